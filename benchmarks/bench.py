@@ -0,0 +1,198 @@
+"""
+Benchmark suite
+
+Generates synthetic banks and measures the parse, list, replace, query,
+layout and write throughput and peak memory of each. Results are compared to a
+stored baseline and the run fails if any of them regressed past the
+threshold, or if there is no baseline.
+
+Run from the repository root:
+    python -m benchmarks.bench [--counts 1000 10000 100000] [--save-baseline]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from modules.bnkwizard import BNKWizard
+from modules.query import parse_query
+from modules.synthetic import make_synthetic_bank
+
+# Searches of the UI search box, the id prefix as it is typed
+QUERIES = ("1", "12", "123", "size:1k-4k", "replaced", "unreplaced 4", "type:2")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Measurements where lower is better, compared against the baseline
+COMPARED_MEASURES = ("seconds", "peak_bytes")
+
+
+def bench_parse(state: dict):
+    """Read the bank, memory-mapped"""
+    state["bnkwizard"] = BNKWizard()
+    state["bnkwizard"].read_bnk(state["bank"], use_mmap=True)
+
+
+def bench_list(state: dict):
+    """Get every WEM and HIRC object, as the list command does"""
+    bnkwizard = state["bnkwizard"]
+    wem_list, wwise_list = bnkwizard.wem_list, bnkwizard.wwise_list
+    for wem_id in wem_list.wem_ids:
+        wem_list.get_wem(wem_id)
+    for wwise_id in wwise_list.wwise_ids:
+        wwise_list.get_wwise(wwise_id).get_name()
+
+
+def bench_replace(state: dict):
+    """Replace one WEM in a hundred with a payload of a different size"""
+    wem_list = state["bnkwizard"].wem_list
+    rnd = random.Random(0)
+    for wem_id in wem_list.wem_ids[::100]:
+        wem_list.set_replacement_data(wem_id, bytes(rnd.randint(16, 8192)))
+
+
+def bench_query(state: dict):
+    """Build the search indexes and run every search of QUERIES"""
+    query = state["bnkwizard"].query
+    query.build()
+    for text in QUERIES:
+        wem_filter, wwise_filter = parse_query(text)
+        query.find_wems(wem_filter)
+        query.find_wwise(wwise_filter)
+
+
+def bench_layout(state: dict):
+    """Compute the final DIDX columns after the replacements"""
+    wem_list = state["bnkwizard"].wem_list
+    wem_list.create_final_wem_data()
+    wem_list.clear_final_wem_data()
+
+
+def bench_write(state: dict):
+    """Write the bank with its replacements"""
+    state["bnkwizard"].write_bnk(state["output"])
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "list": bench_list,
+    "replace": bench_replace,
+    "query": bench_query,
+    "layout": bench_layout,
+    "write": bench_write,
+}
+
+
+def run_benchmarks(bank: str, output: str, repeat: int) -> dict:
+    """Time every benchmark on a bank, best of repeat runs, then measure
+    peak memory in a separate traced run"""
+    results = {name: {"seconds": float("inf")} for name in BENCHMARKS}
+    for _ in range(repeat):
+        state = {"bank": bank, "output": output}
+        for name, bench in BENCHMARKS.items():
+            gc.collect()
+            start = time.perf_counter()
+            bench(state)
+            seconds = time.perf_counter() - start
+            results[name]["seconds"] = min(results[name]["seconds"], seconds)
+        del state
+    state = {"bank": bank, "output": output}
+    for name, bench in BENCHMARKS.items():
+        gc.collect()
+        tracemalloc.start()
+        bench(state)
+        results[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """List the measurements worse than the baseline by more than threshold"""
+    regressions = []
+    for count, benchmarks in results.items():
+        for name, measures in benchmarks.items():
+            for measure in COMPARED_MEASURES:
+                value = measures.get(measure)
+                base_value = baseline.get(count, {}).get(name, {}).get(measure)
+                if value and base_value and value > base_value * (1 + threshold):
+                    regressions.append(
+                        {
+                            "count": count,
+                            "benchmark": name,
+                            "measure": measure,
+                            "baseline": base_value,
+                            "value": value,
+                        }
+                    )
+    return regressions
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """Create the argument parser"""
+    parser = argparse.ArgumentParser(description="Benchmark bank operations")
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown/growth over the baseline (default: 0.25)",
+    )
+    return parser
+
+
+def main(argv: list = None) -> int:
+    """Run the benchmarks and compare them to the baseline"""
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        # Without a baseline nothing would be compared and the run would pass
+        parser.error(
+            f"no baseline at {args.baseline}, run with --save-baseline to store one"
+        )
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for count in args.counts:
+            bank = os.path.join(work_dir, f"synthetic_{count}.bnk")
+            summary = make_synthetic_bank(bank, count, seed=args.seed)
+            benchmarks = run_benchmarks(
+                bank, os.path.join(work_dir, "out.bnk"), args.repeat
+            )
+            for measures in benchmarks.values():
+                measures["entries_per_second"] = count / measures["seconds"]
+            benchmarks["parse"]["mib_per_second"] = (
+                os.path.getsize(bank) / (1 << 20) / benchmarks["parse"]["seconds"]
+            )
+            benchmarks["write"]["mib_per_second"] = (
+                os.path.getsize(bank) / (1 << 20) / benchmarks["write"]["seconds"]
+            )
+            benchmarks["bank"] = {"data_size": summary["data_size"]}
+            results[str(count)] = benchmarks
+            os.remove(bank)
+    report = {"results": results}
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        report["baseline"] = args.baseline
+    else:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        report["regressions"] = compare(results, baseline, args.threshold)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Stream microbenchmark
+
+Times reading and writing integers one at a time and in batches with
+InputStream/OutputStream, against the previous implementation which built
+a format string and made a file call for every integer.
+
+Run from the repository root:
+    python -m benchmarks.iostream_bench [--count 1000000]
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from modules.iostream import InputStream, OutputStream
+
+
+class LegacyInputStream:
+    """Integer reads as InputStream did before the precompiled structs"""
+
+    def __init__(self, file: str, little_endian: bool = True):
+        self.file = open(file, "rb")
+        self.little_endian = little_endian
+
+    def fmt_str(self, f_str: str):
+        """Return the struct format string based on little/big endian"""
+        return "<" + f_str if self.little_endian else ">" + f_str
+
+    def read_int(self) -> int:
+        """Read data from file as integer"""
+        data = self.file.read(4)
+        if len(data) == 0:
+            return None
+        if len(data) < 4:
+            raise IOError("Not enough data to read integer!")
+        data: int = struct.unpack(self.fmt_str("I"), data)[0]
+        return data
+
+    def close(self):
+        """Close the file"""
+        self.file.close()
+
+
+class LegacyOutputStream(LegacyInputStream):
+    """Integer writes as OutputStream did before the write buffer"""
+
+    def __init__(self, file: str, little_endian: bool = True):
+        # pylint: disable=super-init-not-called
+        self.file = open(file, "wb")
+        self.little_endian = little_endian
+
+    def write_int(self, data: int) -> bool:
+        """Write integer data to file"""
+        data = struct.pack(self.fmt_str("I"), data)
+        return self.file.write(data)
+
+
+def measure(func, repeat: int) -> float:
+    """Best time of repeat runs of func, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(count: int, repeat: int, work_dir: str) -> dict:
+    """Time every variant on count integers"""
+    ints_file = os.path.join(work_dir, "ints.bin")
+    out_file = os.path.join(work_dir, "out.bin")
+    values = range(count)
+
+    def write_legacy():
+        out = LegacyOutputStream(out_file)
+        for value in values:
+            out.write_int(value)
+        out.close()
+
+    def write_int():
+        out = OutputStream(out_file)
+        for value in values:
+            out.write_int(value)
+        out.close()
+
+    def write_ints():
+        out = OutputStream(out_file)
+        out.write_ints(values)
+        out.close()
+
+    def read_legacy():
+        inp = LegacyInputStream(ints_file)
+        for _ in values:
+            inp.read_int()
+        inp.close()
+
+    def read_int(use_mmap: bool):
+        inp = InputStream(ints_file, use_mmap=use_mmap)
+        for _ in values:
+            inp.read_int()
+        inp.close()
+
+    def read_ints():
+        inp = InputStream(ints_file, use_mmap=True)
+        inp.read_ints(count)
+        inp.close()
+
+    write_ints()
+    os.replace(out_file, ints_file)
+    results = {
+        "write_int (legacy)": measure(write_legacy, repeat),
+        "write_int": measure(write_int, repeat),
+        "write_ints": measure(write_ints, repeat),
+        "read_int (legacy)": measure(read_legacy, repeat),
+        "read_int (file)": measure(lambda: read_int(False), repeat),
+        "read_int (mmap)": measure(lambda: read_int(True), repeat),
+        "read_ints (mmap)": measure(read_ints, repeat),
+    }
+    return {
+        name: {"seconds": seconds, "ints_per_second": count / seconds}
+        for name, seconds in results.items()
+    }
+
+
+def main(argv: list = None) -> int:
+    """Run the microbenchmark"""
+    parser = argparse.ArgumentParser(description="Benchmark stream integer I/O")
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run(args.count, args.repeat, work_dir)
+    results["speedup"] = {
+        "write_int": results["write_int (legacy)"]["seconds"]
+        / results["write_int"]["seconds"],
+        "read_int (mmap)": results["read_int (legacy)"]["seconds"]
+        / results["read_int (mmap)"]["seconds"],
+        "read_int (file)": results["read_int (legacy)"]["seconds"]
+        / results["read_int (file)"]["seconds"],
+    }
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,28 +2,121 @@
 Module for utilities
 """
 
+import os
 import tempfile
+import threading
 import subprocess
 import logging
-from pygame import mixer
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from io import BytesIO
+from modules import profiling
+from modules.cache import ConversionCache
+from modules.hashing import get_digest
+
+VGMSTREAM_CLI = os.path.join("bin", "vgmstream-cli.exe")
+# Jobs submitted per worker ahead of the results being consumed, so results
+# are not all held at once and cancelling stops quickly
+JOBS_PER_WORKER = 2
+conversion_cache: ConversionCache = None
+
+
+@dataclass(slots=True)
+class ConversionResult:
+    """Result of one conversion job of a batch"""
+
+    file: str
+    data: bytes = None
+    error: str = None
+
+
+def make_scratch_file(suffix: str) -> str:
+    """Create a unique scratch file, so conversions can run concurrently"""
+    scratch_fd, scratch_file = tempfile.mkstemp(suffix=suffix, prefix="bnkwizard-")
+    os.close(scratch_fd)
+    return scratch_file
+
+
+def run_vgmstream_to_memory(in_file: str) -> bytes:
+    """Convert in_file with vgmstream, piping the wav output back"""
+    with profiling.span("vgmstream", file=in_file):
+        return subprocess.run(
+            [VGMSTREAM_CLI, "-p", in_file], stdout=subprocess.PIPE, check=True
+        ).stdout
+
+
+def set_conversion_cache(cache: ConversionCache):
+    """Set the cache used by all conversions, None to disable caching"""
+    global conversion_cache  # pylint: disable=global-statement
+    conversion_cache = cache
+
+
+@lru_cache(maxsize=None)
+def get_converter_version() -> str:
+    """Identify the vgmstream build, so upgrading it invalidates the cache"""
+    try:
+        exe_stat = os.stat(VGMSTREAM_CLI)
+    except OSError:
+        return "vgmstream:missing"
+    return f"vgmstream:{exe_stat.st_size}:{exe_stat.st_mtime_ns}"
+
+
+def run_cached_conversion(data: bytes, kind: str, in_suffix: str) -> bytes:
+    """Convert data with vgmstream, serving it from the cache if possible"""
+    cache = conversion_cache
+    if cache is not None:
+        key = cache.make_key(data, kind, get_converter_version())
+        cached_data = cache.get(key)
+        if cached_data is not None:
+            profiling.count("cache_hits")
+            return cached_data
+        profiling.count("cache_misses")
+    profiling.count("conversions")
+    # vgmstream needs a real input file, the output comes back through a pipe
+    in_file = make_scratch_file(in_suffix)
+    try:
+        with open(in_file, "wb") as scratch_file:
+            scratch_file.write(data)
+        converted_data = run_vgmstream_to_memory(in_file)
+    finally:
+        os.remove(in_file)
+    if cache is not None:
+        cache.put(key, converted_data)
+    return converted_data
+
+
+def decode_wem(wem_data: bytes) -> bytes:
+    """Decode wem data to wav data"""
+    return run_cached_conversion(wem_data, "wav", ".wem")
+
+
+def convert_to_wem(new_file: str) -> bytes:
+    """If wem data, return as is, else convert to wem and return
+
+    Raises on failure, see get_data_as_wem for the logging variant"""
+    with open(new_file, "rb") as aud_file:
+        aud_data = aud_file.read()
+    if new_file.endswith(".wem"):
+        return aud_data
+    return run_cached_conversion(aud_data, "wem", os.path.splitext(new_file)[1])
+
+
+def write_wem_to_file(wem_data: bytes, aud_filename: str):
+    """Write wem to file, decoding it unless the file is a .wem
+
+    Raises on failure, see save_wem_to_file for the logging variant"""
+    if not aud_filename.endswith(".wem"):
+        wem_data = decode_wem(wem_data)
+    with open(aud_filename, "wb") as aud_file:
+        aud_file.write(wem_data)
 
 
 def get_data_as_wem(new_file: str) -> bytes:
     """If wem data, return as is, else convert to wem and return"""
     try:
-        if new_file.endswith(".wem"):
-            with open(new_file, "rb") as wem_file:
-                return wem_file.read()
-
-        new_wem_file = tempfile.gettempdir() + "\\temp.wem"
-        subprocess.check_call(
-            [
-                r"bin\\vgmstream-cli.exe",
-                "-o",
-                new_wem_file,
-                new_file,
-            ]
-        )
+        return convert_to_wem(new_file)
     except IOError as err:
         logging.exception(err)
         return 0
@@ -33,28 +126,12 @@ def get_data_as_wem(new_file: str) -> bytes:
     except Exception as err:
         logging.exception(err)
         return 0
-    with open(new_wem_file, "rb") as wem_file:
-        return wem_file.read()
 
 
 def save_wem_to_file(wem_data: bytes, aud_filename: str) -> int:
     """Write wem to file"""
     try:
-        if aud_filename.endswith(".wem"):
-            with open(aud_filename, "wb") as wem_file:
-                wem_file.write(wem_data)
-            return 1
-        new_wem_filename = tempfile.gettempdir() + "\\temp.wem"
-        with open(new_wem_filename, "wb") as new_wem_file:
-            new_wem_file.write(wem_data)
-        subprocess.check_call(
-            [
-                r"bin\\vgmstream-cli.exe",
-                "-o",
-                aud_filename,
-                new_wem_filename,
-            ]
-        )
+        write_wem_to_file(wem_data, aud_filename)
         return 1
     except IOError as err:
         logging.exception(err)
@@ -67,34 +144,150 @@ def save_wem_to_file(wem_data: bytes, aud_filename: str) -> int:
         return 0
 
 
-def play_wem_audio(wem_data: bytes):
-    """Play the given wem audio"""
-    wem_filename = tempfile.gettempdir() + "\\temp.wem"
-    with open(wem_filename, mode="wb") as wem_file:
-        wem_file.write(wem_data.data)
-    try:
-        mixer.music.unload()
-    finally:
-        pass
+def run_conversion_job(func, file: str, *args) -> ConversionResult:
+    """Run one conversion job, capturing its error instead of raising"""
     try:
-        wav_filename = wem_filename.split(".wem")[0] + ".wav"
-        subprocess.check_call(
-            [
-                r"bin\\vgmstream-cli.exe",
-                "-o",
-                wav_filename,
-                wem_filename,
-            ]
-        )
-        mixer.music.load(wav_filename)
-        mixer.music.play()
+        with profiling.span("conversion", file=file):
+            return ConversionResult(file, func(*args))
     except subprocess.CalledProcessError as err:
-        print(err.output)
+        return ConversionResult(file, error="vgmstream failed: " + str(err))
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        return ConversionResult(file, error=str(err))
 
 
-def stop_wem_audio():
-    """Stop if any audio is playing"""
-    try:
-        mixer.music.stop()
-    finally:
-        pass
+def get_batch_as_wem(files: list, max_workers: int = None) -> list:
+    """Convert many files to wem concurrently
+
+    vgmstream runs as a subprocess, so a thread pool bounded to max_workers
+    (the number of CPUs by default) is enough to keep every core busy.
+    Returns one ConversionResult per file, in order"""
+    return list(iter_batch_as_wem(files, max_workers))
+
+
+def iter_batch_as_wem(files: list, max_workers: int = None):
+    """Convert many files to wem concurrently, yielding one ConversionResult
+    per file in order
+
+    At most JOBS_PER_WORKER conversions per worker are submitted ahead of
+    the result being yielded, so only that many converted payloads are held
+    if the caller stores each result before asking for the next"""
+    max_workers = max_workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers) as pool:
+        pending = deque()
+        for file in files:
+            if len(pending) >= max_workers * JOBS_PER_WORKER:
+                yield pending.popleft().result()
+            pending.append(pool.submit(run_conversion_job, convert_to_wem, file, file))
+        while pending:
+            yield pending.popleft().result()
+
+
+class AudioPlayer:
+    """Plays WEMs without blocking the caller
+
+    Decoding runs on background workers and the decoded wav is handed to
+    pygame from memory. Recently decoded clips are kept in an LRU bounded to
+    max_bytes, keyed by WEM id and payload hash. Play requests have their
+    own worker, so they never wait behind prefetches, and only the latest
+    prefetch request is kept. Payloads are hashed on the workers"""
+
+    def __init__(self, max_bytes: int = 256 << 20):
+        self.max_bytes = max_bytes
+        self.play_pool = ThreadPoolExecutor(1)
+        self.prefetch_pool = ThreadPoolExecutor(1)
+        self.lock = threading.Lock()
+        self.decoded = OrderedDict()
+        self.decoded_bytes = 0
+        self.pending = {}
+        self.prefetch_wems = deque()
+        self.prefetching = False
+        self.play_token = 0
+
+    def get_key(self, wem) -> tuple:
+        """LRU key of a WEM"""
+        return wem.wem_id, get_digest(wem.data)
+
+    def decode(self, wem) -> bytes:
+        """Decode a WEM on the calling thread, unless it is in the LRU or
+        already being decoded by the other worker, and store it in the LRU"""
+        key = self.get_key(wem)
+        with self.lock:
+            if key in self.decoded:
+                self.decoded.move_to_end(key)
+                return self.decoded[key]
+            future = self.pending.get(key)
+            running = future is not None
+            if not running:
+                future = self.pending[key] = Future()
+        if running:
+            return future.result()
+        try:
+            wav_data = decode_wem(bytes(wem.data))
+        except Exception as err:
+            with self.lock:
+                self.pending.pop(key, None)
+            future.set_exception(err)
+            raise
+        with self.lock:
+            self.pending.pop(key, None)
+            self.decoded[key] = wav_data
+            self.decoded_bytes += len(wav_data)
+            while self.decoded_bytes > self.max_bytes and len(self.decoded) > 1:
+                _, old_data = self.decoded.popitem(last=False)
+                self.decoded_bytes -= len(old_data)
+        future.set_result(wav_data)
+        return wav_data
+
+    def prefetch(self, wems: list):
+        """Speculatively decode WEMs which are likely to be played next,
+        dropping the WEMs of earlier requests which were not started yet"""
+        with self.lock:
+            self.prefetch_wems = deque(wems)
+            if self.prefetching:
+                return
+            self.prefetching = True
+        self.prefetch_pool.submit(self.prefetch_job)
+
+    def prefetch_job(self):
+        """Decode the prefetched WEMs until there are none left"""
+        while True:
+            with self.lock:
+                if not self.prefetch_wems:
+                    self.prefetching = False
+                    return
+                wem = self.prefetch_wems.popleft()
+            try:
+                self.decode(wem)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.exception(err)
+
+    def play(self, wem):
+        """Play a WEM once it is decoded, superseding earlier play requests"""
+        with self.lock:
+            self.play_token += 1
+            token = self.play_token
+        self.play_pool.submit(self.play_job, wem, token)
+
+    def play_job(self, wem, token: int):
+        """Decode and play a WEM unless a newer request came in meanwhile"""
+        from pygame import mixer  # pylint: disable=import-outside-toplevel
+
+        if token != self.play_token:
+            return
+        try:
+            sound = mixer.Sound(file=BytesIO(self.decode(wem)))
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.exception(err)
+            return
+        if token != self.play_token:
+            return
+        mixer.stop()
+        sound.play()
+
+    def stop(self):
+        """Stop playing and drop pending play requests"""
+        from pygame import mixer  # pylint: disable=import-outside-toplevel
+
+        with self.lock:
+            self.play_token += 1
+        mixer.stop()
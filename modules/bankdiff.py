@@ -0,0 +1,289 @@
+"""bankdiff: Module to diff banks and apply the resulting patches
+
+A patch rebuilds the target bank from the base bank with a stream of
+operations: copy a byte range of the base, insert literal bytes or insert
+zero padding. Only WEM payloads, HIRC objects and chunks which cannot be
+found in the base are stored literally.
+"""
+
+import hashlib
+import os
+import struct
+from dataclasses import dataclass
+from modules.bnkwizard import BNKWizard
+from modules.hashing import get_digest
+from modules.iostream import COPY_CHUNK_SIZE, InputStream, OutputStream
+
+PATCH_MAGIC = b"BNKD"
+PATCH_VERSION = 1
+PATCH_HEADER = struct.Struct("<4sIQ32sQ32s")
+OP_END = 0
+OP_COPY = 1
+OP_DATA = 2
+OP_ZERO = 3
+OP_HEADER = struct.Struct("<BQQ")
+# PatchWriter statistic counting the bytes of each operation
+OP_STATS = {OP_COPY: "copy_bytes", OP_DATA: "data_bytes", OP_ZERO: "zero_bytes"}
+
+
+def hash_file(file: str) -> bytes:
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file, "rb") as hashed_file:
+        while chunk := hashed_file.read(COPY_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def get_bank_buffer(bnk: str) -> memoryview:
+    """View of a whole bank file, memory-mapped"""
+    input_stream = InputStream(bnk, use_mmap=True)
+    bank_buffer = input_stream.get_view(0, len(input_stream.buffer))
+    input_stream.close()
+    return bank_buffer
+
+
+@dataclass(slots=True)
+class PatchOperation:
+    """An operation of a patch, data holds the literal pieces of OP_DATA"""
+
+    opcode: int
+    pos: int
+    size: int
+    data: list = None
+
+
+class PatchWriter:
+    """Writes patch operations, merging adjacent ones"""
+
+    def __init__(self, patch_file):
+        self.patch_file = patch_file
+        self.pending = None
+        self.stats = {"copy_bytes": 0, "data_bytes": 0, "zero_bytes": 0, "ops": 0}
+
+    def add(self, opcode: int, pos: int, size: int, data: memoryview = None):
+        """Add an operation, data is the literal bytes of OP_DATA"""
+        if size == 0:
+            return
+        pending = self.pending
+        if pending is not None and pending.opcode == opcode:
+            if opcode == OP_COPY and pending.pos + pending.size == pos:
+                pending.size += size
+                return
+            if opcode == OP_ZERO:
+                pending.size += size
+                return
+            if opcode == OP_DATA:
+                pending.data.append(data)
+                pending.size += size
+                return
+        self.flush()
+        self.pending = PatchOperation(
+            opcode, pos, size, [data] if opcode == OP_DATA else None
+        )
+
+    def flush(self):
+        """Write the pending operation"""
+        pending = self.pending
+        if pending is None:
+            return
+        self.patch_file.write(OP_HEADER.pack(pending.opcode, pending.pos, pending.size))
+        for piece in pending.data or ():
+            self.patch_file.write(piece)
+        self.stats["ops"] += 1
+        self.stats[OP_STATS[pending.opcode]] += pending.size
+        self.pending = None
+
+    def close(self):
+        """Write the end marker"""
+        self.flush()
+        self.patch_file.write(OP_HEADER.pack(OP_END, 0, 0))
+
+
+def diff_banks(base: str, target: str, patch: str, little_endian: bool = True):
+    """Write a patch turning the base bank into the target bank
+
+    Both banks are memory-mapped and compared through their DIDX and HIRC
+    indexes and payload hashes. Returns statistics of the patch"""
+    banks = []
+    for bnk in (base, target):
+        bnkwizard = BNKWizard()
+        bnkwizard.read_bnk(bnk, little_endian, use_mmap=True)
+        banks.append(bnkwizard)
+    base_bank, target_bank = banks
+    base_buffer = get_bank_buffer(base)
+    target_buffer = get_bank_buffer(target)
+    base_chunks = {}
+    for tag, pos, size in base_bank.sections.chunks:
+        base_chunks.setdefault(tag, []).append((pos, size))
+
+    with open(patch, "wb") as patch_file:
+        patch_file.write(
+            PATCH_HEADER.pack(
+                PATCH_MAGIC,
+                PATCH_VERSION,
+                os.path.getsize(base),
+                hash_file(base),
+                os.path.getsize(target),
+                hash_file(target),
+            )
+        )
+        writer = PatchWriter(patch_file)
+        for tag, pos, size in target_bank.sections.chunks:
+            if tag == "DATA":
+                writer.add(OP_DATA, 0, 8, target_buffer[pos : pos + 8])
+                diff_wems(writer, base_bank, target_bank, base_buffer)
+            elif tag == "HIRC":
+                writer.add(OP_DATA, 0, 12, target_buffer[pos : pos + 12])
+                diff_wwise_objects(writer, base_bank, target_bank)
+            else:
+                chunk = target_buffer[pos : pos + 8 + size]
+                for base_pos, base_size in base_chunks.get(tag, ()):
+                    if base_buffer[base_pos : base_pos + 8 + base_size] == chunk:
+                        writer.add(OP_COPY, base_pos, 8 + size)
+                        break
+                else:
+                    writer.add(OP_DATA, 0, 8 + size, chunk)
+        writer.close()
+    return writer.stats
+
+
+def diff_wems(
+    writer: PatchWriter,
+    base_bank: BNKWizard,
+    target_bank: BNKWizard,
+    base_buffer: memoryview,
+):
+    """Add the operations rebuilding the DATA section payloads"""
+    base_list, target_list = base_bank.wem_list, target_bank.wem_list
+    base_payloads = {}
+    for idx in range(base_list.wem_count):
+        digest = get_digest(base_list.get_payload(idx))
+        base_payloads.setdefault(
+            digest, base_list.abs_offset + base_list.offsets[idx]
+        )
+    target_data = target_list.data_buffer
+    pos = 0
+    for idx in range(target_list.wem_count):
+        offset, size = target_list.offsets[idx], target_list.sizes[idx]
+        add_padding(writer, target_data[pos:offset], base_buffer)
+        payload = target_list.get_payload(idx)
+        digest = get_digest(payload)
+        if digest in base_payloads:
+            writer.add(OP_COPY, base_payloads[digest], size)
+        else:
+            writer.add(OP_DATA, 0, size, payload)
+        pos = offset + size
+    add_padding(writer, target_data[pos:], base_buffer)
+
+
+def add_padding(writer: PatchWriter, padding: memoryview, base_buffer: memoryview):
+    """Add the operation rebuilding alignment padding, extending the pending
+    copy when the base has the same bytes, so unchanged runs stay one copy"""
+    pending = writer.pending
+    if pending is not None and pending.opcode == OP_COPY:
+        end = pending.pos + pending.size
+        if base_buffer[end : end + len(padding)] == padding:
+            writer.add(OP_COPY, end, len(padding))
+            return
+    if not any(padding):
+        writer.add(OP_ZERO, 0, len(padding))
+    else:
+        writer.add(OP_DATA, 0, len(padding), padding)
+
+
+def diff_wwise_objects(
+    writer: PatchWriter, base_bank: BNKWizard, target_bank: BNKWizard
+):
+    """Add the operations rebuilding the HIRC objects"""
+    base_list, target_list = base_bank.wwise_list, target_bank.wwise_list
+    base_records = {}
+    for idx in range(base_list.num_wwise):
+        start = base_list.offsets[idx]
+        end = start + base_list.header.size + base_list.sizes[idx] - 4
+        digest = get_digest(base_list.hirc_buffer[start:end])
+        base_records.setdefault(digest, base_list.abs_offset + start)
+    for idx in range(target_list.num_wwise):
+        start = target_list.offsets[idx]
+        end = start + target_list.header.size + target_list.sizes[idx] - 4
+        record = target_list.hirc_buffer[start:end]
+        base_pos = base_records.get(get_digest(record))
+        if base_pos is not None:
+            writer.add(OP_COPY, base_pos, end - start)
+        else:
+            writer.add(OP_DATA, 0, end - start, record)
+
+
+def read_patch_header(patch_file) -> tuple:
+    """Read and check the header of a patch, returns the base and target
+    (size, sha256)"""
+    header = patch_file.read(PATCH_HEADER.size)
+    if len(header) != PATCH_HEADER.size:
+        raise ValueError("Truncated patch header")
+    magic, version, base_size, base_hash, target_size, target_hash = (
+        PATCH_HEADER.unpack(header)
+    )
+    if magic != PATCH_MAGIC:
+        raise ValueError("Not a bank patch")
+    if version != PATCH_VERSION:
+        raise ValueError("Unsupported bank patch version " + str(version))
+    return (base_size, base_hash), (target_size, target_hash)
+
+
+def apply_patch(base: str, patch: str, bnk: str, verify: bool = True) -> dict:
+    """Rebuild a target bank from the base bank and a patch
+
+    The operations are streamed to a temporary file which only replaces bnk
+    once its hash matches the target. With verify the base is also checked
+    against the patch before anything is written"""
+    with open(patch, "rb") as patch_file:
+        (base_size, base_hash), (target_size, target_hash) = read_patch_header(
+            patch_file
+        )
+        if verify and (
+            os.path.getsize(base) != base_size or hash_file(base) != base_hash
+        ):
+            raise ValueError("Base bank does not match the patch")
+        tmp_bnk = f"{bnk}.{os.getpid()}.tmp"
+        try:
+            with open(base, "rb") as base_file:
+                out = OutputStream(tmp_bnk)
+                try:
+                    apply_ops(patch_file, base_file, out)
+                finally:
+                    out.close()
+            if (
+                os.path.getsize(tmp_bnk) != target_size
+                or hash_file(tmp_bnk) != target_hash
+            ):
+                raise ValueError("Patched bank does not match the target")
+            os.replace(tmp_bnk, bnk)
+        except BaseException:
+            if os.path.exists(tmp_bnk):
+                os.remove(tmp_bnk)
+            raise
+    return {"size": target_size, "sha256": target_hash.hex()}
+
+
+def apply_ops(patch_file, base_file, out: OutputStream):
+    """Stream the operations of a patch to out"""
+    while True:
+        op_header = patch_file.read(OP_HEADER.size)
+        if len(op_header) != OP_HEADER.size:
+            raise ValueError("Truncated patch")
+        opcode, pos, size = OP_HEADER.unpack(op_header)
+        if opcode == OP_END:
+            return
+        if opcode == OP_COPY:
+            out.copy_from(base_file, pos, size)
+        elif opcode == OP_ZERO:
+            out.write_zeros(size)
+        elif opcode == OP_DATA:
+            while size:
+                chunk = patch_file.read(min(size, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError("Truncated patch")
+                out.write_bytes(chunk)
+                size -= len(chunk)
+        else:
+            raise ValueError("Unknown patch operation " + str(opcode))
@@ -0,0 +1,161 @@
+"""blobstore: Module to keep payloads in memory up to a budget"""
+
+import mmap
+import tempfile
+import threading
+from collections import OrderedDict
+from modules import profiling
+from modules.iostream import OutputStream
+
+spill_budget: int = None
+spill_dir: str = None
+
+
+class BlobStore:
+    """Payloads kept in memory up to max_bytes, the rest in a scratch file
+
+    Once the payloads in memory exceed max_bytes, the least recently used
+    ones are appended to a scratch file in spill_dir (the temp directory by
+    default), which is deleted when the store is closed. Spilled payloads
+    are read back as views of a mapping of the scratch file and written out
+    with OutputStream.copy_from, so they never pass through Python buffers
+    again. Without max_bytes every payload stays in memory"""
+
+    def __init__(self, max_bytes: int = None, scratch_dir: str = None):
+        self.max_bytes = max_bytes
+        self.scratch_dir = scratch_dir
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.spilled = {}
+        self.spill_file = None
+        self.spill_size = 0
+        self.mapping = None
+        self.view = None
+
+    def __len__(self) -> int:
+        return len(self.memory) + len(self.spilled)
+
+    def __contains__(self, key) -> bool:
+        return key in self.memory or key in self.spilled
+
+    def put(self, key, data: bytes):
+        """Store the payload of key, replacing any previous one"""
+        with self.lock:
+            self.discard(key)
+            self.memory[key] = data
+            self.memory_bytes += len(data)
+            if self.max_bytes is None:
+                return
+            while self.memory_bytes > self.max_bytes:
+                old_key, old_data = self.memory.popitem(last=False)
+                self.memory_bytes -= len(old_data)
+                self.spill(old_key, old_data)
+
+    def spill(self, key, data: bytes):
+        """Append a payload to the scratch file"""
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(
+                prefix="bnkwizard-spill-", dir=self.scratch_dir
+            )
+        self.spill_file.seek(self.spill_size)
+        self.spill_file.write(data)
+        self.spilled[key] = (self.spill_size, len(data))
+        self.spill_size += len(data)
+        profiling.count_io("spill", len(data))
+
+    def get(self, key) -> memoryview:
+        """Get the payload of key, a view of the scratch file if spilled"""
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                return memoryview(data)
+            offset, size = self.spilled[key]
+            if self.mapping is None or offset + size > len(self.mapping):
+                # Views of the previous mapping stay valid, it is released
+                # once the last of them is gone
+                self.spill_file.flush()
+                self.mapping = mmap.mmap(
+                    self.spill_file.fileno(), self.spill_size, access=mmap.ACCESS_READ
+                )
+                self.view = memoryview(self.mapping)
+            return self.view[offset : offset + size]
+
+    def get_size(self, key) -> int:
+        """Get the size of the payload of key"""
+        with self.lock:
+            data = self.memory.get(key)
+            return len(data) if data is not None else self.spilled[key][1]
+
+    def write_to(self, key, out: OutputStream) -> int:
+        """Write the payload of key to a stream, copying it straight from the
+        scratch file if spilled"""
+        with self.lock:
+            data = self.memory.get(key)
+            if data is None:
+                offset, size = self.spilled[key]
+                self.spill_file.flush()
+                return out.copy_from(self.spill_file, offset, size)
+        return out.write_bytes(data)
+
+    def remove(self, key):
+        """Forget the payload of key"""
+        with self.lock:
+            self.discard(key)
+
+    def discard(self, key):
+        """Forget the payload of key if any, the lock being held. The space
+        of spilled payloads is only reclaimed when the store is closed"""
+        data = self.memory.pop(key, None)
+        if data is not None:
+            self.memory_bytes -= len(data)
+        self.spilled.pop(key, None)
+
+    def detach(self):
+        """Replace the payloads in memory which are views, e.g. of a mapped
+        bank, by copies"""
+        with self.lock:
+            for key, data in self.memory.items():
+                if isinstance(data, memoryview):
+                    self.memory[key] = bytes(data)
+
+    def get_stats(self) -> dict:
+        """Get the payload counts and bytes in memory and spilled"""
+        with self.lock:
+            return {
+                "memory_count": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "spilled_count": len(self.spilled),
+                "spilled_bytes": sum(size for _, size in self.spilled.values()),
+                "spill_file_bytes": self.spill_size,
+            }
+
+    def close(self):
+        """Drop every payload and delete the scratch file"""
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            self.spilled.clear()
+            if self.view is not None:
+                self.view.release()
+                self.view = None
+            if self.mapping is not None:
+                try:
+                    self.mapping.close()
+                except BufferError:
+                    # Views handed out are still alive
+                    pass
+                self.mapping = None
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            self.spill_size = 0
+
+
+def set_spill_budget(max_bytes: int, scratch_dir: str = None):
+    """Set the memory budget of the replacement payloads of every bank read
+    afterwards and where the rest spills to, None for no budget"""
+    global spill_budget, spill_dir  # pylint: disable=global-statement
+    spill_budget = max_bytes
+    spill_dir = scratch_dir
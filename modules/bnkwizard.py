@@ -1,9 +1,23 @@
 """
 bnkwizard Module
 """
+import os
+from typing import Callable
+from modules import indexcache, profiling
+from modules.extraction import extract_wems
+from modules.indexcache import BankIndex
 from modules.iostream import InputStream, OutputStream
+from modules.journal import patch_file, recover_journal
 from modules.objects import WemList, WwiseList
+from modules.query import BankQuery, WemFilter, WwiseFilter
+from modules.refgraph import ReferenceGraph
 from modules.sections import Sections
+from modules.verify import hash_payloads, verify_bank
+
+
+class LoadCancelled(Exception):
+    """Raised from a progress callback to cancel loading a bank or
+    extracting its WEMs"""
 
 
 class BNKWizard:
@@ -12,19 +26,244 @@ class BNKWizard:
     sections: Sections
     wem_list: WemList
     wwise_list: WwiseList
+    references: ReferenceGraph
+    query: BankQuery = None
+    bnk_path: str = None
+    bnk_stat: tuple = None
+    mapped: bool = False
+
+    def read_bnk(
+        self,
+        bnk: str,
+        little_endian: bool = True,
+        use_mmap: bool = False,
+        progress: Callable[[str], None] = None,
+        headers: set = None,
+    ) -> None:
+        """Load an existing BNK file and read its contents
+
+        With use_mmap the bank is memory-mapped and WEM payloads are kept as
+        lazy memoryview slices of the mapping instead of being copied.
+        progress is called with the header of every section read and may
+        raise LoadCancelled to abort. headers restricts reading to those
+        sections, e.g. {"DIDX"} to list WEMs, such banks cannot be written.
+        If an index cache is set, the parsed index is taken from it when
+        the bank is unchanged and stored in it after a full parse. The
+        reference graph is only built on its first query, its edges are then
+        added to the stored index"""
+        with profiling.span("read_bnk", bank=bnk):
+            recover_journal(bnk)
+            cache = indexcache.index_cache
+            index = key = None
+            if cache is not None:
+                with profiling.span("load index"):
+                    key = cache.make_key(bnk)
+                    index = cache.load(bnk, little_endian, key)
+            self.sections = Sections()
+            self.wem_list = WemList()
+            self.wwise_list = WwiseList()
+            input_stream = InputStream(bnk, little_endian, use_mmap)
+            try:
+                self.sections.read_sections(
+                    input_stream,
+                    self.wem_list,
+                    self.wwise_list,
+                    progress,
+                    headers,
+                    index,
+                )
+            finally:
+                # The mapping stays alive as long as the payload views
+                # reference it
+                input_stream.close()
+            self.references = ReferenceGraph(
+                self.wem_list, self.wwise_list, little_endian
+            )
+            self.query = BankQuery(self.wem_list, self.wwise_list)
+            if cache is not None and headers is None:
+                if index is None:
+                    with profiling.span("save index"):
+                        cache.save(bnk, little_endian, key, self.get_index())
+                if index is None or index.object_wem_edges is None:
+                    self.references.on_build = lambda: self.save_index(
+                        bnk, little_endian, key
+                    )
+            if index is not None and index.object_wem_edges is not None:
+                if headers is None or "HIRC" in headers:
+                    self.references.load_edges(
+                        index.object_wem_edges, index.child_edges
+                    )
+        self.bnk_path = bnk
+        bnk_stat = os.stat(bnk)
+        self.bnk_stat = (bnk_stat.st_size, bnk_stat.st_mtime_ns)
+        self.mapped = use_mmap
+
+    def get_index(self) -> BankIndex:
+        """Get the parsed index of the bank, as stored in the index cache"""
+        object_wem_edges, child_edges = self.references.get_flat_edges()
+        return BankIndex(
+            chunks=self.sections.chunks,
+            didx_offset=self.wem_list.didx_offset,
+            wem_ids=self.wem_list.wem_ids,
+            wem_offsets=self.wem_list.offsets,
+            wem_sizes=self.wem_list.sizes,
+            hirc_offset=self.wwise_list.abs_offset,
+            num_wwise=self.wwise_list.num_wwise or 0,
+            section_types=self.wwise_list.section_types,
+            wwise_ids=self.wwise_list.wwise_ids,
+            wwise_offsets=self.wwise_list.offsets,
+            wwise_sizes=self.wwise_list.sizes,
+            object_wem_edges=object_wem_edges,
+            child_edges=child_edges,
+        )
+
+    def save_index(self, bnk: str, little_endian: bool, key: tuple):
+        """Store the index with the reference graph edges once the graph is
+        built, unless the objects were modified since reading"""
+        cache = indexcache.index_cache
+        if cache is None or self.wwise_list.modified or bnk != self.bnk_path:
+            return
+        with profiling.span("save index"):
+            cache.save(bnk, little_endian, key, self.get_index())
+
+    def extract_all(
+        self,
+        out_dir: str,
+        wem_ids: list = None,
+        wem_filter: WemFilter = None,
+        wav: bool = False,
+        max_workers: int = None,
+        progress: Callable[[int, int], None] = None,
+        force: bool = False,
+    ) -> list:
+        """Extract every WEM, or only those of wem_ids and/or matching
+        wem_filter, to out_dir
+
+        See extract_wems for the other parameters. Returns one ExtractResult
+        per WEM"""
+        if wem_filter is not None:
+            matches = self.find_wems(wem_filter)
+            if wem_ids is not None:
+                matches = set(matches)
+                matches = [wem_id for wem_id in wem_ids if wem_id in matches]
+            wem_ids = matches
+        return extract_wems(
+            self.wem_list, out_dir, wem_ids, wav, max_workers, progress, force
+        )
+
+    def replace_wwise_data(self, wwise_id: int, data: bytes):
+        """Replace the body of a HIRC object and update its references"""
+        self.wwise_list.replace_wwise_data(wwise_id, data)
+        self.references.update_object(wwise_id)
+        self.query.update_wwise(wwise_id)
 
-    def read_bnk(self, bnk: str, little_endian: bool = True) -> None:
-        """Load an existing BNK file and read its contents"""
-        self.sections = Sections()
-        self.wem_list = WemList()
-        self.wwise_list = WwiseList()
-        input_stream = InputStream(bnk, little_endian)
-        self.sections.read_sections(input_stream, self.wem_list, self.wwise_list)
-        input_stream.close()
+    def find_wems(self, wem_filter: WemFilter) -> list:
+        """Get the ids of the WEMs matching a filter, in bank order"""
+        wem_ids = self.wem_list.wem_ids
+        return [wem_ids[pos] for pos in self.query.find_wems(wem_filter)]
+
+    def find_wwise(self, wwise_filter: WwiseFilter) -> list:
+        """Get the ids of the HIRC objects matching a filter, in bank order"""
+        wwise_ids = self.wwise_list.wwise_ids
+        return [wwise_ids[pos] for pos in self.query.find_wwise(wwise_filter)]
+
+    def open_source(self):
+        """Open the source bank for copying, if it is unchanged since reading"""
+        if self.bnk_path is None:
+            return None
+        try:
+            bnk_stat = os.stat(self.bnk_path)
+        except OSError:
+            return None
+        if (bnk_stat.st_size, bnk_stat.st_mtime_ns) != self.bnk_stat:
+            return None
+        return open(self.bnk_path, "rb")
 
     def write_bnk(self, bnk: str, little_endian: bool = True):
-        """Create BNK file and write data to it"""
-        output_stream = OutputStream(bnk, little_endian)
-        self.wem_list.create_final_wem_data()
-        self.sections.write_sections(output_stream, self.wem_list, self.wwise_list)
-        output_stream.close()
+        """Create BNK file and write data to it
+
+        The bank is streamed into a temporary file next to the destination,
+        synced to disk and atomically renamed into place once complete. When
+        overwriting the memory-mapped bank itself, the views of the mapping
+        are first replaced by copies and the source is closed, as Windows
+        cannot replace a file which is open or mapped"""
+        if not self.sections.complete:
+            raise ValueError("Cannot write a bank which was only partially read!")
+        overwrite = (
+            self.mapped and os.path.exists(bnk) and os.path.samefile(bnk, self.bnk_path)
+        )
+        # Created through OutputStream so the bank gets the usual permissions
+        tmp_path = f"{bnk}.{os.getpid()}.tmp"
+        output_stream = OutputStream(tmp_path, little_endian)
+        source = self.open_source()
+        try:
+            with profiling.span("write_bnk", bank=bnk):
+                with profiling.span("layout"):
+                    self.wem_list.create_final_wem_data()
+                self.sections.write_sections(
+                    output_stream, self.wem_list, self.wwise_list, source
+                )
+                output_stream.sync()
+                output_stream.close()
+                if source is not None:
+                    source.close()
+                if overwrite:
+                    self.sections.detach(self.wem_list, self.wwise_list)
+                    self.mapped = False
+                os.replace(tmp_path, bnk)
+        except BaseException:
+            # Closing would try to write the buffered data again
+            output_stream.abort()
+            os.remove(tmp_path)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+
+    def hash_wems(self, max_workers: int = None) -> dict:
+        """Get the wem_id -> digest of the payload every WEM will be written
+        with, its replacement if it has one"""
+        wem_list = self.wem_list
+        payloads = [
+            (
+                wem_list.get_replacement_data(wem_id)
+                if wem_id in wem_list.repl_wems
+                else wem_list.get_payload(idx)
+            )
+            for idx, wem_id in enumerate(wem_list.wem_ids)
+        ]
+        return dict(zip(wem_list.wem_ids, hash_payloads(payloads, max_workers)))
+
+    def verify(
+        self, bnk: str, little_endian: bool = True, max_workers: int = None
+    ) -> dict:
+        """Check a bank written from this one, see verify_bank
+
+        Every WEM of the bank must hold the payload it has here, its
+        replacement if it has one"""
+        return verify_bank(bnk, little_endian, self.hash_wems(max_workers), max_workers)
+
+    def patch_bnk(self, little_endian: bool = True) -> str:
+        """Apply the pending replacements to the source bank
+
+        If every replacement fits the aligned slot of the WEM it replaces
+        and no HIRC object was modified, only those byte ranges and their
+        DIDX size fields are rewritten in place through a journal. Otherwise
+        the whole bank is rewritten.
+        Returns the path taken, "patch" or "rewrite", and reloads the bank"""
+        mapped = self.mapped
+        source = self.open_source()
+        if source is None:
+            raise ValueError("The source bank was changed since it was read!")
+        source.close()
+        if not self.wwise_list.modified and self.wem_list.fits_in_place():
+            with profiling.span("patch_bnk", bank=self.bnk_path):
+                patch_file(
+                    self.bnk_path, self.wem_list.get_patch_ranges(little_endian)
+                )
+            path_taken = "patch"
+        else:
+            self.write_bnk(self.bnk_path, little_endian)
+            path_taken = "rewrite"
+        self.read_bnk(self.bnk_path, little_endian, mapped)
+        return path_taken
@@ -0,0 +1,121 @@
+"""cache: Module for the on-disk audio conversion cache"""
+
+import os
+import threading
+from collections import OrderedDict
+from modules.hashing import get_digest
+
+# Eviction frees space down to this fraction of max_bytes, so a full cache
+# does not evict on every store
+LOW_WATERMARK = 0.9
+
+
+class ConversionCache:
+    """Content-addressed on-disk cache of audio conversions
+
+    Entries are keyed by a hash of the source data, the kind of conversion
+    and the converter version, so an unchanged input never runs the
+    converter twice. The least recently used entries are evicted once the
+    cache grows past max_bytes. The directory is only walked once, the size
+    and last use of every entry are then kept in memory"""
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        # key -> size, least recently used first
+        self.entries = OrderedDict(
+            (os.path.basename(path), size)
+            for _, path, size in sorted(self.list_entries())
+        )
+        self.total_bytes = sum(self.entries.values())
+
+    def make_key(self, data: bytes, kind: str, converter_version: str) -> str:
+        """Cache key of a conversion of data"""
+        return get_digest(
+            b"\0".join((converter_version.encode(), kind.encode(), get_digest(data)))
+        ).hex()
+
+    def get_path(self, key: str) -> str:
+        """Path of the cache entry of key"""
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def list_entries(self) -> list:
+        """List (last use, path, size) of all cache entries"""
+        entries = []
+        for dir_path, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".tmp"):
+                    continue
+                path = os.path.join(dir_path, file)
+                try:
+                    entry_stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((entry_stat.st_mtime_ns, path, entry_stat.st_size))
+        return entries
+
+    def get(self, key: str) -> bytes:
+        """Get the cached data of key, or None on a miss"""
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as entry_file:
+                data = entry_file.read()
+            # mtime doubles as last use time for the next runs, atime is
+            # often not updated
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            if key not in self.entries:
+                # Stored by another process sharing the directory
+                self.entries[key] = len(data)
+                self.total_bytes += len(data)
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Store data under key and evict old entries if over the limit"""
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as entry_file:
+            entry_file.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is down to the
+        low watermark, the lock being held"""
+        target = int(self.max_bytes * LOW_WATERMARK)
+        while self.total_bytes > target and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            try:
+                os.remove(self.get_path(key))
+            except OSError:
+                # Already evicted by another process sharing the directory
+                pass
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """Get hit/miss statistics of the cache"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,223 @@
+"""extraction: Module to extract the WEMs of a bank to a directory"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable
+from modules import profiling
+from modules.audioutils import JOBS_PER_WORKER, decode_wem, get_converter_version
+from modules.hashing import get_digest
+from modules.objects import WemList
+
+MANIFEST_NAME = ".bnkwizard-extract.json"
+MANIFEST_VERSION = 2
+# Raw payloads written per job, writing one is too short to be worth a job
+RAW_BATCH_SIZE = 256
+# Seconds between manifest saves while extracting, so a killed extraction
+# only redoes the files of the last few seconds
+MANIFEST_SAVE_INTERVAL = 5.0
+
+
+@dataclass(slots=True)
+class ExtractResult:
+    """Result of extracting one WEM"""
+
+    wem_id: int
+    file: str
+    skipped: bool = False
+    error: str = None
+
+
+def load_manifest(out_dir: str) -> dict:
+    """Read the file -> entry manifest of an extraction directory, empty if
+    there is none or it cannot be read"""
+    try:
+        with open(
+            os.path.join(out_dir, MANIFEST_NAME), "r", encoding="utf-8"
+        ) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(out_dir: str, files: dict):
+    """Atomically write the manifest of an extraction directory"""
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, manifest_file)
+    os.replace(tmp_path, path)
+
+
+def is_up_to_date(out_file: str, entry: dict, digest: str, kind: str) -> bool:
+    """Check if out_file is still the output of a manifest entry for a
+    payload hash and kind of output"""
+    if entry is None or entry.get("hash") != digest or entry.get("kind") != kind:
+        return False
+    try:
+        out_stat = os.stat(out_file)
+    except OSError:
+        return False
+    return (out_stat.st_size, out_stat.st_mtime_ns) == (
+        entry.get("size"),
+        entry.get("mtime_ns"),
+    )
+
+
+def extract_wem(
+    wem_id: int, data, out_file: str, kind: str, entry: dict
+) -> (ExtractResult, dict):
+    """Write one payload to out_file, decoded to wav unless kind is "wem"
+
+    Skipped if the manifest entry shows out_file is already up to date.
+    Returns the result and the new manifest entry"""
+    with profiling.span("extract", wem=wem_id):
+        digest = get_digest(data).hex()
+        if is_up_to_date(out_file, entry, digest, kind):
+            profiling.count("extract_skipped")
+            return ExtractResult(wem_id, out_file, skipped=True), entry
+        if kind != "wem":
+            data = decode_wem(data)
+        # Written under a temporary name, so an interrupted extraction never
+        # leaves a truncated file looking complete
+        tmp_file = f"{out_file}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_file, "wb") as wem_file:
+                wem_file.write(data)
+            os.replace(tmp_file, out_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        profiling.count_io("write", len(data))
+        out_stat = os.stat(out_file)
+        return ExtractResult(wem_id, out_file), {
+            "hash": digest,
+            "kind": kind,
+            "size": out_stat.st_size,
+            "mtime_ns": out_stat.st_mtime_ns,
+        }
+
+
+def extract_batch(jobs: list, kind: str) -> list:
+    """Run a batch of (wem id, payload, file, manifest entry) extraction
+    jobs, capturing their errors. Returns (result, new entry) pairs"""
+    results = []
+    for wem_id, data, out_file, entry in jobs:
+        try:
+            results.append(extract_wem(wem_id, data, out_file, kind, entry))
+        except subprocess.CalledProcessError as err:
+            error = "vgmstream failed: " + str(err)
+            results.append((ExtractResult(wem_id, out_file, error=error), None))
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            results.append((ExtractResult(wem_id, out_file, error=str(err)), None))
+    return results
+
+
+def extract_wems(
+    wem_list: WemList,
+    out_dir: str,
+    wem_ids: list = None,
+    wav: bool = False,
+    max_workers: int = None,
+    progress: Callable[[int, int], None] = None,
+    force: bool = False,
+) -> list:
+    """Extract the original payloads of WEMs to out_dir as ID.wem or ID.wav
+
+    Raw payloads are written straight from the bank buffer in batches of
+    RAW_BATCH_SIZE, wav decoding one WEM per job. Jobs run on a pool of
+    max_workers threads (the number of CPUs by default) with a bounded
+    number of them in flight. A manifest in out_dir records the payload
+    hash of every file written, files which are still up to date are
+    skipped unless force is set, so an interrupted extraction resumes where
+    it stopped. The manifest is saved every MANIFEST_SAVE_INTERVAL seconds
+    and once done. progress is called with the number of WEMs done and the
+    total after every job and may raise to cancel, the jobs already running
+    finish and the manifest is saved before the exception propagates.
+    Returns one ExtractResult per WEM, in order"""
+    os.makedirs(out_dir, exist_ok=True)
+    wem_ids = wem_list.wem_ids if wem_ids is None else wem_ids
+    kind = get_converter_version() if wav else "wem"
+    extension = ".wav" if wav else ".wem"
+    batch_size = 1 if wav else RAW_BATCH_SIZE
+    manifest = {} if force else load_manifest(out_dir)
+    results = {}
+    pending = set()
+    max_workers = max_workers or os.cpu_count()
+    last_save = time.monotonic()
+
+    def collect():
+        nonlocal last_save
+        collect_jobs(pending, results, manifest, progress, wem_ids)
+        if time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+            save_manifest(out_dir, manifest)
+            last_save = time.monotonic()
+
+    with profiling.span("extract_wems", wems=len(wem_ids)):
+        with ThreadPoolExecutor(max_workers) as pool:
+            try:
+                batch = []
+                for wem_id in wem_ids:
+                    file_name = str(wem_id) + extension
+                    out_file = os.path.join(out_dir, file_name)
+                    if wem_id not in wem_list.wem_id_idx_map:
+                        results[wem_id] = ExtractResult(
+                            wem_id, out_file, error="WEM not found in bank"
+                        )
+                        continue
+                    batch.append(
+                        (
+                            wem_id,
+                            wem_list.get_wem(wem_id).data,
+                            out_file,
+                            manifest.get(file_name),
+                        )
+                    )
+                    if len(batch) < batch_size:
+                        continue
+                    while len(pending) >= max_workers * JOBS_PER_WORKER:
+                        collect()
+                    pending.add(pool.submit(extract_batch, batch, kind))
+                    batch = []
+                if batch:
+                    pending.add(pool.submit(extract_batch, batch, kind))
+                while pending:
+                    collect()
+            finally:
+                for future in pending:
+                    future.cancel()
+                # Jobs which were already running still get into the manifest
+                for future in wait(pending).done:
+                    if not future.cancelled():
+                        record_batch(future.result(), results, manifest)
+                save_manifest(out_dir, manifest)
+    return [results[wem_id] for wem_id in wem_ids if wem_id in results]
+
+
+def record_batch(batch_results: list, results: dict, manifest: dict):
+    """Record the results and manifest entries of a finished batch"""
+    for result, entry in batch_results:
+        results[result.wem_id] = result
+        file_name = os.path.basename(result.file)
+        if entry is None:
+            manifest.pop(file_name, None)
+        else:
+            manifest[file_name] = entry
+
+
+def collect_jobs(pending: set, results: dict, manifest: dict, progress, wem_ids: list):
+    """Wait for at least one extraction job and record the finished ones"""
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        record_batch(future.result(), results, manifest)
+    if progress is not None:
+        progress(len(results), len(wem_ids))
@@ -0,0 +1,11 @@
+"""hashing: Module for the content hash of payloads"""
+
+import hashlib
+
+# Digest bytes, enough to tell apart the payloads of any set of banks
+DIGEST_SIZE = 20
+
+
+def get_digest(data) -> bytes:
+    """Content hash of a payload, or of any other buffer"""
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
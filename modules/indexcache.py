@@ -0,0 +1,239 @@
+"""indexcache: Module for the persistent cache of parsed bank indexes"""
+
+import os
+import struct
+import sys
+import threading
+from array import array
+from dataclasses import dataclass, field
+from modules.hashing import get_digest
+from modules.iostream import UINT32_TYPECODE
+
+INDEX_MAGIC = b"BNKI"
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+# magic, version, byte order, little endian bank, bank size, bank mtime,
+# partial hash of the bank
+INDEX_HEADER = struct.Struct("<4sIc?QQ20s")
+ARRAY_HEADER = struct.Struct("<cQ")
+PARTIAL_HASH_SIZE = 1 << 16
+index_cache: "IndexCache" = None
+
+
+@dataclass(slots=True)
+class BankIndex:
+    """Everything read_bnk parses out of a bank, except the payloads"""
+
+    chunks: list = field(default_factory=list)
+    didx_offset: int = None
+    wem_ids: array = field(default_factory=lambda: array(UINT32_TYPECODE))
+    wem_offsets: array = field(default_factory=lambda: array(UINT32_TYPECODE))
+    wem_sizes: array = field(default_factory=lambda: array(UINT32_TYPECODE))
+    hirc_offset: int = None
+    num_wwise: int = 0
+    section_types: array = field(default_factory=lambda: array("B"))
+    wwise_ids: array = field(default_factory=lambda: array(UINT32_TYPECODE))
+    wwise_offsets: array = field(default_factory=lambda: array(UINT32_TYPECODE))
+    wwise_sizes: array = field(default_factory=lambda: array(UINT32_TYPECODE))
+    # Reference graph edges, flattened by flatten_edges, None if the graph
+    # was not built when the index was stored
+    object_wem_edges: tuple = None
+    child_edges: tuple = None
+
+
+def flatten_edges(edges: dict) -> (array, array, array):
+    """Flatten an id -> set of ids dict into owner, count and value columns"""
+    owners = array(UINT32_TYPECODE, edges)
+    counts = array(UINT32_TYPECODE, (len(edges[owner]) for owner in owners))
+    values = array(
+        UINT32_TYPECODE, (value for owner in owners for value in edges[owner])
+    )
+    return owners, counts, values
+
+
+def unflatten_edges(owners: array, counts: array, values: array) -> dict:
+    """Inverse of flatten_edges"""
+    edges = {}
+    pos = 0
+    for owner, count in zip(owners, counts):
+        edges[owner] = set(values[pos : pos + count])
+        pos += count
+    return edges
+
+
+class IndexCache:
+    """Persistent cache of parsed bank indexes
+
+    The DIDX columns, the HIRC object table, the chunk map and the reference
+    graph edges of a bank are stored in one compact binary file. It is
+    either a sidecar next to the bank or, with cache_dir, a file of a shared
+    directory named after the bank's path. Entries are keyed on the bank's
+    size, mtime and a hash of its first and last 64 KiB, and only used if
+    all of them still match"""
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, bnk: str) -> str:
+        """Path of the index file of a bank"""
+        if self.cache_dir is None:
+            return bnk + INDEX_SUFFIX
+        bnk_path = os.path.normcase(os.path.abspath(bnk))
+        name = get_digest(bnk_path.encode()).hex()
+        return os.path.join(self.cache_dir, name + INDEX_SUFFIX)
+
+    def make_key(self, bnk: str) -> (int, int, bytes):
+        """Size, mtime and partial hash identifying the contents of a bank"""
+        with open(bnk, "rb") as bnk_file:
+            bnk_stat = os.fstat(bnk_file.fileno())
+            data = bnk_file.read(PARTIAL_HASH_SIZE)
+            if bnk_stat.st_size > PARTIAL_HASH_SIZE:
+                bnk_file.seek(
+                    max(PARTIAL_HASH_SIZE, bnk_stat.st_size - PARTIAL_HASH_SIZE)
+                )
+                data += bnk_file.read(PARTIAL_HASH_SIZE)
+        return bnk_stat.st_size, bnk_stat.st_mtime_ns, get_digest(data)
+
+    def count(self, hit: bool):
+        """Count a hit or a miss"""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def load(self, bnk: str, little_endian: bool, key: tuple) -> BankIndex:
+        """Get the index of a bank, or None if there is no valid entry"""
+        try:
+            with open(self.get_path(bnk), "rb") as index_file:
+                data = memoryview(index_file.read())
+            index = self.decode(data, little_endian, key)
+        except (OSError, ValueError, struct.error):
+            index = None
+        self.count(index is not None)
+        return index
+
+    def decode(self, data: memoryview, little_endian: bool, key: tuple) -> BankIndex:
+        """Decode an index file, None if it is not for this bank"""
+        magic, version, byteorder, index_le, size, mtime_ns, digest = (
+            INDEX_HEADER.unpack_from(data)
+        )
+        if (
+            magic != INDEX_MAGIC
+            or version != INDEX_VERSION
+            or byteorder != sys.byteorder[0].encode()
+            or index_le != little_endian
+            or (size, mtime_ns, digest) != key
+        ):
+            return None
+        pos = INDEX_HEADER.size
+        columns = []
+        while pos < len(data):
+            typecode, count = ARRAY_HEADER.unpack_from(data, pos)
+            pos += ARRAY_HEADER.size
+            column = array(typecode.decode())
+            end = pos + count * column.itemsize
+            if end > len(data):
+                raise ValueError("Truncated index")
+            column.frombytes(data[pos:end])
+            columns.append(column)
+            pos = end
+        (
+            scalars,
+            chunk_tags,
+            chunk_offsets,
+            chunk_sizes,
+            wem_ids,
+            wem_offsets,
+            wem_sizes,
+            section_types,
+            wwise_ids,
+            wwise_offsets,
+            wwise_sizes,
+            *edges,
+        ) = columns
+        tags = chunk_tags.tobytes()
+        return BankIndex(
+            chunks=[
+                (tags[4 * i : 4 * i + 4].decode(), offset, size)
+                for i, (offset, size) in enumerate(zip(chunk_offsets, chunk_sizes))
+            ],
+            didx_offset=scalars[0] if scalars[3] else None,
+            wem_ids=wem_ids,
+            wem_offsets=wem_offsets,
+            wem_sizes=wem_sizes,
+            hirc_offset=scalars[1] if scalars[4] else None,
+            num_wwise=scalars[2],
+            section_types=section_types,
+            wwise_ids=wwise_ids,
+            wwise_offsets=wwise_offsets,
+            wwise_sizes=wwise_sizes,
+            object_wem_edges=tuple(edges[0:3]) if edges else None,
+            child_edges=tuple(edges[3:6]) if edges else None,
+        )
+
+    def save(self, bnk: str, little_endian: bool, key: tuple, index: BankIndex):
+        """Store the index of a bank, silently giving up if it cannot be
+        written (e.g. read-only game directories)"""
+        columns = [
+            array(
+                "Q",
+                (
+                    index.didx_offset or 0,
+                    index.hirc_offset or 0,
+                    index.num_wwise,
+                    index.didx_offset is not None,
+                    index.hirc_offset is not None,
+                ),
+            ),
+            array("B", "".join(tag for tag, _, _ in index.chunks).encode()),
+            array("Q", (offset for _, offset, _ in index.chunks)),
+            array("Q", (size for _, _, size in index.chunks)),
+            index.wem_ids,
+            index.wem_offsets,
+            index.wem_sizes,
+            index.section_types,
+            index.wwise_ids,
+            index.wwise_offsets,
+            index.wwise_sizes,
+            *(index.object_wem_edges or ()),
+            *(index.child_edges or ()),
+        ]
+        path = self.get_path(bnk)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as index_file:
+                index_file.write(
+                    INDEX_HEADER.pack(
+                        INDEX_MAGIC,
+                        INDEX_VERSION,
+                        sys.byteorder[0].encode(),
+                        little_endian,
+                        *key,
+                    )
+                )
+                for column in columns:
+                    index_file.write(
+                        ARRAY_HEADER.pack(column.typecode.encode(), len(column))
+                    )
+                    index_file.write(column)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_stats(self) -> dict:
+        """Get hit/miss statistics of the cache"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def set_index_cache(cache: IndexCache):
+    """Set the cache used by all bank reads, None to disable it"""
+    global index_cache  # pylint: disable=global-statement
+    index_cache = cache
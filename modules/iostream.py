@@ -1,7 +1,24 @@
 """iostream: Module to input and output data in a formatted manner"""
 
+import mmap
+import os
 import struct
+import sys
+from array import array
+from functools import lru_cache
 from io import BytesIO
+from modules import profiling
+
+COPY_CHUNK_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 16
+# array typecode holding an unsigned 32-bit integer on this platform
+UINT32_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+
+@lru_cache(maxsize=None)
+def get_struct(fmt: str) -> struct.Struct:
+    """Precompiled struct of a format string, shared by all streams"""
+    return struct.Struct(fmt)
 
 
 class Stream:
@@ -15,12 +32,22 @@ class Stream:
                 self.file = open(file, "wb")
         else:
             self.file = BytesIO()
+        # In-memory streams are not I/O, only file streams are profiled.
+        # Decided once here so the per-integer calls skip count_io when
+        # profiling is off, it must be switched on before opening streams
+        self.profiled = file != "" and profiling.profiler is not None
         self.little_endian = little_endian
+        self.uint = self.get_struct("I")
 
     def fmt_str(self, f_str: str):
         """Return the struct format string based on little/big endian"""
         return "<" + f_str if self.little_endian else ">" + f_str
 
+    def get_struct(self, f_str: str) -> struct.Struct:
+        """Return the precompiled struct of a format string in this stream's
+        endianness"""
+        return get_struct(self.fmt_str(f_str))
+
     def get_position(self) -> int:
         """Get current location of the file cursor"""
         return self.file.tell()
@@ -38,53 +65,278 @@ class Stream:
 
 
 class InputStream(Stream):
-    """InputStream Class : For endian-based binary input"""
+    """InputStream Class : For endian-based binary input
 
-    def __init__(self, file: str, little_endian: bool = True) -> None:
+    file is a path or a bytes-like object. Bytes-like objects and
+    memory-mapped files are read through a cursor over the buffer with
+    unpack_from, without any file calls"""
+
+    def __init__(
+        self, file: str, little_endian: bool = True, use_mmap: bool = False
+    ) -> None:
+        self.buffer = None
+        self.view = None
+        self.pos = 0
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            super().__init__("", "rb", little_endian)
+            self.view = memoryview(file)
+            return
         super().__init__(file, "rb", little_endian)
+        if use_mmap and file != "":
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.buffer)
+
+    def is_mapped(self) -> bool:
+        """Check if the file is memory-mapped"""
+        return self.buffer is not None
+
+    def get_view(self, pos: int, size: int) -> memoryview:
+        """Get a zero-copy view of the mapped file"""
+        if self.buffer is None:
+            raise IOError("File is not memory-mapped!")
+        if pos + size > len(self.view):
+            raise IOError("Not enough data to create view of size ", size, "!")
+        if self.profiled:
+            profiling.count_io("map", size)
+        return self.view[pos : pos + size]
+
+    def get_size(self) -> int:
+        """Get the size of the whole input"""
+        if self.view is not None:
+            return len(self.view)
+        if isinstance(self.file, BytesIO):
+            return self.file.getbuffer().nbytes
+        return os.fstat(self.file.fileno()).st_size
+
+    def get_position(self) -> int:
+        """Get current location of the file cursor"""
+        if self.view is not None:
+            return self.pos
+        return self.file.tell()
+
+    def set_position(self, pos: int) -> None:
+        """Get file cursor location"""
+        if self.view is not None:
+            self.pos = pos
+        else:
+            self.file.seek(pos)
+
+    def close(self) -> None:
+        """Close the file and release the mapping if no views are alive"""
+        if getattr(self, "view", None) is not None:
+            # Views handed out by get_view stay valid
+            self.view.release()
+            self.view = None
+        if getattr(self, "buffer", None) is not None:
+            try:
+                self.buffer.close()
+            except BufferError:
+                # Views handed out are still alive, the mapping is released
+                # once the last of them is garbage collected
+                pass
+            self.buffer = None
+        super().close()
+
+    def read_view(self, size: int) -> memoryview:
+        """Advance the cursor by size bytes, returning a view of them"""
+        pos = self.pos
+        data = self.view[pos : pos + size]
+        self.pos = pos + len(data)
+        if self.profiled:
+            profiling.count_io("read", len(data))
+        return data
 
     def read_bytes(self, size: int) -> bytes:
         """Read data from file as binary"""
+        if self.view is not None:
+            return bytes(self.read_view(size))
         data = self.file.read(size)
+        if self.profiled:
+            profiling.count_io("read", len(data))
         return data
 
     def read_str(self, size: int) -> str:
         """Read data from file as string"""
-        data = self.file.read(size)
+        data = self.read_bytes(size)
         if len(data) == 0:
             return None
         if len(data) < size:
             raise IOError("Not enough data to read string of size ", size, "!")
-        data: bytes = struct.unpack(self.fmt_str(str(size) + "s"), data)[0]
         return data.decode()
 
     def read_int(self) -> int:
         """Read data from file as integer"""
-        data = self.file.read(4)
+        if self.view is not None:
+            pos = self.pos
+            if pos + 4 <= len(self.view):
+                self.pos = pos + 4
+                if self.profiled:
+                    profiling.count_io("read", 4)
+                return self.uint.unpack_from(self.view, pos)[0]
+            data = self.read_view(4)
+        else:
+            data = self.read_bytes(4)
+            if len(data) == 4:
+                return self.uint.unpack(data)[0]
         if len(data) == 0:
             return None
-        if len(data) < 4:
-            raise IOError("Not enough data to read integer!")
-        data: int = struct.unpack(self.fmt_str("I"), data)[0]
-        return data
+        raise IOError("Not enough data to read integer!")
+
+    def read_ints(self, count: int) -> array:
+        """Read count integers from file in one go as an unsigned int array"""
+        if self.view is not None:
+            data = self.read_view(4 * count)
+        else:
+            data = self.read_bytes(4 * count)
+        if len(data) < 4 * count:
+            raise IOError("Not enough data to read ", count, " integers!")
+        ints = array(UINT32_TYPECODE)
+        ints.frombytes(data)
+        if self.little_endian != (sys.byteorder == "little"):
+            ints.byteswap()
+        return ints
 
 
 class OutputStream(Stream):
-    """OutputStream Class : For endian-based binary output"""
+    """OutputStream Class : For endian-based binary output
+
+    Small writes are packed into a bytearray with pack_into and reach the
+    file in WRITE_BUFFER_SIZE blocks, large ones are written directly"""
 
     def __init__(self, file: str, little_endian: bool = True) -> None:
         super().__init__(file, "wb", little_endian)
+        self.buffer = bytearray(WRITE_BUFFER_SIZE)
+        self.used = 0
+
+    def flush(self) -> None:
+        """Write the buffered data to the file"""
+        if self.used:
+            with memoryview(self.buffer) as buffer:
+                self.file.write(buffer[: self.used])
+            self.used = 0
+
+    def reserve(self, size: int) -> int:
+        """Reserve size bytes of the write buffer, returning their offset"""
+        if self.used + size > len(self.buffer):
+            self.flush()
+        pos = self.used
+        self.used = pos + size
+        if self.profiled:
+            profiling.count_io("write", size)
+        return pos
+
+    def get_position(self) -> int:
+        """Get current location of the file cursor"""
+        return self.file.tell() + self.used
+
+    def set_position(self, pos: int) -> None:
+        """Get file cursor location"""
+        self.flush()
+        self.file.seek(pos)
+
+    def close(self) -> None:
+        """Write the buffered data and close the file"""
+        if getattr(self, "used", 0) and not self.file.closed:
+            self.flush()
+        super().close()
+
+    def sync(self) -> None:
+        """Write the buffered data and sync the file to disk"""
+        self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def abort(self) -> None:
+        """Close the file dropping the buffered data, after a failed write"""
+        self.used = 0
+        try:
+            self.file.close()
+        except OSError:
+            # The file object could not flush its own buffer either, it is
+            # closed anyway
+            pass
 
     def write_bytes(self, data: bytes) -> int:
         """Write binary data to file"""
-        return self.file.write(data)
+        size = len(data)
+        if size > len(self.buffer) // 2:
+            self.flush()
+            if self.profiled:
+                profiling.count_io("write", size)
+            return self.file.write(data)
+        pos = self.reserve(size)
+        self.buffer[pos : pos + size] = data
+        return size
 
     def write_str(self, data: str) -> int:
         """Write string data to file"""
-        data = struct.pack(self.fmt_str(str(len(data)) + "s"), data.encode())
-        return self.file.write(data)
+        return self.write_bytes(data.encode())
 
     def write_int(self, data: int) -> bool:
         """Write integer data to file"""
-        data = struct.pack(self.fmt_str("I"), data)
-        return self.file.write(data)
+        # reserve inlined, this is the innermost call of the section writers
+        pos = self.used
+        if pos + 4 > WRITE_BUFFER_SIZE:
+            self.flush()
+            pos = 0
+        self.used = pos + 4
+        self.uint.pack_into(self.buffer, pos, data)
+        if self.profiled:
+            profiling.count_io("write", 4)
+        return 4
+
+    def write_ints(self, data) -> int:
+        """Write a sequence of integers to file in one go"""
+        ints = array(UINT32_TYPECODE, data)
+        if self.little_endian != (sys.byteorder == "little"):
+            ints.byteswap()
+        return self.write_bytes(memoryview(ints).cast("B"))
+
+    def write_zeros(self, size: int) -> int:
+        """Write zero padding to file"""
+        if size <= len(self.buffer) // 2:
+            pos = self.reserve(size)
+            self.buffer[pos : pos + size] = bytes(size)
+            return size
+        written = 0
+        while written < size:
+            written += self.write_bytes(bytes(min(COPY_CHUNK_SIZE, size - written)))
+        return written
+
+    def copy_from(self, src, pos: int, size: int) -> int:
+        """Copy a byte range of another binary file into this file
+
+        Uses os.copy_file_range/os.sendfile so the data does not pass through
+        Python buffers where possible, otherwise falls back to chunked copies"""
+        self.flush()
+        self.file.flush()
+        dst_pos = self.file.tell()
+        copied = 0
+        try:
+            src_fd, dst_fd = src.fileno(), self.file.fileno()
+            while copied < size:
+                if hasattr(os, "copy_file_range"):
+                    count = os.copy_file_range(
+                        src_fd, dst_fd, size - copied, pos + copied, dst_pos + copied
+                    )
+                else:
+                    os.lseek(dst_fd, dst_pos + copied, os.SEEK_SET)
+                    count = os.sendfile(dst_fd, src_fd, pos + copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except (OSError, AttributeError):
+            # No fd (BytesIO), cross-device copies or sendfile only supporting
+            # sockets: continue with the generic path from where we stopped
+            pass
+        while copied < size:
+            src.seek(pos + copied)
+            chunk = src.read(min(COPY_CHUNK_SIZE, size - copied))
+            if len(chunk) == 0:
+                raise IOError("Not enough data to copy range of size ", size, "!")
+            self.file.seek(dst_pos + copied)
+            copied += self.file.write(chunk)
+        self.file.seek(dst_pos + size)
+        if self.profiled:
+            profiling.count_io("copy", size)
+        return size
@@ -0,0 +1,197 @@
+"""journal: Module to patch files in place without risking corruption"""
+
+import os
+import struct
+import zlib
+from modules.hashing import DIGEST_SIZE, get_digest
+from modules.iostream import COPY_CHUNK_SIZE
+
+JOURNAL_MAGIC = b"BNKJ"
+JOURNAL_VERSION = 2
+JOURNAL_TRAILER = b"DONE"
+# magic, version, size of the patched file
+JOURNAL_HEADER = struct.Struct("<4sIQ")
+# offset and size of a range, followed by the digests of its new bytes and
+# by its original bytes
+RANGE_HEADER = struct.Struct("<QQ")
+# trailer, number of ranges and CRC-32 of everything before the trailer
+TRAILER = struct.Struct("<4sII")
+# Ranges are checked in blocks aligned on disk sectors, as a crash may leave
+# some sectors of a range written and others not
+BLOCK_SIZE = 512
+
+
+def get_journal_path(file: str) -> str:
+    """Path of the undo journal kept next to a file"""
+    return file + ".journal"
+
+
+def iter_blocks(offset: int, size: int):
+    """Iterate over the (start, end) of the BLOCK_SIZE-aligned blocks of a
+    range, relative to its start"""
+    start = 0
+    while start < size:
+        block_end = ((offset + start) // BLOCK_SIZE + 1) * BLOCK_SIZE
+        end = min(size, block_end - offset)
+        yield start, end
+        start = end
+
+
+class JournalWriter:
+    """Writes a journal, keeping the CRC of what was written"""
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.crc = 0
+
+    def write(self, data: bytes):
+        """Write bytes to the journal"""
+        self.journal_file.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+
+    def write_range(self, patched_file, offset: int, data: memoryview):
+        """Journal a range, streaming its original bytes from the file"""
+        self.write(RANGE_HEADER.pack(offset, len(data)))
+        self.write(
+            b"".join(
+                get_digest(data[start:end])
+                for start, end in iter_blocks(offset, len(data))
+            )
+        )
+        patched_file.seek(offset)
+        copied = 0
+        while copied < len(data):
+            chunk = patched_file.read(min(COPY_CHUNK_SIZE, len(data) - copied))
+            if not chunk:
+                raise IOError("Patch range is past the end of the file!")
+            self.write(chunk)
+            copied += len(chunk)
+
+
+def check_journal(journal_file) -> (int, int):
+    """Get the patched file size and range count of a journal, None if the
+    journal was not completely written"""
+    journal_size = journal_file.seek(0, os.SEEK_END)
+    if journal_size < JOURNAL_HEADER.size + TRAILER.size:
+        return None
+    journal_file.seek(journal_size - TRAILER.size)
+    trailer, count, crc = TRAILER.unpack(journal_file.read(TRAILER.size))
+    journal_file.seek(0)
+    magic, version, file_size = JOURNAL_HEADER.unpack(
+        journal_file.read(JOURNAL_HEADER.size)
+    )
+    if (
+        trailer != JOURNAL_TRAILER
+        or magic != JOURNAL_MAGIC
+        or version != JOURNAL_VERSION
+    ):
+        return None
+    actual_crc = 0
+    journal_file.seek(0)
+    remaining = journal_size - TRAILER.size
+    while remaining:
+        chunk = journal_file.read(min(COPY_CHUNK_SIZE, remaining))
+        actual_crc = zlib.crc32(chunk, actual_crc)
+        remaining -= len(chunk)
+    if actual_crc != crc:
+        return None
+    return file_size, count
+
+
+def iter_ranges(journal_file, count: int):
+    """Iterate over the (offset, size, new block digests, position of the
+    original bytes) ranges of a valid journal"""
+    pos = JOURNAL_HEADER.size
+    for _ in range(count):
+        journal_file.seek(pos)
+        offset, size = RANGE_HEADER.unpack(journal_file.read(RANGE_HEADER.size))
+        block_count = sum(1 for _ in iter_blocks(offset, size))
+        digests = journal_file.read(block_count * DIGEST_SIZE)
+        old_pos = pos + RANGE_HEADER.size + len(digests)
+        yield offset, size, digests, old_pos
+        pos = old_pos + size
+
+
+def matches_journal(patched_file, journal_file, count: int) -> bool:
+    """Check every block of the journaled ranges of a file holds either its
+    original bytes or its patched bytes, so the journal is for this file"""
+    for offset, size, digests, old_pos in iter_ranges(journal_file, count):
+        for block, (start, end) in enumerate(iter_blocks(offset, size)):
+            patched_file.seek(offset + start)
+            current = patched_file.read(end - start)
+            journal_file.seek(old_pos + start)
+            if current == journal_file.read(end - start):
+                continue
+            digest = digests[block * DIGEST_SIZE : (block + 1) * DIGEST_SIZE]
+            if get_digest(current) != digest:
+                return False
+    return True
+
+
+def roll_back(patched_file, journal_file, count: int):
+    """Write the original bytes of the journaled ranges back to a file"""
+    for offset, size, _, old_pos in iter_ranges(journal_file, count):
+        journal_file.seek(old_pos)
+        patched_file.seek(offset)
+        copied = 0
+        while copied < size:
+            chunk = journal_file.read(min(COPY_CHUNK_SIZE, size - copied))
+            patched_file.write(chunk)
+            copied += len(chunk)
+    patched_file.flush()
+    os.fsync(patched_file.fileno())
+
+
+def recover_journal(file: str) -> bool:
+    """Roll back an interrupted patch of file, if its journal exists
+
+    A journal which was not completely written means the file itself was
+    never touched, so it is simply discarded. So is a journal whose ranges
+    hold neither the original nor the patched bytes in file, or which was
+    written for a file of another size, as it belongs to another file which
+    was at that path"""
+    journal_path = get_journal_path(file)
+    if not os.path.exists(journal_path):
+        return False
+    recovered = False
+    with open(journal_path, "rb") as journal_file:
+        journal = check_journal(journal_file)
+        if journal is not None and os.path.exists(file):
+            file_size, count = journal
+            with open(file, "r+b") as patched_file:
+                size = os.fstat(patched_file.fileno()).st_size
+                if size == file_size and matches_journal(
+                    patched_file, journal_file, count
+                ):
+                    roll_back(patched_file, journal_file, count)
+                    recovered = True
+    os.remove(journal_path)
+    return recovered
+
+
+def patch_file(file: str, patches: list):
+    """Overwrite (offset, data) ranges of file in place
+
+    The original bytes of every range are streamed to a journal, with
+    digests of the new ones, and synced to disk before the file is modified,
+    so a crash at any point can be rolled back with recover_journal. patches
+    is iterated twice, data may be any buffer"""
+    journal_path = get_journal_path(file)
+    with open(file, "r+b") as patched_file:
+        file_size = os.fstat(patched_file.fileno()).st_size
+        count = 0
+        with open(journal_path, "wb") as journal_file:
+            writer = JournalWriter(journal_file)
+            writer.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, file_size))
+            for offset, data in patches:
+                writer.write_range(patched_file, offset, memoryview(data))
+                count += 1
+            journal_file.write(TRAILER.pack(JOURNAL_TRAILER, count, writer.crc))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        for offset, data in patches:
+            patched_file.seek(offset)
+            patched_file.write(data)
+        patched_file.flush()
+        os.fsync(patched_file.fileno())
+    os.remove(journal_path)
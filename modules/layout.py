@@ -0,0 +1,112 @@
+"""layout: Module to keep the layout of the DATA section up to date"""
+
+from array import array
+from modules.iostream import UINT32_TYPECODE
+
+ALIGNMENT = 16
+
+
+def align(value: int, alignment: int = ALIGNMENT) -> int:
+    """Round value up to the next multiple of alignment"""
+    return ((value // alignment) + ((value % alignment) != 0)) * alignment
+
+
+class FenwickTree:
+    """Binary indexed tree over integer deltas"""
+
+    def __init__(self, size: int):
+        self.tree = [0] * (size + 1)
+
+    def add(self, idx: int, delta: int):
+        """Add delta at position idx"""
+        idx += 1
+        while idx < len(self.tree):
+            self.tree[idx] += delta
+            idx += idx & -idx
+
+    def prefix_sum(self, idx: int) -> int:
+        """Sum of all deltas before position idx"""
+        total = 0
+        while idx > 0:
+            total += self.tree[idx]
+            idx -= idx & -idx
+        return total
+
+
+class WemLayout:
+    """Incremental layout of the WEMs in the DATA section
+
+    Every WEM owns a slot which runs up to the next WEM's offset, padding
+    included. Unchanged WEMs keep their original slot, a replaced WEM gets
+    a slot of its new size rounded up to the 16-byte alignment. The final
+    offset of a WEM is its original offset plus the slot deltas of all WEMs
+    before it, which are kept in a Fenwick tree so replacements update the
+    layout in O(log n)"""
+
+    def __init__(self, offsets: array, sizes: array, data_size: int):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.slots = array(
+            "q",
+            (offsets[i + 1] - offsets[i] for i in range(len(offsets) - 1)),
+        )
+        if len(offsets):
+            self.slots.append(data_size - offsets[-1])
+        self.new_sizes = {}
+        self.deltas = {}
+        self.tree = FenwickTree(len(offsets))
+
+    def set_size(self, idx: int, size: int):
+        """Change the size of the WEM at idx"""
+        delta = align(size) - self.slots[idx]
+        self.tree.add(idx, delta - self.deltas.get(idx, 0))
+        self.new_sizes[idx] = size
+        self.deltas[idx] = delta
+
+    def reset_size(self, idx: int):
+        """Restore the original size of the WEM at idx"""
+        self.tree.add(idx, -self.deltas.pop(idx, 0))
+        self.new_sizes.pop(idx, None)
+
+    def get_offset(self, idx: int) -> int:
+        """Final offset of the WEM at idx"""
+        return self.offsets[idx] + self.tree.prefix_sum(idx)
+
+    def get_size(self, idx: int) -> int:
+        """Final size of the WEM at idx"""
+        return self.new_sizes.get(idx, self.sizes[idx])
+
+    def get_data_size(self) -> int:
+        """Final length of the DATA section"""
+        last = len(self.offsets) - 1
+        return self.get_offset(last) + self.get_size(last)
+
+    def get_final_columns(self) -> (array, array):
+        """Final offset and size columns for the DIDX section"""
+        offsets = array(UINT32_TYPECODE, self.offsets)
+        sizes = array(UINT32_TYPECODE, self.sizes)
+        shift, start = 0, 0
+        for idx in sorted(self.deltas):
+            if shift:
+                offsets[start : idx + 1] = array(
+                    UINT32_TYPECODE, (x + shift for x in offsets[start : idx + 1])
+                )
+            sizes[idx] = self.new_sizes[idx]
+            shift += self.deltas[idx]
+            start = idx + 1
+        if shift:
+            offsets[start:] = array(
+                UINT32_TYPECODE, (x + shift for x in offsets[start:])
+            )
+        return offsets, sizes
+
+    def recompute(self) -> (array, array):
+        """Full recompute of the final columns, walking every slot in order"""
+        offsets = array(UINT32_TYPECODE)
+        sizes = array(UINT32_TYPECODE)
+        offset = self.offsets[0] if len(self.offsets) else 0
+        for idx, slot in enumerate(self.slots):
+            offsets.append(offset)
+            sizes.append(self.get_size(idx))
+            offset += align(self.new_sizes[idx]) if idx in self.new_sizes else slot
+        return offsets, sizes
@@ -1,38 +1,58 @@
 """wem module"""
+import operator
+import struct
 from dataclasses import dataclass
-from io import BytesIO
-from modules.iostream import InputStream, OutputStream
-from modules.audioutils import get_data_as_wem
+from itertools import islice
+from array import array
+from modules import blobstore
+from modules.blobstore import BlobStore
+from modules.indexcache import BankIndex
+from modules.iostream import UINT32_TYPECODE, InputStream, OutputStream
+from modules.audioutils import get_data_as_wem, iter_batch_as_wem
+from modules.layout import WemLayout
 
 
-@dataclass
+@dataclass(slots=True)
 class Wem:
-    """WEM Class"""
+    """WEM Class : Lightweight view of one WEM entry, created on demand"""
 
-    wem_id: int
-    offset: int
-    size: int
-    data: bytes
-
-    def __init__(self):
-        pass
+    wem_id: int = None
+    offset: int = None
+    size: int = None
+    data: bytes = None
 
 
 class WemList:
-    """Class to store WEM Data"""
+    """Class to store WEM Data
+
+    The DIDX entries are kept as id/offset/size columns, original payloads as
+    slices of the DATA section buffer and replacements in a sparse dict,
+    their payloads in a BlobStore bounded to the spill budget"""
 
     def __init__(self):
-        self.wem_count = None
-        self.orig_wems = []
-        self.repl_wems = []
-        self.final_wems = []
-        self.wem_ids = []
-        self.rep_wem_ids = set()
+        self.wem_count = 0
+        self.wem_ids = array(UINT32_TYPECODE)
+        self.offsets = array(UINT32_TYPECODE)
+        self.sizes = array(UINT32_TYPECODE)
+        self.final_offsets = array(UINT32_TYPECODE)
+        self.final_sizes = array(UINT32_TYPECODE)
+        self.repl_wems = {}
+        self.repl_store = BlobStore(blobstore.spill_budget, blobstore.spill_dir)
         self.wem_id_idx_map = {}
         self.abs_offset = None
+        self.didx_offset = None
+        self.data_buffer = None
+        self.payload_views = None
+        self.layout = None
+
+    @property
+    def rep_wem_ids(self):
+        """Ids of the WEMs which have a replacement"""
+        return self.repl_wems.keys()
 
-    def get_wem_metadata_from_bnk(self, inp: InputStream):
-        """Read DIDX (Data Index) section into array"""
+    def get_wem_metadata_from_bnk(self, inp: InputStream, index: BankIndex = None):
+        """Read DIDX (Data Index) section into array, taking the columns from
+        a cached index if one is given"""
         didx_size = inp.read_int()
         if didx_size % 12 != 0:
             raise ValueError(
@@ -41,106 +61,251 @@ class WemList:
                 ", which is not divisible by 12)",
             )
         self.wem_count = didx_size // 12
-        self.orig_wems = [Wem() for _ in range(self.wem_count)]
-        self.repl_wems = [Wem() for _ in range(self.wem_count)]
-        self.final_wems = [Wem() for _ in range(self.wem_count)]
-        for i in range(self.wem_count):
-            (
-                self.orig_wems[i].wem_id,
-                self.orig_wems[i].offset,
-                self.orig_wems[i].size,
-            ) = [inp.read_int() for i in range(3)]
-            self.wem_id_idx_map[self.orig_wems[i].wem_id] = i
-            if i > 0 and self.orig_wems[i].offset < self.orig_wems[i - 1].offset:
-                raise ValueError(
-                    "The file has a corrupted DIDX section! (WEM number "
-                    + i
-                    + " is located at offset "
-                    + self.orig_wems[i].offset
-                    + ", while WEM number "
-                    + (i - 1)
-                    + " is located at offset "
-                    + self.orig_wems[i - 1].offset
-                    + ")"
-                )
-            self.wem_ids.append(self.orig_wems[i].wem_id)
+        # Whole section decoded in one read into id/offset/size columns
+        self.didx_offset = inp.get_position()
+        if index is not None:
+            inp.set_position(self.didx_offset + didx_size)
+            self.wem_ids = index.wem_ids
+            self.offsets = index.wem_offsets
+            self.sizes = index.wem_sizes
+            self.wem_id_idx_map = dict(zip(self.wem_ids, range(self.wem_count)))
+            return
+        didx = inp.read_ints(3 * self.wem_count)
+        ids, offsets, sizes = didx[0::3], didx[1::3], didx[2::3]
+        if not all(map(operator.le, offsets, islice(offsets, 1, None))):
+            i = next(
+                i for i in range(1, self.wem_count) if offsets[i] < offsets[i - 1]
+            )
+            raise ValueError(
+                "The file has a corrupted DIDX section! (WEM number "
+                + str(i)
+                + " is located at offset "
+                + str(offsets[i])
+                + ", while WEM number "
+                + str(i - 1)
+                + " is located at offset "
+                + str(offsets[i - 1])
+                + ")"
+            )
+        self.wem_ids, self.offsets, self.sizes = ids, offsets, sizes
+        self.wem_id_idx_map = dict(zip(ids, range(self.wem_count)))
 
     def get_wem_data_from_bnk(self, inp: InputStream):
         """Read DATA (Data) section into array"""
         data_size = inp.read_int()
-        if data_size != self.orig_wems[-1].size + self.orig_wems[-1].offset:
+        expected_size = self.sizes[-1] + self.offsets[-1] if self.wem_count else 0
+        if data_size != expected_size:
             raise ValueError(
                 "The file has a corrupted DATA section! (calculated length: ",
-                sum(self.orig_wems[-1].size + self.orig_wems[-1].offset),
+                expected_size,
                 ", actual length: ",
                 data_size,
                 ")",
             )
+        self.layout = WemLayout(self.offsets, self.sizes, data_size)
         self.abs_offset = inp.get_position()
-        for i in range(self.wem_count):
-            inp.set_position(self.abs_offset + self.orig_wems[i].offset)
-            self.orig_wems[i].data = inp.read_bytes(self.orig_wems[i].size)
+        if inp.is_mapped():
+            # Zero-copy view of the mapped bank, pages are only faulted in
+            # once a payload is actually played, exported or written
+            self.data_buffer = inp.get_view(self.abs_offset, data_size)
+            inp.set_position(self.abs_offset + data_size)
+        else:
+            self.data_buffer = memoryview(inp.read_bytes(data_size))
 
     def get_wem(self, wem_id: int, repl: bool = False) -> Wem:
         """Get WEM data given id"""
         idx = self.wem_id_idx_map[wem_id]
-        if repl and wem_id in self.rep_wem_ids:
-            return self.repl_wems[idx]
-        return self.orig_wems[idx]
+        if repl and wem_id in self.repl_wems:
+            return Wem(
+                wem_id,
+                self.layout.get_offset(idx),
+                self.repl_wems[wem_id].size,
+                self.repl_store.get(wem_id),
+            )
+        return Wem(wem_id, self.offsets[idx], self.sizes[idx], self.get_payload(idx))
+
+    def get_payload(self, idx: int) -> memoryview:
+        """Get the original payload of the WEM at idx"""
+        if self.payload_views is not None:
+            return self.payload_views[idx]
+        offset = self.offsets[idx]
+        return self.data_buffer[offset : offset + self.sizes[idx]]
+
+    def set_payload_views(self, payload_views: list):
+        """Serve original payloads from the given views instead of the DATA
+        section buffer, which is released"""
+        self.payload_views = payload_views
+        self.data_buffer = None
+
+    def detach(self):
+        """Replace the views of the mapped bank, original and replacement
+        payloads, by copies so the mapping can be closed"""
+        if self.data_buffer is not None:
+            self.data_buffer = memoryview(bytes(self.data_buffer))
+        if self.payload_views is not None:
+            self.payload_views = [
+                memoryview(bytes(view)) for view in self.payload_views
+            ]
+        self.repl_store.detach()
 
     def make_replacement(self, wem_id: int, new_wem: str):
         """Add replacement WEM"""
         wem_data = get_data_as_wem(new_wem)
+        if not wem_data:
+            raise ValueError(f"Could not convert {new_wem} to wem!")
+        self.set_replacement_data(wem_id, wem_data)
+
+    def make_replacements(self, replacements: dict, max_workers: int = None) -> dict:
+        """Add many replacement WEMs given a wem_id -> file dict
+
+        The files are converted concurrently and each one is stored as soon
+        as it is done, so only a few converted payloads are held at once.
+        Returns a wem_id -> error message dict of the replacements which
+        failed"""
+        errors = {}
+        wem_ids = []
+        for wem_id in replacements:
+            if wem_id in self.wem_id_idx_map:
+                wem_ids.append(wem_id)
+            else:
+                errors[wem_id] = "WEM not found in bank"
+        results = iter_batch_as_wem(
+            [replacements[wem_id] for wem_id in wem_ids], max_workers
+        )
+        for wem_id, result in zip(wem_ids, results):
+            if result.error is not None:
+                errors[wem_id] = result.error
+            elif not result.data:
+                errors[wem_id] = "Converted WEM is empty"
+            else:
+                self.set_replacement_data(wem_id, result.data)
+        return errors
+
+    def set_replacement_data(self, wem_id: int, wem_data: bytes):
+        """Add replacement WEM given its data"""
         idx: int = self.wem_id_idx_map[wem_id]
-        self.repl_wems[idx].data = wem_data
-        self.repl_wems[idx].offset = self.orig_wems[idx].offset
-        self.repl_wems[idx].size = len(wem_data)
-        self.rep_wem_ids.add(wem_id)
+        self.layout.set_size(idx, len(wem_data))
+        self.repl_store.put(wem_id, wem_data)
+        self.repl_wems[wem_id] = Wem(wem_id, self.layout.get_offset(idx), len(wem_data))
+
+    def get_replacement_data(self, wem_id: int) -> memoryview:
+        """Get the payload of a replacement WEM"""
+        return self.repl_store.get(wem_id)
 
     def remove_replacement(self, wem_id: int):
         """Remove replacement WEM"""
-        self.rep_wem_ids.remove(wem_id)
+        del self.repl_wems[wem_id]
+        self.repl_store.remove(wem_id)
+        self.layout.reset_size(self.wem_id_idx_map[wem_id])
+
+    def fits_in_place(self) -> bool:
+        """Check if every replacement fits the slot of the WEM it replaces"""
+        last = self.wem_count - 1
+        for wem_id, repl_wem in self.repl_wems.items():
+            idx: int = self.wem_id_idx_map[wem_id]
+            slot = self.layout.slots[idx]
+            # The last WEM defines the DATA length, so it cannot shrink
+            if repl_wem.size > slot or (idx == last and repl_wem.size != slot):
+                return False
+        return True
+
+    def get_patch_ranges(self, little_endian: bool = True) -> list:
+        """Get (absolute offset, data) ranges patching replacements in place
+
+        The payloads are views of the replacement store, not copies, so
+        spilled replacements are read straight from the scratch file. The
+        rest of each slot is zeroed by a separate padding range"""
+        size_fmt = "<I" if little_endian else ">I"
+        patches = []
+        for wem_id, repl_wem in sorted(self.repl_wems.items()):
+            idx: int = self.wem_id_idx_map[wem_id]
+            offset = self.abs_offset + self.offsets[idx]
+            patches.append((offset, self.get_replacement_data(wem_id)))
+            padding = self.layout.slots[idx] - repl_wem.size
+            if padding:
+                patches.append((offset + repl_wem.size, bytes(padding)))
+            patches.append(
+                (
+                    self.didx_offset + 12 * idx + 8,
+                    struct.pack(size_fmt, repl_wem.size),
+                )
+            )
+        return patches
 
     def create_final_wem_data(self):
         """Fill final data with replaced wems"""
-        diff = 0
-        for wem_id in self.wem_ids:
-            idx: int = self.wem_id_idx_map[wem_id]
-            if wem_id in self.rep_wem_ids:
-                data = self.repl_wems[idx].data
-                offset = self.repl_wems[idx].offset + diff
-                size = self.repl_wems[idx].size
-                diff = self.repl_wems[idx].size - self.orig_wems[idx].size
-            else:
-                data = self.orig_wems[idx].data
-                offset = self.orig_wems[idx].offset + diff
-                size = self.orig_wems[idx].size
-            offset = ((offset // 16) + ((offset % 16) != 0)) * 16
-            self.final_wems[idx].wem_id = wem_id
-            self.final_wems[idx].data = data
-            self.final_wems[idx].offset = offset
-            self.final_wems[idx].size = size
+        if self.layout is None:
+            # Bank without a DATA section
+            return
+        self.final_offsets, self.final_sizes = self.layout.get_final_columns()
 
     def clear_final_wem_data(self):
         """Clear final data after writing data"""
-        self.final_wems = [Wem() for _ in range(self.wem_count)]
+        self.final_offsets = array(UINT32_TYPECODE)
+        self.final_sizes = array(UINT32_TYPECODE)
 
     def write_wem_metadata_to_bnk(self, out: OutputStream):
         """Write DIDX (Data Index) section into file"""
         out.write_int(self.wem_count * 12)
-        for wem_id in self.wem_ids:
-            idx: int = self.wem_id_idx_map[wem_id]
-            out.write_int(self.final_wems[idx].wem_id)
-            out.write_int(self.final_wems[idx].offset)
-            out.write_int(self.final_wems[idx].size)
-
-    def write_wem_data_to_bnk(self, out: OutputStream):
-        """Write DATA (Data) section into file"""
-        out.write_int(self.final_wems[-1].offset + self.final_wems[-1].size)
-        for wem_id in self.wem_ids:
-            idx: int = self.wem_id_idx_map[wem_id]
-            out.set_position(self.abs_offset + self.final_wems[idx].offset)
-            out.write_bytes(self.final_wems[idx].data)
+        didx = array(UINT32_TYPECODE, bytes(12 * self.wem_count))
+        didx[0::3], didx[1::3], didx[2::3] = (
+            self.wem_ids,
+            self.final_offsets,
+            self.final_sizes,
+        )
+        out.write_ints(didx)
+
+    def write_wem_data_to_bnk(self, out: OutputStream, source=None):
+        """Write DATA (Data) section into file
+
+        The section is streamed in order with the alignment padding emitted
+        inline. If the source bank is given as an open binary file, runs of
+        unchanged WEMs are copied straight from it, so only replaced payloads
+        pass through Python buffers"""
+        data_size = (
+            self.final_offsets[-1] + self.final_sizes[-1] if self.wem_count else 0
+        )
+        out.write_int(data_size)
+        pos = 0
+        run_src, run_dst, run_size = 0, 0, 0
+        for idx, wem_id in enumerate(self.wem_ids):
+            final_offset = self.final_offsets[idx]
+            final_size = self.final_sizes[idx]
+            if wem_id not in self.repl_wems and (
+                source is not None or self.data_buffer is not None
+            ):
+                src_pos = self.offsets[idx]
+                if run_size and src_pos - run_src == final_offset - run_dst:
+                    # Still contiguous with the pending run, padding included
+                    run_size = final_offset + final_size - run_dst
+                    continue
+                pos = self._flush_copy_run(
+                    out, source, pos, run_src, run_dst, run_size
+                )
+                run_src, run_dst, run_size = src_pos, final_offset, final_size
+                continue
+            pos = self._flush_copy_run(out, source, pos, run_src, run_dst, run_size)
+            run_size = 0
+            out.write_zeros(final_offset - pos)
+            if wem_id in self.repl_wems:
+                self.repl_store.write_to(wem_id, out)
+            else:
+                out.write_bytes(self.get_payload(idx))
+            pos = final_offset + final_size
+        self._flush_copy_run(out, source, pos, run_src, run_dst, run_size)
+
+    def _flush_copy_run(
+        self, out: OutputStream, source, pos: int, src: int, dst: int, size: int
+    ) -> int:
+        """Copy a pending run of unchanged WEMs, from the source bank if given"""
+        if size == 0:
+            return pos
+        out.write_zeros(dst - pos)
+        if source is not None:
+            out.copy_from(source, self.abs_offset + src, size)
+        else:
+            out.write_bytes(self.data_buffer[src : src + size])
+        return dst + size
 
 
 class Wwise:
@@ -168,68 +333,179 @@ class Wwise:
         19: "Unknown Section",
         20: "Auxilary Bus",
     }
+    fetch_type_names: {} = {0: "Embedded", 1: "Streamed", 2: "Prefetched"}
+    metadata_section_types = {2}
     section_type: int
     size: int
     wwise_id: int
     data: bytes
 
     def __init__(self):
-        pass
+        self.metadata = None
 
     def get_name(self):
         """Get name of the section type"""
         return self.section_type_name_dict[self.section_type]
 
+    def has_metadata(self) -> bool:
+        """Check if get_metadata can decode anything for this section type"""
+        return self.section_type in self.metadata_section_types
+
     def get_metadata(self) -> dict:
-        """Get metadata of the section"""
+        """Get metadata of the section, decoded on first use and memoised"""
+        if self.metadata is not None:
+            return self.metadata
         metadata = {}
-        inp = InputStream("")
-        inp.file = BytesIO(self.data)
         if self.section_type == 2:  # Sound SFX/Voice
-            fetch_type = {0: "Embedded", 1: "Streamed", 2: "Prefetched"}
+            inp = InputStream(self.data)
             metadata["Unknown"] = inp.read_str(4)
-            metadata["Fetch Type"] = fetch_type[int.from_bytes(inp.read_bytes(1))]
+            metadata["Fetch Type"] = self.fetch_type_names[
+                int.from_bytes(inp.read_bytes(1))
+            ]
             metadata["Audio Id"] = inp.read_int()
             metadata["Source Id"] = inp.read_int()
             metadata["Audio Offset"] = inp.read_int()
             metadata["Audio Length"] = inp.read_int()
             inp.close()
+        self.metadata = metadata
         return metadata
 
 
 class WwiseList:
-    """Wwise Object List"""
+    """Wwise Object List
+
+    Loading only records the type/id/offset/size of every object in a
+    compact index. Objects are created on first access with their body as a
+    lazy slice of the HIRC section buffer"""
 
-    hirc_size = None
-    num_wwise = None
-    wwise_id_idx_dict = {}
-    wwise_ids = []
-    wwise_objs = []
+    def __init__(self):
+        self.hirc_size = None
+        self.num_wwise = None
+        self.hirc_buffer = None
+        self.abs_offset = None
+        self.section_types = array("B")
+        self.wwise_ids = array(UINT32_TYPECODE)
+        self.offsets = array(UINT32_TYPECODE)
+        self.sizes = array(UINT32_TYPECODE)
+        self.wwise_id_idx_dict = {}
+        self.type_positions = None
+        self.wwise_objs = {}
+        self.modified = set()
+        self.header = None
 
-    def read_wwise_list(self, inp: InputStream):
-        """Read Wwise List"""
+    def read_wwise_list(self, inp: InputStream, index: BankIndex = None):
+        """Read Wwise List, taking the object table from a cached index if one
+        is given"""
         self.hirc_size = inp.read_int()
         self.num_wwise = inp.read_int()
-        self.wwise_objs = [Wwise() for _ in range(self.num_wwise)]
+        pos = inp.get_position()
+        self.abs_offset = pos
+        if inp.is_mapped():
+            self.hirc_buffer = inp.get_view(pos, self.hirc_size - 4)
+            inp.set_position(pos + self.hirc_size - 4)
+        else:
+            self.hirc_buffer = memoryview(inp.read_bytes(self.hirc_size - 4))
+        self.header = inp.get_struct("BII")
+        if index is not None:
+            self.section_types = index.section_types
+            self.wwise_ids = index.wwise_ids
+            self.offsets = index.wwise_offsets
+            self.sizes = index.wwise_sizes
+            self.wwise_id_idx_dict = dict(zip(self.wwise_ids, range(self.num_wwise)))
+            return
+        # Only the object headers are decoded, bodies stay in the buffer
+        unpack_from = self.header.unpack_from
+        header_size = self.header.size
+        pos = 0
         for i in range(self.num_wwise):
-            self.wwise_objs[i].section_type = int.from_bytes(inp.read_bytes(1))
-            self.wwise_objs[i].size = inp.read_int()
-            self.wwise_objs[i].wwise_id = inp.read_int()
-            self.wwise_objs[i].data = inp.read_bytes(self.wwise_objs[i].size - 4)
-            self.wwise_ids.append(self.wwise_objs[i].wwise_id)
-            self.wwise_id_idx_dict[self.wwise_objs[i].wwise_id] = i
+            section_type, size, wwise_id = unpack_from(self.hirc_buffer, pos)
+            self.section_types.append(section_type)
+            self.wwise_ids.append(wwise_id)
+            self.offsets.append(pos)
+            self.sizes.append(size)
+            self.wwise_id_idx_dict[wwise_id] = i
+            pos += header_size + size - 4
 
     def get_wwise(self, wwise_id: int) -> Wwise:
         """Get Wwise Data"""
-        return self.wwise_objs[self.wwise_id_idx_dict[wwise_id]]
+        idx: int = self.wwise_id_idx_dict[wwise_id]
+        wwise_obj = self.wwise_objs.get(idx)
+        if wwise_obj is None:
+            wwise_obj = Wwise()
+            wwise_obj.section_type = self.section_types[idx]
+            wwise_obj.size = self.sizes[idx]
+            wwise_obj.wwise_id = wwise_id
+            body = self.offsets[idx] + self.header.size
+            wwise_obj.data = self.hirc_buffer[body : body + self.sizes[idx] - 4]
+            self.wwise_objs[idx] = wwise_obj
+        return wwise_obj
+
+    def get_body(self, idx: int) -> memoryview:
+        """Get the body of the object at idx without creating the object,
+        its new body if it was replaced"""
+        if idx in self.modified:
+            return memoryview(self.wwise_objs[idx].data)
+        body = self.offsets[idx] + self.header.size
+        return self.hirc_buffer[body : body + self.sizes[idx] - 4]
+
+    def detach(self):
+        """Replace the views of the mapped bank by copies so the mapping can
+        be closed"""
+        if self.hirc_buffer is not None:
+            self.hirc_buffer = memoryview(bytes(self.hirc_buffer))
+        for wwise_obj in self.wwise_objs.values():
+            wwise_obj.data = bytes(wwise_obj.data)
+
+    def get_type_positions(self) -> dict:
+        """Get the section type -> positions of its Wwise objects, in order,
+        grouped on the first call"""
+        if self.type_positions is None:
+            self.type_positions = {}
+            for pos, section_type in enumerate(self.section_types):
+                positions = self.type_positions.get(section_type)
+                if positions is None:
+                    positions = self.type_positions[section_type] = array(
+                        UINT32_TYPECODE
+                    )
+                positions.append(pos)
+        return self.type_positions
+
+    def get_ids_by_type(self, section_type: int) -> list:
+        """Get the ids of all Wwise objects of a section type"""
+        wwise_ids = self.wwise_ids
+        return [
+            wwise_ids[pos] for pos in self.get_type_positions().get(section_type, ())
+        ]
+
+    def replace_wwise_data(self, wwise_id: int, data: bytes):
+        """Replace the body of a Wwise object"""
+        wwise_obj = self.get_wwise(wwise_id)
+        wwise_obj.data = data
+        wwise_obj.size = len(data) + 4
+        wwise_obj.metadata = None
+        self.modified.add(self.wwise_id_idx_dict[wwise_id])
 
     def write_wwise_list(self, out: OutputStream):
-        """Write Wwise List"""
-        out.write_int(self.hirc_size)
+        """Write Wwise List
+
+        Unchanged objects are copied from the section buffer as is, in runs
+        between the modified objects"""
+        pieces = []
+        run_start = 0
+        for idx in sorted(self.modified):
+            wwise_obj = self.wwise_objs[idx]
+            pieces.append(self.hirc_buffer[run_start : self.offsets[idx]])
+            pieces.append(
+                out.get_struct("BII").pack(
+                    wwise_obj.section_type,
+                    wwise_obj.size,
+                    wwise_obj.wwise_id,
+                )
+            )
+            pieces.append(wwise_obj.data)
+            run_start = self.offsets[idx] + self.header.size + self.sizes[idx] - 4
+        pieces.append(self.hirc_buffer[run_start:])
+        out.write_int(4 + sum(len(piece) for piece in pieces))
         out.write_int(self.num_wwise)
-        for wwise_id in self.wwise_ids:
-            idx: int = self.wwise_id_idx_dict[wwise_id]
-            out.write_bytes(self.wwise_objs[idx].section_type.to_bytes(1))
-            out.write_int(self.wwise_objs[idx].size)
-            out.write_int(self.wwise_objs[idx].wwise_id)
-            out.write_bytes(self.wwise_objs[idx].data)
+        for piece in pieces:
+            out.write_bytes(piece)
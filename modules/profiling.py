@@ -0,0 +1,144 @@
+"""profiling: Module for timing spans and throughput counters
+
+Profiling is off unless a Profiler is set with set_profiler. While it is
+off, span returns a shared no-op context and count returns at once, so
+instrumented code pays a global lookup and a None check per call."""
+
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+profiler: "Profiler" = None
+NULL_SPAN = nullcontext()
+
+
+class Span:
+    """Context manager recording one timed span"""
+
+    __slots__ = ("owner", "name", "args", "start")
+
+    def __init__(self, owner: "Profiler", name: str, args: dict):
+        self.owner = owner
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.owner.add_span(
+            self.name, self.start, time.perf_counter_ns() - self.start, self.args
+        )
+
+
+class Profiler:
+    """Collects timed spans and counters from every thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter_ns()
+        self.spans = []
+        self.counters = {}
+
+    def span(self, name: str, **args) -> Span:
+        """Time the enclosed block as a span called name"""
+        return Span(self, name, args)
+
+    def add_span(self, name: str, start: int, duration: int, args: dict):
+        """Record a finished span, times in nanoseconds"""
+        with self.lock:
+            self.spans.append((name, start, duration, threading.get_ident(), args))
+
+    def count(self, name: str, value: int = 1):
+        """Add value to the counter called name"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_io(self, kind: str, size: int):
+        """Count one call of kind (read, write, copy, map) moving size bytes"""
+        with self.lock:
+            counters = self.counters
+            counters[kind + "_calls"] = counters.get(kind + "_calls", 0) + 1
+            counters[kind + "_bytes"] = counters.get(kind + "_bytes", 0) + size
+
+    def get_report(self) -> dict:
+        """Total time, calls and longest call of every span name, and the
+        counters"""
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        totals = {}
+        for name, _, duration, _, _ in spans:
+            total = totals.setdefault(name, {"calls": 0, "total_ms": 0, "max_ms": 0})
+            total["calls"] += 1
+            total["total_ms"] += duration / 1e6
+            total["max_ms"] = max(total["max_ms"], duration / 1e6)
+        return {
+            "wall_ms": (time.perf_counter_ns() - self.start) / 1e6,
+            "spans": totals,
+            "counters": counters,
+        }
+
+    def get_chrome_trace(self) -> dict:
+        """Spans and counters as Chrome trace events, for chrome://tracing
+        or Perfetto"""
+        pid = os.getpid()
+        with self.lock:
+            events = [
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.start) / 1e3,
+                    "dur": duration / 1e3,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+                for name, start, duration, tid, args in self.spans
+            ]
+            end = (time.perf_counter_ns() - self.start) / 1e3
+            events.extend(
+                {
+                    "name": name,
+                    "ph": "C",
+                    "ts": end,
+                    "pid": pid,
+                    "args": {name: value},
+                }
+                for name, value in self.counters.items()
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, trace_file: str):
+        """Write the Chrome trace events to a JSON file"""
+        with open(trace_file, "w", encoding="utf-8") as trace:
+            json.dump(self.get_chrome_trace(), trace)
+
+
+def set_profiler(new_profiler: Profiler):
+    """Set the profiler receiving all spans and counters, None to disable"""
+    global profiler  # pylint: disable=global-statement
+    profiler = new_profiler
+
+
+def span(name: str, **args):
+    """Time the enclosed block if profiling is on"""
+    if profiler is None:
+        return NULL_SPAN
+    return profiler.span(name, **args)
+
+
+def count(name: str, value: int = 1):
+    """Add value to a counter if profiling is on"""
+    if profiler is not None:
+        profiler.count(name, value)
+
+
+def count_io(kind: str, size: int):
+    """Count one read/write/copy call moving size bytes if profiling is on"""
+    if profiler is not None:
+        profiler.count_io(kind, size)
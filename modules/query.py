@@ -0,0 +1,313 @@
+"""query: Module for filtering the WEMs and HIRC objects of a bank"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from modules.iostream import UINT32_TYPECODE
+from modules.objects import WemList, Wwise, WwiseList
+
+# Sorts right after the digits, so every id string starting with a prefix
+# lies between prefix and prefix + ID_PREFIX_END
+ID_PREFIX_END = ":"
+# Fetch type of objects which are not Sound SFX
+NO_FETCH_TYPE = 0xFF
+# Sound SFX bodies start with 4 unknown bytes followed by the fetch type
+FETCH_TYPE_OFFSET = 4
+SIZE_UNITS = {"": 1, "b": 1, "k": 1 << 10, "kb": 1 << 10, "m": 1 << 20, "mb": 1 << 20}
+
+
+@dataclass(slots=True)
+class WemFilter:
+    """Filter over the WEMs of a bank, fields left as None match everything
+
+    Sizes are the original payload sizes in bytes, both bounds inclusive"""
+
+    id_prefix: str = None
+    min_size: int = None
+    max_size: int = None
+    replaced: bool = None
+
+
+@dataclass(slots=True)
+class WwiseFilter:
+    """Filter over the HIRC objects of a bank, fields left as None match
+    everything"""
+
+    id_prefix: str = None
+    section_type: int = None
+    fetch_type: int = None
+
+
+class PrefixIndex:
+    """Ids sorted by their decimal string, so the ids starting with a prefix
+    are one contiguous slice found with two bisections"""
+
+    def __init__(self, ids: array):
+        keys = [str(item_id) for item_id in ids]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = [keys[pos] for pos in order]
+        self.order = array(UINT32_TYPECODE, order)
+
+    def find(self, prefix: str) -> array:
+        """Positions of the ids starting with prefix, in no particular order"""
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + ID_PREFIX_END, start)
+        return self.order[start:end]
+
+
+class RangeIndex:
+    """Values sorted with their positions, so the values within a range are
+    one contiguous slice found with two bisections"""
+
+    def __init__(self, values: array):
+        order = sorted(range(len(values)), key=values.__getitem__)
+        self.values = array(values.typecode, (values[pos] for pos in order))
+        self.order = array(UINT32_TYPECODE, order)
+
+    def find(self, low: int = None, high: int = None) -> array:
+        """Positions of the values in [low, high], in no particular order"""
+        start = 0 if low is None else bisect_left(self.values, low)
+        end = len(self.values) if high is None else bisect_right(self.values, high)
+        return self.order[start:end]
+
+
+def get_buckets(values: array) -> dict:
+    """Group the positions of an array by value, each bucket in order"""
+    buckets = {}
+    for pos, value in enumerate(values):
+        bucket = buckets.get(value)
+        if bucket is None:
+            bucket = buckets[value] = array(UINT32_TYPECODE)
+        bucket.append(pos)
+    return buckets
+
+
+def select(count: int, filters: list) -> array:
+    """Positions of the count entries passing every filter
+
+    filters are (candidates, check) pairs, candidates being the positions
+    found with an index or None if the filter has none, and check a
+    predicate on a position. Only the smallest candidate array is scanned,
+    the other filters are applied to its positions through their checks.
+    Returns the positions in bank order"""
+    indexed = [i for i, (positions, _) in enumerate(filters) if positions is not None]
+    if indexed:
+        best = min(indexed, key=lambda i: len(filters[i][0]))
+        positions = filters[best][0]
+    else:
+        best, positions = None, range(count)
+    for i, (_, check) in enumerate(filters):
+        if i != best:
+            positions = [pos for pos in positions if check(pos)]
+    if best is not None:
+        positions = sorted(positions)
+    return array(UINT32_TYPECODE, positions)
+
+
+class BankQuery:
+    """Filter index over the WEMs and HIRC objects of a bank
+
+    The id prefix, size, section type and fetch type indexes are built on
+    first use, or all at once with build, and answer a filter with
+    bisections and bucket lookups instead of a scan of every entry.
+    Replacements are looked up in WemList.repl_wems at query time. Results
+    are arrays of positions in the WEM/HIRC columns, in bank order"""
+
+    def __init__(self, wem_list: WemList, wwise_list: WwiseList):
+        self.wem_list = wem_list
+        self.wwise_list = wwise_list
+        self.wem_prefixes = None
+        self.wem_sizes = None
+        self.wwise_prefixes = None
+        self.fetch_types = None
+        self.fetch_buckets = None
+
+    def build(self):
+        """Build every index, so the first query does not pay for it"""
+        self.get_wem_prefixes()
+        self.get_wem_sizes()
+        self.get_wwise_prefixes()
+        self.get_type_buckets()
+        self.get_fetch_buckets()
+
+    def get_wem_prefixes(self) -> PrefixIndex:
+        """Get the id prefix index of the WEMs"""
+        if self.wem_prefixes is None:
+            self.wem_prefixes = PrefixIndex(self.wem_list.wem_ids)
+        return self.wem_prefixes
+
+    def get_wem_sizes(self) -> RangeIndex:
+        """Get the size index of the WEMs"""
+        if self.wem_sizes is None:
+            self.wem_sizes = RangeIndex(self.wem_list.sizes)
+        return self.wem_sizes
+
+    def get_wwise_prefixes(self) -> PrefixIndex:
+        """Get the id prefix index of the HIRC objects"""
+        if self.wwise_prefixes is None:
+            self.wwise_prefixes = PrefixIndex(self.wwise_list.wwise_ids)
+        return self.wwise_prefixes
+
+    def get_type_buckets(self) -> dict:
+        """Get the positions of the HIRC objects of every section type, the
+        index kept by the WwiseList"""
+        return self.wwise_list.get_type_positions()
+
+    def get_fetch_buckets(self) -> dict:
+        """Get the positions of the Sound SFX objects of every fetch type
+
+        The fetch type byte is read straight from the HIRC section buffer,
+        without creating the objects"""
+        if self.fetch_buckets is None:
+            wwise_list = self.wwise_list
+            self.fetch_types = array("B", bytes([NO_FETCH_TYPE])) * len(
+                wwise_list.wwise_ids
+            )
+            for pos in self.get_type_buckets().get(2, ()):
+                self.fetch_types[pos] = self.read_fetch_type(pos)
+            self.fetch_buckets = get_buckets(self.fetch_types)
+        return self.fetch_buckets
+
+    def read_fetch_type(self, pos: int) -> int:
+        """Read the fetch type of the Sound SFX object at pos"""
+        wwise_list = self.wwise_list
+        wwise_obj = wwise_list.wwise_objs.get(pos)
+        if wwise_obj is not None:
+            data, offset = wwise_obj.data, FETCH_TYPE_OFFSET
+        else:
+            data = wwise_list.hirc_buffer
+            offset = wwise_list.offsets[pos] + wwise_list.header.size
+            offset += FETCH_TYPE_OFFSET
+            if wwise_list.sizes[pos] - 4 <= FETCH_TYPE_OFFSET:
+                return NO_FETCH_TYPE
+        if offset >= len(data):
+            return NO_FETCH_TYPE
+        return data[offset]
+
+    def update_wwise(self, wwise_id: int):
+        """Update the indexes after the body of a HIRC object was replaced"""
+        pos = self.wwise_list.wwise_id_idx_dict[wwise_id]
+        if self.fetch_buckets is None or self.wwise_list.section_types[pos] != 2:
+            return
+        old_type, new_type = self.fetch_types[pos], self.read_fetch_type(pos)
+        if old_type == new_type:
+            return
+        self.fetch_types[pos] = new_type
+        self.fetch_buckets[old_type].remove(pos)
+        bucket = self.fetch_buckets.setdefault(new_type, array(UINT32_TYPECODE))
+        bucket.insert(bisect_left(bucket, pos), pos)
+
+    def find_wems(self, wem_filter: WemFilter) -> array:
+        """Positions of the WEMs matching a filter"""
+        wem_list = self.wem_list
+        filters = []
+        if wem_filter.id_prefix:
+            prefix = wem_filter.id_prefix
+            wem_ids = wem_list.wem_ids
+            filters.append(
+                (
+                    self.get_wem_prefixes().find(prefix),
+                    lambda pos: str(wem_ids[pos]).startswith(prefix),
+                )
+            )
+        if wem_filter.min_size is not None or wem_filter.max_size is not None:
+            low = 0 if wem_filter.min_size is None else wem_filter.min_size
+            high = wem_filter.max_size
+            sizes = wem_list.sizes
+            filters.append(
+                (
+                    self.get_wem_sizes().find(low, high),
+                    lambda pos: low <= sizes[pos]
+                    and (high is None or sizes[pos] <= high),
+                )
+            )
+        if wem_filter.replaced is not None:
+            id_idx_map = wem_list.wem_id_idx_map
+            replaced = {id_idx_map[wem_id] for wem_id in wem_list.repl_wems}
+            if wem_filter.replaced:
+                filters.append((list(replaced), replaced.__contains__))
+            else:
+                # Only a few WEMs are replaced, the others are not worth
+                # listing as candidates
+                filters.append((None, lambda pos: pos not in replaced))
+        return select(wem_list.wem_count, filters)
+
+    def find_wwise(self, wwise_filter: WwiseFilter) -> array:
+        """Positions of the HIRC objects matching a filter"""
+        wwise_list = self.wwise_list
+        filters = []
+        if wwise_filter.id_prefix:
+            prefix = wwise_filter.id_prefix
+            wwise_ids = wwise_list.wwise_ids
+            filters.append(
+                (
+                    self.get_wwise_prefixes().find(prefix),
+                    lambda pos: str(wwise_ids[pos]).startswith(prefix),
+                )
+            )
+        if wwise_filter.section_type is not None:
+            section_type = wwise_filter.section_type
+            section_types = wwise_list.section_types
+            filters.append(
+                (
+                    self.get_type_buckets().get(section_type, ()),
+                    lambda pos: section_types[pos] == section_type,
+                )
+            )
+        if wwise_filter.fetch_type is not None:
+            fetch_type = wwise_filter.fetch_type
+            filters.append(
+                (
+                    self.get_fetch_buckets().get(fetch_type, ()),
+                    lambda pos: self.fetch_types[pos] == fetch_type,
+                )
+            )
+        return select(len(wwise_list.wwise_ids), filters)
+
+
+def parse_size(text: str) -> int:
+    """Parse a size in bytes with an optional k/kb/m/mb suffix"""
+    number = text.rstrip("kmbKMB")
+    unit = SIZE_UNITS.get(text[len(number) :].lower())
+    try:
+        value = float(number)
+    except ValueError:
+        value = None
+    if unit is None or value is None or value < 0:
+        raise ValueError("Invalid size " + text)
+    return int(value * unit)
+
+
+def parse_query(text: str) -> (WemFilter, WwiseFilter):
+    """Parse a search string into a WEM filter and a HIRC filter
+
+    Terms are separated by spaces:
+        123             ids starting with 123
+        size:MIN-MAX    WEMs of MIN to MAX bytes, either bound may be left
+                        out and take a k/m suffix (size:10k-, size:-2m)
+        replaced        WEMs with a replacement, unreplaced for the others
+        type:N          HIRC objects of section type N
+        fetch:NAME      Sound SFX objects with this fetch type (embedded,
+                        streamed or prefetched)"""
+    wem_filter, wwise_filter = WemFilter(), WwiseFilter()
+    fetch_types = {
+        name.lower(): value for value, name in Wwise.fetch_type_names.items()
+    }
+    for term in text.split():
+        name, _, value = term.partition(":")
+        name = name.lower()
+        if term.isdigit():
+            wem_filter.id_prefix = wwise_filter.id_prefix = term
+        elif name in ("replaced", "unreplaced") and not value:
+            wem_filter.replaced = name == "replaced"
+        elif name == "size" and "-" in value:
+            low, _, high = value.partition("-")
+            wem_filter.min_size = parse_size(low) if low else None
+            wem_filter.max_size = parse_size(high) if high else None
+        elif name == "type" and value.isdigit():
+            wwise_filter.section_type = int(value)
+        elif name == "fetch" and value.lower() in fetch_types:
+            wwise_filter.fetch_type = fetch_types[value.lower()]
+        else:
+            raise ValueError("Invalid search term " + term)
+    return wem_filter, wwise_filter
@@ -0,0 +1,194 @@
+"""refgraph: Module for the WEM <-> HIRC cross-reference graph"""
+
+import sys
+import threading
+from array import array
+from collections import deque
+from typing import Callable, Optional
+from modules.indexcache import flatten_edges, unflatten_edges
+from modules.iostream import UINT32_TYPECODE, get_struct
+from modules.objects import WemList, WwiseList
+
+# Sound SFX bodies hold the Audio Id and Source Id after 4 unknown bytes and
+# the fetch type
+SOUND_IDS_OFFSET = 5
+
+
+class ReferenceGraph:
+    """Cross-reference index between WEMs and HIRC objects
+
+    Sound SFX objects reference WEMs through their Audio Id/Source Id fields.
+    Music Tracks, containers, events and actions store the ids they
+    reference somewhere in their body, whose layout depends on the Wwise
+    version, so their bodies are scanned for ids of WEMs and of other
+    objects. Wwise writes an object's dependencies before the object itself,
+    so only ids of earlier objects count as children, which keeps parent ids
+    found in child bodies out of the graph
+
+    The graph is built on the first query, reading the bodies straight from
+    the HIRC section buffer without creating Wwise objects, unless its edges
+    were restored from the index cache. on_build is called once the bodies
+    were scanned"""
+
+    scanned_section_types = {3, 4, 5, 6, 7, 9, 10, 11, 12, 13}
+
+    def __init__(self, wem_list: WemList, wwise_list: WwiseList, little_endian=True):
+        self.wem_list = wem_list
+        self.wwise_list = wwise_list
+        self.swap_bytes = little_endian != (sys.byteorder == "little")
+        self.sound_ids = get_struct(("<" if little_endian else ">") + "II")
+        self.object_wems = {}
+        self.wem_users = {}
+        self.children = {}
+        self.parents = {}
+        self.flat_edges = None
+        self.built = False
+        self.lock = threading.Lock()
+        self.on_build: Optional[Callable[[], None]] = None
+
+    def build(self):
+        """Build the whole graph in one pass over the HIRC objects, unless it
+        is already built. Safe to call from a background thread"""
+        with self.lock:
+            if self.built:
+                return
+            scanned = self.flat_edges is None
+            if scanned:
+                section_types = self.wwise_list.section_types
+                for idx, wwise_id in enumerate(self.wwise_list.wwise_ids):
+                    section_type = section_types[idx]
+                    if section_type == 2 or section_type in self.scanned_section_types:
+                        self.add_edges(wwise_id, *self.find_references_at(idx))
+            else:
+                self.expand_edges()
+            self.built = True
+        if scanned and self.on_build is not None:
+            self.on_build()
+
+    def load_edges(self, object_wem_edges: tuple, child_edges: tuple):
+        """Restore the graph from the flattened edges of a cached index, which
+        are only expanded on the first query"""
+        self.flat_edges = (object_wem_edges, child_edges)
+
+    def expand_edges(self):
+        """Expand the flattened edges given to load_edges"""
+        object_wem_edges, child_edges = self.flat_edges
+        self.flat_edges = None
+        self.object_wems = unflatten_edges(*object_wem_edges)
+        self.children = unflatten_edges(*child_edges)
+        for wwise_id, wems in self.object_wems.items():
+            for wem_id in wems:
+                self.wem_users.setdefault(wem_id, set()).add(wwise_id)
+        for wwise_id, child_ids in self.children.items():
+            for child_id in child_ids:
+                self.parents.setdefault(child_id, set()).add(wwise_id)
+
+    def get_flat_edges(self) -> (tuple, tuple):
+        """Get the WEM and child edges flattened, for the index cache, or
+        None if the graph was neither built nor restored"""
+        if self.flat_edges is not None:
+            return self.flat_edges
+        if not self.built:
+            return None, None
+        return flatten_edges(self.object_wems), flatten_edges(self.children)
+
+    def scan_ids(self, data: memoryview) -> set:
+        """Get every 32-bit value of data, at any byte alignment"""
+        values = set()
+        for start in range(min(4, len(data))):
+            end = start + (len(data) - start) // 4 * 4
+            ints = array(UINT32_TYPECODE)
+            ints.frombytes(data[start:end])
+            if self.swap_bytes:
+                ints.byteswap()
+            values.update(ints)
+        return values
+
+    def find_references(self, wwise_id: int) -> (set, set):
+        """Get the WEM ids and child object ids referenced by an object"""
+        return self.find_references_at(self.wwise_list.wwise_id_idx_dict[wwise_id])
+
+    def find_references_at(self, idx: int) -> (set, set):
+        """Get the WEM ids and child object ids referenced by the object at
+        idx, read from its body"""
+        wwise_list = self.wwise_list
+        section_type = wwise_list.section_types[idx]
+        wem_ids = self.wem_list.wem_id_idx_map
+        if section_type == 2:  # Sound SFX/Voice
+            body = wwise_list.get_body(idx)
+            if len(body) < SOUND_IDS_OFFSET + self.sound_ids.size:
+                return set(), set()
+            return {
+                wem_id
+                for wem_id in self.sound_ids.unpack_from(body, SOUND_IDS_OFFSET)
+                if wem_id in wem_ids
+            }, set()
+        if section_type not in self.scanned_section_types:
+            return set(), set()
+        idx_dict = wwise_list.wwise_id_idx_dict
+        values = self.scan_ids(wwise_list.get_body(idx))
+        return {value for value in values if value in wem_ids}, {
+            value
+            for value in values
+            if value in idx_dict and idx_dict[value] < idx
+        }
+
+    def add_edges(self, wwise_id: int, wems: set, children: set):
+        """Add the edges of an object"""
+        if wems:
+            self.object_wems[wwise_id] = wems
+            for wem_id in wems:
+                self.wem_users.setdefault(wem_id, set()).add(wwise_id)
+        if children:
+            self.children[wwise_id] = children
+            for child_id in children:
+                self.parents.setdefault(child_id, set()).add(wwise_id)
+
+    def remove_edges(self, wwise_id: int):
+        """Remove the edges of an object"""
+        for wem_id in self.object_wems.pop(wwise_id, ()):
+            self.wem_users[wem_id].discard(wwise_id)
+        for child_id in self.children.pop(wwise_id, ()):
+            self.parents[child_id].discard(wwise_id)
+
+    def update_object(self, wwise_id: int):
+        """Recompute only the edges of an object after its body changed,
+        nothing to do if the graph is not built yet"""
+        with self.lock:
+            if self.flat_edges is not None:
+                self.expand_edges()
+                self.built = True
+            if not self.built:
+                return
+            self.remove_edges(wwise_id)
+            self.add_edges(wwise_id, *self.find_references(wwise_id))
+
+    def get_wem_users(self, wem_id: int, transitive: bool = False) -> set:
+        """Get the objects playing a WEM, or with transitive every object
+        (containers, actions, events) which reaches it"""
+        self.build()
+        users = set(self.wem_users.get(wem_id, ()))
+        if not transitive:
+            return users
+        queue = deque(users)
+        while queue:
+            for parent_id in self.parents.get(queue.popleft(), ()):
+                if parent_id not in users:
+                    users.add(parent_id)
+                    queue.append(parent_id)
+        return users
+
+    def get_reachable_wems(self, wwise_id: int) -> set:
+        """Get every WEM an object (e.g. an event) reaches through its children"""
+        self.build()
+        wems = set()
+        seen = {wwise_id}
+        queue = deque(seen)
+        while queue:
+            current_id = queue.popleft()
+            wems.update(self.object_wems.get(current_id, ()))
+            for child_id in self.children.get(current_id, ()):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    queue.append(child_id)
+        return wems
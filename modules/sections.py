@@ -1,15 +1,19 @@
 """sections: Module which contains the sections of bank"""
 
+from typing import Callable
+from modules import profiling
+from modules.indexcache import BankIndex
 from modules.iostream import InputStream, OutputStream
 from modules.objects import WemList, WwiseList
 
 
-class BKHD:
-    """BKHD Section Class"""
+class Chunk:
+    """Chunk Class : chunk kept as is, for chunks which are not decoded"""
 
-    header: str = "BKHD"
-    size: int
-    data: bytes
+    def __init__(self, header: str):
+        self.header = header
+        self.size = None
+        self.data = None
 
     def read_data(self, input_stream: InputStream):
         """Read data"""
@@ -17,7 +21,16 @@ class BKHD:
         if self.header != header:
             raise ValueError(self.header, " section not found!")
         self.size = input_stream.read_int()
-        self.data = input_stream.read_bytes(self.size)
+        if input_stream.is_mapped():
+            pos = input_stream.get_position()
+            self.data = input_stream.get_view(pos, self.size)
+            input_stream.set_position(pos + self.size)
+        else:
+            self.data = input_stream.read_bytes(self.size)
+
+    def detach(self):
+        """Replace a view of the mapped bank by a copy"""
+        self.data = bytes(self.data)
 
     def write_data(self, output_stream: OutputStream):
         """Write data"""
@@ -26,17 +39,26 @@ class BKHD:
         output_stream.write_bytes(self.data)
 
 
+class BKHD(Chunk):
+    """BKHD Section Class"""
+
+    def __init__(self):
+        super().__init__("BKHD")
+
+
 class DIDX:
     """DIDX Section Class"""
 
     header: str = "DIDX"
 
-    def read_data(self, input_stream: InputStream, wem_list: WemList):
+    def read_data(
+        self, input_stream: InputStream, wem_list: WemList, index: BankIndex = None
+    ):
         """Read data"""
         header = input_stream.read_str(4)
         if self.header != header:
             raise ValueError(self.header, " section not found!")
-        wem_list.get_wem_metadata_from_bnk(input_stream)
+        wem_list.get_wem_metadata_from_bnk(input_stream, index)
 
     def write_data(self, output_stream: OutputStream, wem_list: WemList):
         """Write data"""
@@ -56,10 +78,12 @@ class DATA:
             raise ValueError(self.header, " section not found!")
         wem_list.get_wem_data_from_bnk(input_stream)
 
-    def write_data(self, output_stream: OutputStream, wem_list: WemList):
+    def write_data(
+        self, output_stream: OutputStream, wem_list: WemList, source=None
+    ):
         """Write data"""
         output_stream.write_str(self.header)
-        wem_list.write_wem_data_to_bnk(output_stream)
+        wem_list.write_wem_data_to_bnk(output_stream, source)
 
 
 class HIRC:
@@ -69,12 +93,14 @@ class HIRC:
     size: int
     data: bytes
 
-    def read_data(self, input_stream: InputStream, wwise_list: WwiseList):
+    def read_data(
+        self, input_stream: InputStream, wwise_list: WwiseList, index: BankIndex = None
+    ):
         """Read data"""
         header = input_stream.read_str(4)
         if self.header != header:
             raise ValueError(self.header, " section not found!")
-        wwise_list.read_wwise_list(input_stream)
+        wwise_list.read_wwise_list(input_stream, index)
 
     def write_data(self, output_stream: OutputStream, wwise_list: WwiseList):
         """Write data"""
@@ -82,28 +108,128 @@ class HIRC:
         wwise_list.write_wwise_list(output_stream)
 
 
-class Sections:
-    """To combine all sections into one wrapper"""
+def scan_chunks(input_stream: InputStream) -> list:
+    """Index the chunks of a bank as (header, offset, size) by walking the
+    chunk headers only, without reading any chunk"""
+    chunks = []
+    end = input_stream.get_size()
+    pos = 0
+    while pos < end:
+        input_stream.set_position(pos)
+        header = input_stream.read_str(4)
+        size = input_stream.read_int()
+        if size is None or pos + 8 + size > end:
+            raise ValueError(
+                "The file has a truncated " + header + " section at offset " + str(pos)
+            )
+        chunks.append((header, pos, size))
+        pos += 8 + size
+    return chunks
 
-    bkhd = BKHD()
-    didx = DIDX()
-    data = DATA()
-    hirc = HIRC()
+
+class Sections:
+    """To combine all sections into one wrapper
+
+    A first pass indexes the chunk headers, then the sections are read in
+    the order they are found. Callers may read only some of them, and chunks
+    which are not decoded are kept and written back verbatim"""
+
+    def __init__(self):
+        self.bkhd = BKHD()
+        self.didx = DIDX()
+        self.data = DATA()
+        self.hirc = HIRC()
+        self.chunks = []
+        self.loaded = []
+        self.complete = False
+
+    def get_section(self, header: str):
+        """Get the section object reading a chunk"""
+        known = {
+            self.bkhd.header: self.bkhd,
+            self.didx.header: self.didx,
+            self.data.header: self.data,
+            self.hirc.header: self.hirc,
+        }
+        return known.get(header) or Chunk(header)
+
+    def detach(self, wem_list: WemList, wwise_list: WwiseList):
+        """Replace every view of the mapped bank by a copy, so the mapping
+        is closed once the views handed out are gone"""
+        for section in self.loaded:
+            if isinstance(section, Chunk):
+                section.detach()
+        wem_list.detach()
+        wwise_list.detach()
 
     def read_sections(
-        self, input_stream: InputStream, wem_list: WemList, wwise_list: WwiseList
+        self,
+        input_stream: InputStream,
+        wem_list: WemList,
+        wwise_list: WwiseList,
+        progress: Callable[[str], None] = None,
+        headers: set = None,
+        index: BankIndex = None,
     ):
-        """Read all sections"""
-        self.bkhd.read_data(input_stream)
-        self.didx.read_data(input_stream, wem_list)
-        self.data.read_data(input_stream, wem_list)
-        self.hirc.read_data(input_stream, wwise_list)
+        """Read all sections, or only those in headers, reporting each
+        section read to progress. With a cached index, the chunk headers are
+        not walked and DIDX/HIRC are not parsed"""
+        progress = progress or (lambda header: None)
+        if index is not None:
+            self.chunks = index.chunks
+        else:
+            with profiling.span("scan chunks"):
+                self.chunks = scan_chunks(input_stream)
+        if not self.chunks or self.chunks[0][0] != self.bkhd.header:
+            raise ValueError(self.bkhd.header, " section not found!")
+        found = {header for header, _, _ in self.chunks}
+        if self.data.header in found and self.didx.header not in found:
+            raise ValueError(self.didx.header, " section not found!")
+        if headers is not None and self.data.header in headers:
+            # WEM payloads are located through the DIDX section
+            headers = set(headers) | {self.didx.header}
+        sections = {}
+        # DIDX is read first, as reading DATA needs it
+        for header, offset, _ in sorted(
+            self.chunks, key=lambda chunk: chunk[0] != self.didx.header
+        ):
+            if headers is not None and header not in headers:
+                continue
+            section = self.get_section(header)
+            input_stream.set_position(offset)
+            with profiling.span("read " + header):
+                if section is self.didx:
+                    section.read_data(input_stream, wem_list, index)
+                elif section is self.data:
+                    section.read_data(input_stream, wem_list)
+                elif section is self.hirc:
+                    section.read_data(input_stream, wwise_list, index)
+                else:
+                    section.read_data(input_stream)
+            sections[offset] = section
+            progress(header)
+        self.loaded = [
+            sections[offset] for _, offset, _ in self.chunks if offset in sections
+        ]
+        self.complete = headers is None
 
     def write_sections(
-        self, output_stream: OutputStream, wem_list: WemList, wwise_list: WwiseList
+        self,
+        output_stream: OutputStream,
+        wem_list: WemList,
+        wwise_list: WwiseList,
+        source=None,
     ):
-        """Write all sections"""
-        self.bkhd.write_data(output_stream)
-        self.didx.write_data(output_stream, wem_list)
-        self.data.write_data(output_stream, wem_list)
-        self.hirc.write_data(output_stream, wwise_list)
+        """Write all sections in their original order"""
+        if not self.complete:
+            raise ValueError("Cannot write a bank which was only partially read!")
+        for section in self.loaded:
+            with profiling.span("write " + section.header):
+                if section is self.didx:
+                    section.write_data(output_stream, wem_list)
+                elif section is self.data:
+                    section.write_data(output_stream, wem_list, source)
+                elif section is self.hirc:
+                    section.write_data(output_stream, wwise_list)
+                else:
+                    section.write_data(output_stream)
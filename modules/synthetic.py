@@ -0,0 +1,149 @@
+"""synthetic: Module to generate synthetic banks for benchmarks"""
+
+import random
+import struct
+from modules.iostream import OutputStream
+from modules.layout import align
+
+# Objects of each type generated per WEM, on top of one Sound SFX per WEM
+DEFAULT_HIRC_MIX = {5: 0.05, 3: 0.05, 4: 0.05}
+
+
+def get_payload_sizes(
+    rnd: random.Random,
+    wem_count: int,
+    min_size: int,
+    max_size: int,
+    distribution: str,
+) -> list:
+    """Draw the payload size of every WEM
+
+    uniform spreads sizes evenly between min_size and max_size, lognormal
+    gives many small payloads and a few large ones like real banks"""
+    if distribution == "uniform":
+        return [rnd.randint(min_size, max_size) for _ in range(wem_count)]
+    if distribution == "lognormal":
+        median = (min_size * max_size) ** 0.5
+        return [
+            min(max_size, max(min_size, int(rnd.lognormvariate(0, 1) * median)))
+            for _ in range(wem_count)
+        ]
+    raise ValueError("Unknown size distribution " + distribution)
+
+
+def make_hirc_objects(
+    rnd: random.Random, wem_ids: list, sizes: list, hirc_mix: dict, fmt: str
+) -> list:
+    """Build the HIRC objects as (type, id, body), dependencies first
+
+    Every WEM gets a Sound SFX, containers group sounds, actions target
+    containers or sounds and events trigger actions"""
+    next_id = [max(wem_ids, default=0) + 1]
+
+    def new_id() -> int:
+        next_id[0] += 1
+        return next_id[0]
+
+    objects = []
+    sound_ids = []
+    for wem_id, size in zip(wem_ids, sizes):
+        sound_id = new_id()
+        body = b"\0\0\0\0\0" + struct.pack(fmt + "IIII", wem_id, wem_id, 0, size)
+        objects.append((2, sound_id, body))
+        sound_ids.append(sound_id)
+    counts = {
+        section_type: int(len(wem_ids) * ratio)
+        for section_type, ratio in hirc_mix.items()
+    }
+    container_ids = []
+    for _ in range(counts.pop(5, 0)):
+        children = rnd.sample(sound_ids, min(len(sound_ids), rnd.randint(1, 8)))
+        container_id = new_id()
+        body = b"\0" + struct.pack(
+            fmt + "I" * (len(children) + 1), len(children), *children
+        )
+        objects.append((5, container_id, body))
+        container_ids.append(container_id)
+    action_ids = []
+    targets = container_ids or sound_ids
+    for _ in range(counts.pop(3, 0)):
+        action_id = new_id()
+        body = struct.pack(fmt + "HI", 0x403, rnd.choice(targets)) + b"\0\0"
+        objects.append((3, action_id, body))
+        action_ids.append(action_id)
+    for _ in range(counts.pop(4, 0)):
+        actions = rnd.sample(action_ids, min(len(action_ids), rnd.randint(1, 3)))
+        body = bytes([len(actions)]) + struct.pack(
+            fmt + "I" * len(actions), *actions
+        )
+        objects.append((4, new_id(), body))
+    for section_type, count in counts.items():
+        for _ in range(count):
+            body = rnd.randbytes(rnd.randint(4, 64))
+            objects.append((section_type, new_id(), body))
+    return objects
+
+
+def make_synthetic_bank(
+    bnk: str,
+    wem_count: int = 1000,
+    min_size: int = 64,
+    max_size: int = 4096,
+    distribution: str = "lognormal",
+    hirc_mix: dict = None,
+    seed: int = 0,
+    little_endian: bool = True,
+) -> dict:
+    """Write a valid synthetic bank, identical for identical arguments
+
+    Payloads are random bytes laid out with the 16-byte alignment of real
+    banks and written as they are generated, so large banks do not have to
+    fit in memory. Returns a summary of the generated bank"""
+    rnd = random.Random(seed)
+    fmt = "<" if little_endian else ">"
+    hirc_mix = DEFAULT_HIRC_MIX if hirc_mix is None else hirc_mix
+    wem_ids = sorted(rnd.sample(range(1, 1 << 31), wem_count))
+    sizes = get_payload_sizes(rnd, wem_count, min_size, max_size, distribution)
+    offsets = []
+    data_size = 0
+    for size in sizes:
+        data_size = align(data_size)
+        offsets.append(data_size)
+        data_size += size
+    objects = make_hirc_objects(rnd, wem_ids, sizes, hirc_mix, fmt)
+    hirc_size = 4 + sum(9 + len(body) for _, _, body in objects)
+
+    out = OutputStream(bnk, little_endian)
+    try:
+        out.write_str("BKHD")
+        out.write_int(16)
+        out.write_ints((0x71, seed & 0xFFFFFFFF, 0, 0))
+        out.write_str("DIDX")
+        out.write_int(12 * wem_count)
+        out.write_ints(
+            value for entry in zip(wem_ids, offsets, sizes) for value in entry
+        )
+        out.write_str("DATA")
+        out.write_int(data_size)
+        pos = 0
+        for offset, size in zip(offsets, sizes):
+            out.write_zeros(offset - pos)
+            out.write_bytes(rnd.randbytes(size))
+            pos = offset + size
+        out.write_str("HIRC")
+        out.write_int(hirc_size)
+        out.write_int(len(objects))
+        for section_type, wwise_id, body in objects:
+            out.write_bytes(
+                struct.pack(fmt + "BII", section_type, len(body) + 4, wwise_id)
+            )
+            out.write_bytes(body)
+    finally:
+        out.close()
+    return {
+        "bank": bnk,
+        "wem_count": wem_count,
+        "data_size": data_size,
+        "hirc_count": len(objects),
+        "wem_ids": wem_ids,
+    }
@@ -2,12 +2,36 @@
 
 import tkinter as tk
 import os
+import queue
+import tempfile
+import threading
+from itertools import islice
 from typing import Callable, Any
 from tkinter import ttk, filedialog, messagebox
 from pygame import mixer
 from PIL import Image, ImageTk
-from modules.bnkwizard import BNKWizard
-from modules.audioutils import play_wem_audio, stop_wem_audio, save_wem_to_file
+from modules.bnkwizard import BNKWizard, LoadCancelled
+from modules.audioutils import (
+    AudioPlayer,
+    save_wem_to_file,
+    set_conversion_cache,
+)
+from modules.blobstore import set_spill_budget
+from modules.cache import ConversionCache
+from modules.indexcache import IndexCache, set_index_cache
+from modules.query import parse_query
+
+LOAD_POLL_MS = 20
+TREE_PAGE_ROWS = 200
+# Materialise the next page once the view is scrolled past this fraction
+TREE_PAGE_THRESHOLD = 0.9
+# Replacement WEMs kept in memory, the rest spills to a scratch file
+SPILL_BUDGET = 512 << 20
+
+
+def format_size(size: int) -> str:
+    """Format a size in bytes for the WEM tree"""
+    return str(round(size / 2**10, 2)) + " KB"
 
 
 class UserInterfaceElements:
@@ -82,6 +106,14 @@ class Application:
 
     def __init__(self):
         mixer.init()
+        set_conversion_cache(
+            ConversionCache(os.path.join(tempfile.gettempdir(), "bnkwizard-cache"))
+        )
+        set_index_cache(
+            IndexCache(os.path.join(tempfile.gettempdir(), "bnkwizard-index"))
+        )
+        set_spill_budget(SPILL_BUDGET)
+        self.player = AudioPlayer()
         self.bnkwizard = BNKWizard()
         ui_elem = UserInterfaceElements()
         self.root = ui_elem.create_root("BNK Wizard")
@@ -110,6 +142,14 @@ class Application:
             disabled=True,
         )
         self.all_btns["save"].grid(row=0, column=2, pady=(10, 10))
+        self.all_btns["saveall"] = ui_elem.create_button(
+            self.root,
+            text="Save All",
+            image=ui_elem.load_image(file="assets\\save.png", size=16),
+            command=self.save_all_wems,
+            disabled=True,
+        )
+        self.all_btns["saveall"].grid(row=1, column=4, pady=(10, 10))
         self.all_btns["replace"] = ui_elem.create_button(
             self.root,
             text="Replace",
@@ -138,7 +178,7 @@ class Application:
             self.root,
             text="Stop",
             image=ui_elem.load_image(file="assets\\stop.png", size=16),
-            command=stop_wem_audio,
+            command=self.stop_audio,
             disabled=True,
         )
         self.all_btns["stop"].grid(row=1, column=2, pady=(10, 10))
@@ -157,6 +197,33 @@ class Application:
         top_wem_sep.grid(
             row=2, column=0, columnspan=8, sticky=tk.NSEW, padx=(5, 5), pady=(5, 5)
         )
+        self.load_cancel = None
+        self.load_queue = None
+        # Bumped by every load, extraction and cancel, so the messages of a
+        # cancelled worker are dropped
+        self.load_generation = 0
+        self.tree_rows = {}
+        self.progress_bar = ttk.Progressbar(self.root, maximum=100)
+        self.progress_bar.grid(row=3, column=0, columnspan=2, sticky=tk.EW, padx=10)
+        self.progress_lbl = ui_elem.create_label(self.root, text="")
+        self.progress_lbl.grid(row=3, column=2, sticky=tk.W)
+        self.cancel_btn = ui_elem.create_button(
+            self.root,
+            text="Cancel",
+            image=ui_elem.load_image(file="assets\\clear.png", size=16),
+            command=self.cancel_loading,
+            disabled=True,
+        )
+        self.cancel_btn.grid(row=3, column=3)
+        self.repl_files = {}
+        self.search_var = tk.StringVar(self.root)
+        self.search_var.trace_add("write", lambda *_: self.apply_search())
+        search_lbl = ui_elem.create_label(self.root, text="Search")
+        search_lbl.grid(row=4, column=0, sticky=tk.E, pady=(10, 0))
+        search_entry = ttk.Entry(self.root, textvariable=self.search_var)
+        search_entry.grid(
+            row=4, column=1, columnspan=3, sticky=tk.EW, padx=(10, 0), pady=(10, 0)
+        )
         self.wem_tree = ui_elem.create_tree(
             self.root,
             columns=[
@@ -171,15 +238,19 @@ class Application:
         self.wem_tree.column("orig_size", anchor=tk.E)
         self.wem_tree.column("repl_size", anchor=tk.E)
         self.wem_tree.grid(
-            row=4, column=0, columnspan=4, sticky=tk.NSEW, padx=(10, 0), pady=(10, 10)
+            row=5, column=0, columnspan=4, sticky=tk.NSEW, padx=(10, 0), pady=(10, 10)
         )
 
         wem_scrollbar = ttk.Scrollbar(
             self.root, orient=tk.VERTICAL, command=self.wem_tree.yview
         )
-        self.wem_tree.configure(yscroll=wem_scrollbar.set)
+        self.wem_tree.configure(
+            yscroll=lambda first, last: self.scroll_tree(
+                self.wem_tree, wem_scrollbar, first, last
+            )
+        )
         self.wem_tree.bind("<<TreeviewSelect>>", self.enable_play_repl_button)
-        wem_scrollbar.grid(row=4, column=4, sticky=tk.NS, padx=(0, 10), pady=(10, 10))
+        wem_scrollbar.grid(row=5, column=4, sticky=tk.NS, padx=(0, 10), pady=(10, 10))
         for i in range(self.root.grid_size()[0]):
             self.root.grid_columnconfigure(i, weight=1)
         self.wwise_tree = ui_elem.create_tree(
@@ -192,13 +263,18 @@ class Application:
             headings=["ID", "Section Type", "Section Name"],
         )
         self.wwise_tree.grid(
-            row=5, column=0, columnspan=4, sticky=tk.NSEW, padx=(10, 0), pady=(10, 10)
+            row=6, column=0, columnspan=4, sticky=tk.NSEW, padx=(10, 0), pady=(10, 10)
         )
         wwise_scrollbar = ttk.Scrollbar(
             self.root, orient=tk.VERTICAL, command=self.wwise_tree.yview
         )
-        self.wwise_tree.configure(yscroll=wwise_scrollbar.set)
-        wwise_scrollbar.grid(row=5, column=4, sticky=tk.NS, padx=(0, 10), pady=(10, 10))
+        self.wwise_tree.configure(
+            yscroll=lambda first, last: self.scroll_tree(
+                self.wwise_tree, wwise_scrollbar, first, last
+            )
+        )
+        self.wwise_tree.bind("<<TreeviewOpen>>", self.expand_wwise_row)
+        wwise_scrollbar.grid(row=6, column=4, sticky=tk.NS, padx=(0, 10), pady=(10, 10))
         self.root.resizable(False, False)
         self.root.mainloop()
 
@@ -208,56 +284,201 @@ class Application:
             filetypes=[("WWise Bank Files", ".bnk")]
         )
         if src_bnkfile != "":
-            for item in self.wem_tree.get_children():
-                self.wem_tree.delete(item)
+            self.cancel_loading()
+            self.tree_rows = {}
+            self.repl_files = {}
+            for tree in (self.wem_tree, self.wwise_tree):
+                tree.delete(*tree.get_children())
             self.bnkwizard = BNKWizard()
-            for btn_name, btn in self.all_btns.items():
-                if btn_name != "playr":
-                    btn["state"] = tk.NORMAL
-            self.bnkwizard.read_bnk(src_bnkfile, True)
-            for itr, wem_id in enumerate(self.bnkwizard.wem_list.wem_ids):
-                self.wem_tree.insert(
-                    "",
-                    tk.END,
-                    iid=wem_id,
-                    values=(
-                        wem_id,
-                        str(itr + 1).zfill(len(str(self.bnkwizard.wem_list.wem_count)))
-                        + ".bnk",
-                        str(
-                            round(
-                                self.bnkwizard.wem_list.get_wem(wem_id).size / 2**10,
-                                2,
-                            )
-                        )
-                        + " KB",
-                        "",
-                        "",
-                    ),
-                )
-            for itr, wwise_id in enumerate(self.bnkwizard.wwise_list.wwise_ids):
-                wwise_obj = self.bnkwizard.wwise_list.get_wwise(wwise_id)
-                self.wwise_tree.insert(
-                    "",
-                    tk.END,
-                    iid=wwise_id,
-                    values=(
-                        wwise_id,
-                        wwise_obj.section_type,
-                        wwise_obj.get_name(),
-                    ),
-                    open=False,
+            for btn in self.all_btns.values():
+                btn["state"] = tk.DISABLED
+            self.load_cancel = threading.Event()
+            self.load_queue = queue.Queue()
+            self.load_generation += 1
+            self.progress_bar["value"] = 0
+            self.progress_lbl["text"] = "Loading " + os.path.basename(src_bnkfile)
+            self.cancel_btn["state"] = tk.NORMAL
+            threading.Thread(
+                target=self.load_bnk_worker,
+                args=(src_bnkfile, self.load_cancel, self.load_queue),
+                daemon=True,
+            ).start()
+            self.root.after(
+                LOAD_POLL_MS, self.poll_loading, self.load_queue, self.load_generation
+            )
+
+    def load_bnk_worker(
+        self, src_bnkfile: str, cancel: threading.Event, load_queue: queue.Queue
+    ):
+        """Read the bank on a worker thread, reporting through the queue"""
+
+        def progress(header: str):
+            if cancel.is_set():
+                raise LoadCancelled()
+            load_queue.put(("progress", header))
+
+        bnkwizard = BNKWizard()
+        try:
+            bnkwizard.read_bnk(src_bnkfile, True, use_mmap=True, progress=progress)
+            # Built here so the first search and the first selection, which
+            # shows the users of a WEM, do not stall the Tk thread
+            bnkwizard.query.build()
+            bnkwizard.references.build()
+        except LoadCancelled:
+            load_queue.put(("cancelled", None))
+            return
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # Anything else would leave the UI waiting for the worker forever
+            load_queue.put(("error", f"Could not load the bank: {err}"))
+            return
+        load_queue.put(("loaded", bnkwizard))
+
+    def poll_loading(self, load_queue: queue.Queue, generation: int):
+        """Handle the messages of the loading worker on the Tk thread, until
+        it is done or was cancelled"""
+        if generation != self.load_generation:
+            return
+        while not load_queue.empty():
+            message, value = load_queue.get()
+            if message == "progress":
+                # Banks may have more than the four usual sections
+                self.progress_bar["value"] = min(100, self.progress_bar["value"] + 25)
+                self.progress_lbl["text"] = "Read " + value + " section"
+            elif message == "loaded":
+                self.bnkwizard = value
+                for btn_name, btn in self.all_btns.items():
+                    if btn_name != "playr":
+                        btn["state"] = tk.NORMAL
+                self.finish_loading(
+                    f"Loaded {self.bnkwizard.wem_list.wem_count} WEMs and "
+                    f"{len(self.bnkwizard.wwise_list.wwise_ids)} HIRC objects"
                 )
-                wwise_metadata = wwise_obj.get_metadata()
-                for meta_id, meta_value in wwise_metadata.items():
-                    self.wwise_tree.insert(
-                        wwise_id,
-                        tk.END,
-                        values=(
-                            meta_id,
-                            str(meta_value),
-                        ),
+                if self.search_var.get().strip():
+                    self.apply_search()
+                else:
+                    self.show_rows(
+                        range(self.bnkwizard.wem_list.wem_count),
+                        range(len(self.bnkwizard.wwise_list.wwise_ids)),
                     )
+                return
+            else:
+                self.finish_loading(
+                    "Loading cancelled" if message == "cancelled" else value
+                )
+                return
+        self.root.after(LOAD_POLL_MS, self.poll_loading, load_queue, generation)
+
+    def apply_search(self):
+        """Show the rows matching the search box, as it is typed"""
+        if self.bnkwizard.query is None:
+            # No bank loaded yet, it is applied once loading is done
+            return
+        try:
+            wem_filter, wwise_filter = parse_query(self.search_var.get())
+        except ValueError as err:
+            self.progress_lbl["text"] = str(err)
+            return
+        wem_positions = self.bnkwizard.query.find_wems(wem_filter)
+        wwise_positions = self.bnkwizard.query.find_wwise(wwise_filter)
+        self.show_rows(wem_positions, wwise_positions)
+        self.progress_lbl["text"] = (
+            f"Found {len(wem_positions)} WEMs and "
+            f"{len(wwise_positions)} HIRC objects"
+        )
+
+    def show_rows(self, wem_positions, wwise_positions):
+        """Replace the rows of both trees with the WEMs and HIRC objects at
+        the given positions"""
+        self.tree_rows = {
+            self.wem_tree: self.iter_wem_rows(wem_positions),
+            self.wwise_tree: self.iter_wwise_rows(wwise_positions),
+        }
+        for tree in list(self.tree_rows):
+            tree.delete(*tree.get_children())
+            self.fill_tree_page(tree)
+
+    def iter_wem_rows(self, positions):
+        """Yield the (iid, values, expandable) rows of the WEM tree"""
+        wem_list = self.bnkwizard.wem_list
+        id_width = len(str(wem_list.wem_count))
+        for pos in positions:
+            wem_id = wem_list.wem_ids[pos]
+            repl_file = self.repl_files.get(wem_id)
+            yield wem_id, (
+                wem_id,
+                str(pos + 1).zfill(id_width) + ".bnk",
+                format_size(wem_list.sizes[pos]),
+                "" if repl_file is None else repl_file,
+                (
+                    ""
+                    if repl_file is None
+                    else format_size(wem_list.get_wem(wem_id, True).size)
+                ),
+            ), False
+
+    def iter_wwise_rows(self, positions):
+        """Yield the (iid, values, expandable) rows of the HIRC tree"""
+        wwise_list = self.bnkwizard.wwise_list
+        for pos in positions:
+            wwise_id = wwise_list.wwise_ids[pos]
+            wwise_obj = wwise_list.get_wwise(wwise_id)
+            yield wwise_id, (
+                wwise_id,
+                wwise_obj.section_type,
+                wwise_obj.get_name(),
+            ), wwise_obj.has_metadata()
+
+    def fill_tree_page(self, tree: ttk.Treeview):
+        """Materialise the next page of rows of a tree"""
+        rows = self.tree_rows.get(tree)
+        if rows is None:
+            return
+        inserted = 0
+        for iid, values, expandable in islice(rows, TREE_PAGE_ROWS):
+            tree.insert("", tk.END, iid=iid, values=values, open=False)
+            if expandable:
+                # Placeholder child so the row can be expanded, its metadata
+                # is only decoded once it is opened
+                tree.insert(iid, tk.END, iid=f"{iid}:placeholder")
+            inserted += 1
+        if inserted < TREE_PAGE_ROWS:
+            del self.tree_rows[tree]
+
+    def scroll_tree(
+        self, tree: ttk.Treeview, scrollbar: ttk.Scrollbar, first: str, last: str
+    ):
+        """Update the scrollbar and materialise more rows near the end"""
+        scrollbar.set(first, last)
+        if float(last) >= TREE_PAGE_THRESHOLD and tree in self.tree_rows:
+            self.root.after_idle(self.fill_tree_page, tree)
+
+    def expand_wwise_row(self, _event):
+        """Insert the metadata of a HIRC object when its row is opened"""
+        item = self.wwise_tree.focus()
+        placeholder = f"{item}:placeholder"
+        if not self.wwise_tree.exists(placeholder):
+            return
+        self.wwise_tree.delete(placeholder)
+        wwise_obj = self.bnkwizard.wwise_list.get_wwise(int(item))
+        for meta_id, meta_value in wwise_obj.get_metadata().items():
+            self.wwise_tree.insert(item, tk.END, values=(meta_id, str(meta_value)))
+
+    def cancel_loading(self):
+        """Cancel loading the bank"""
+        if self.load_cancel is not None and not self.load_cancel.is_set():
+            self.load_cancel.set()
+            self.load_generation += 1
+            if self.bnkwizard.query is not None:
+                # An extraction was cancelled, the bank stays loaded
+                self.all_btns["saveall"]["state"] = tk.NORMAL
+            self.finish_loading("Loading cancelled")
+
+    def finish_loading(self, status: str):
+        """Reset the loading controls"""
+        self.all_btns["open"]["state"] = tk.NORMAL
+        self.cancel_btn["state"] = tk.DISABLED
+        self.progress_bar["value"] = 0
+        self.progress_lbl["text"] = status
 
     def save_wem(self):
         """Save wem to file"""
@@ -284,6 +505,88 @@ class Application:
             else:
                 messagebox.showerror("BNK Wizard", "Wrong filename given!")
 
+    def save_all_wems(self):
+        """Save the WEMs shown in the tree, all of them unless filtered by
+        the search box, to a directory"""
+        try:
+            wem_filter = parse_query(self.search_var.get())[0]
+        except ValueError as err:
+            messagebox.showerror("BNK Wizard", str(err))
+            return
+        out_dir = filedialog.askdirectory(mustexist=False)
+        if out_dir == "":
+            return
+        wav = messagebox.askyesno("BNK Wizard", "Decode the WEMs to wav?")
+        self.all_btns["saveall"]["state"] = tk.DISABLED
+        self.load_cancel = threading.Event()
+        self.load_queue = queue.Queue()
+        self.load_generation += 1
+        self.progress_bar["value"] = 0
+        self.progress_lbl["text"] = "Saving WEMs to " + out_dir
+        self.cancel_btn["state"] = tk.NORMAL
+        threading.Thread(
+            target=self.extract_worker,
+            args=(out_dir, wem_filter, wav, self.load_cancel, self.load_queue),
+            daemon=True,
+        ).start()
+        self.root.after(
+            LOAD_POLL_MS, self.poll_extracting, self.load_queue, self.load_generation
+        )
+
+    def extract_worker(
+        self,
+        out_dir: str,
+        wem_filter,
+        wav: bool,
+        cancel: threading.Event,
+        load_queue: queue.Queue,
+    ):
+        """Extract WEMs on a worker thread, reporting through the queue"""
+
+        def progress(done: int, total: int):
+            if cancel.is_set():
+                raise LoadCancelled()
+            load_queue.put(("progress", (done, total)))
+
+        try:
+            results = self.bnkwizard.extract_all(
+                out_dir, wem_filter=wem_filter, wav=wav, progress=progress
+            )
+        except LoadCancelled:
+            load_queue.put(("cancelled", None))
+            return
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            load_queue.put(("error", f"Could not save the WEMs: {err}"))
+            return
+        load_queue.put(("extracted", results))
+
+    def poll_extracting(self, load_queue: queue.Queue, generation: int):
+        """Handle the messages of the extraction worker on the Tk thread,
+        until it is done or was cancelled"""
+        if generation != self.load_generation:
+            return
+        while not load_queue.empty():
+            message, value = load_queue.get()
+            if message == "progress":
+                done, total = value
+                self.progress_bar["value"] = 100 * done // max(1, total)
+                self.progress_lbl["text"] = f"Saved {done} of {total} WEMs"
+                continue
+            self.all_btns["saveall"]["state"] = tk.NORMAL
+            if message == "extracted":
+                errors = sum(result.error is not None for result in value)
+                skipped = sum(result.skipped for result in value)
+                self.finish_loading(
+                    f"Saved {len(value) - errors - skipped} WEMs, "
+                    f"{skipped} up to date, {errors} failed"
+                )
+            else:
+                self.finish_loading(
+                    "Saving cancelled" if message == "cancelled" else value
+                )
+            return
+        self.root.after(LOAD_POLL_MS, self.poll_extracting, load_queue, generation)
+
     def enable_play_repl_button(self, event):
         """Enable replacement play button"""
         if event:
@@ -294,6 +597,23 @@ class Application:
                     self.all_btns["playr"]["state"] = tk.NORMAL
                 else:
                     self.all_btns["playr"]["state"] = tk.DISABLED
+                users = self.bnkwizard.references.get_wem_users(sel_id)
+                self.progress_lbl["text"] = (
+                    "Used by " + ", ".join(str(user) for user in sorted(users))
+                    if users
+                    else "Not used by any HIRC object"
+                )
+                self.prefetch_audio()
+
+    def prefetch_audio(self):
+        """Decode the selected wem and its neighbours in the background"""
+        focus = self.wem_tree.focus()
+        wem_list = self.bnkwizard.wem_list
+        wems = []
+        for item in (focus, self.wem_tree.next(focus), self.wem_tree.prev(focus)):
+            if item != "" and int(item) in wem_list.wem_id_idx_map:
+                wems.append(wem_list.get_wem(int(item), True))
+        self.player.prefetch(wems)
 
     def play_audio(self, repl=False):
         """Play selected audio"""
@@ -302,7 +622,11 @@ class Application:
             sel_id = sel_wem_data["values"][0]
             if sel_id in self.bnkwizard.wem_list.wem_ids:
                 wem_data = self.bnkwizard.wem_list.get_wem(sel_id, repl)
-                play_wem_audio(wem_data)
+                self.player.play(wem_data)
+
+    def stop_audio(self):
+        """Stop playing audio"""
+        self.player.stop()
 
     def add_wem_replacement(self):
         """Edit the selected wem"""
@@ -314,18 +638,16 @@ class Application:
                     filetypes=[("Audio Files", ".wem .wav .mp3 .ogg")]
                 )
                 if new_wemfile != "":
-                    self.bnkwizard.wem_list.make_replacement(sel_id, new_wemfile)
+                    try:
+                        self.bnkwizard.wem_list.make_replacement(sel_id, new_wemfile)
+                    except ValueError as err:
+                        messagebox.showerror("BNK Wizard", str(err))
+                        return
+                    self.repl_files[sel_id] = os.path.basename(new_wemfile)
                     new_wem_data = list(sel_wem_data)
-                    new_wem_data[3] = os.path.basename(new_wemfile)
-                    new_wem_data[4] = (
-                        str(
-                            round(
-                                self.bnkwizard.wem_list.get_wem(sel_id, True).size
-                                / 2**10,
-                                2,
-                            )
-                        )
-                        + " KB"
+                    new_wem_data[3] = self.repl_files[sel_id]
+                    new_wem_data[4] = format_size(
+                        self.bnkwizard.wem_list.get_wem(sel_id, True).size
                     )
                     self.wem_tree.item(
                         self.wem_tree.focus(), values=tuple(new_wem_data)
@@ -339,8 +661,10 @@ class Application:
             sel_id = sel_wem_data[0]
             if sel_id in self.bnkwizard.wem_list.rep_wem_ids:
                 self.bnkwizard.wem_list.remove_replacement(sel_id)
+                self.repl_files.pop(sel_id, None)
                 new_wem_data = list(sel_wem_data)
-                new_wem_data[2] = ""
+                new_wem_data[3] = ""
+                new_wem_data[4] = ""
                 self.wem_tree.item(self.wem_tree.focus(), values=tuple(new_wem_data))
                 self.all_btns["playr"]["state"] = tk.DISABLED
 
@@ -350,5 +674,12 @@ class Application:
             defaultextension=".bnk", filetypes=[("WWise Bank Files", ".bnk")]
         )
         if dst_bnkfile != "":
-            self.bnkwizard.write_bnk(dst_bnkfile, True)
+            # Queued prefetches hold views of the mapped bank, which must be
+            # gone for it to be overwritten on Windows
+            self.player.prefetch([])
+            try:
+                self.bnkwizard.write_bnk(dst_bnkfile, True)
+            except (OSError, ValueError) as err:
+                messagebox.showerror("BNK Wizard", str(err))
+                return
             messagebox.showinfo("BNK Wizard", "File Saved!")
@@ -0,0 +1,234 @@
+"""verify: Module to check the consistency of a bank and hash its WEMs"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from modules import profiling
+from modules.hashing import get_digest
+from modules.iostream import InputStream, get_struct
+from modules.layout import ALIGNMENT
+
+# Sections which may only appear once in a bank
+UNIQUE_SECTIONS = ("BKHD", "DIDX", "DATA", "HIRC")
+
+
+def hash_range(payloads, start: int, end: int) -> list:
+    """Hash payloads[start:end], one digest per payload"""
+    return [get_digest(payloads[idx]) for idx in range(start, end)]
+
+
+def hash_payloads(payloads, max_workers: int = None) -> list:
+    """Hash a sequence of payloads on max_workers threads (the number of
+    CPUs by default), returning one digest per payload in order
+
+    hashlib releases the GIL while hashing, so the threads hash payloads of
+    a mapped bank in parallel. Each thread gets one contiguous range of
+    payloads, which keeps the per-payload overhead down for small WEMs"""
+    max_workers = max_workers or os.cpu_count()
+    count = len(payloads)
+    step = -(-count // max_workers) if count else 1
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [
+            pool.submit(hash_range, payloads, start, min(count, start + step))
+            for start in range(0, count, step)
+        ]
+        return [digest for future in futures for digest in future.result()]
+
+
+def check_chunks(view: memoryview, little_endian: bool, errors: list) -> dict:
+    """Check the chunk headers tile the whole bank, returning the
+    header -> (offset, size) of the known sections"""
+    uint = get_struct(("<" if little_endian else ">") + "I")
+    sections = {}
+    pos = 0
+    while pos < len(view):
+        if pos + 8 > len(view):
+            errors.append({"error": f"Truncated chunk header at offset {pos}"})
+            break
+        header = bytes(view[pos : pos + 4]).decode(errors="replace")
+        size = uint.unpack_from(view, pos + 4)[0]
+        if pos + 8 + size > len(view):
+            errors.append(
+                {"error": f"The {header} section at offset {pos} is truncated"}
+            )
+            break
+        if not sections and header != "BKHD":
+            errors.append({"error": "The bank does not start with a BKHD section"})
+        if header in sections and header in UNIQUE_SECTIONS:
+            errors.append({"error": f"The bank has more than one {header} section"})
+        sections.setdefault(header, (pos + 8, size))
+        pos += 8 + size
+    if not sections:
+        errors.append({"error": "The bank is empty"})
+    return sections
+
+
+def check_didx(
+    view: memoryview, little_endian: bool, sections: dict, errors: list
+) -> list:
+    """Check the DIDX entries are unique, aligned, in order, do not overlap
+    and lie within the DATA section, returning them as (id, offset, size)"""
+    if "DIDX" not in sections:
+        if "DATA" in sections:
+            errors.append({"error": "The bank has a DATA section but no DIDX"})
+        return []
+    didx_pos, didx_size = sections["DIDX"]
+    if didx_size % 12 != 0:
+        errors.append(
+            {"error": f"The DIDX length {didx_size} is not a multiple of 12"}
+        )
+    entry = get_struct(("<" if little_endian else ">") + "III")
+    entries = [
+        entry.unpack_from(view, pos)
+        for pos in range(didx_pos, didx_pos + didx_size - 11, 12)
+    ]
+    if entries and "DATA" not in sections:
+        errors.append({"error": "The bank has WEMs but no DATA section"})
+        return entries
+    data_size = sections["DATA"][1] if "DATA" in sections else 0
+    seen = set()
+    end = 0
+    for wem_id, offset, size in entries:
+        if wem_id in seen:
+            errors.append({"id": wem_id, "error": "Duplicate WEM id"})
+        seen.add(wem_id)
+        if offset % ALIGNMENT:
+            errors.append(
+                {"id": wem_id, "error": f"Offset {offset} is not {ALIGNMENT}-aligned"}
+            )
+        if offset < end:
+            errors.append(
+                {
+                    "id": wem_id,
+                    "error": f"Offset {offset} overlaps the previous WEM, "
+                    f"which ends at {end}",
+                }
+            )
+        if offset + size > data_size:
+            errors.append(
+                {
+                    "id": wem_id,
+                    "error": f"Payload {offset}+{size} is past the end of "
+                    f"the DATA section ({data_size})",
+                }
+            )
+        end = max(end, offset + size)
+    if entries and data_size != entries[-1][1] + entries[-1][2]:
+        errors.append(
+            {
+                "error": f"The DATA length {data_size} does not end with the "
+                f"last WEM ({entries[-1][1] + entries[-1][2]})"
+            }
+        )
+    return entries
+
+
+def check_hirc(
+    view: memoryview, little_endian: bool, sections: dict, errors: list
+) -> int:
+    """Check the HIRC objects fill the section exactly and match its object
+    count, returning the count"""
+    if "HIRC" not in sections:
+        return 0
+    hirc_pos, hirc_size = sections["HIRC"]
+    if hirc_size < 4:
+        errors.append({"error": f"The HIRC length {hirc_size} is too short"})
+        return 0
+    uint = get_struct(("<" if little_endian else ">") + "I")
+    header = get_struct(("<" if little_endian else ">") + "BII")
+    num_wwise = uint.unpack_from(view, hirc_pos)[0]
+    end = hirc_pos + hirc_size
+    pos = hirc_pos + 4
+    for count in range(num_wwise):
+        if pos + header.size > end:
+            errors.append(
+                {
+                    "error": f"The HIRC section holds {count} objects, "
+                    f"{num_wwise} are declared"
+                }
+            )
+            return num_wwise
+        _, size, wwise_id = header.unpack_from(view, pos)
+        if size < 4 or pos + header.size + size - 4 > end:
+            errors.append(
+                {
+                    "id": wwise_id,
+                    "error": f"HIRC object of size {size} does not fit the section",
+                }
+            )
+            return num_wwise
+        pos += header.size + size - 4
+    if pos != end:
+        errors.append(
+            {
+                "error": f"The HIRC section has {end - pos} bytes after its "
+                f"{num_wwise} objects"
+            }
+        )
+    return num_wwise
+
+
+def verify_bank(
+    bnk: str,
+    little_endian: bool = True,
+    expected: dict = None,
+    max_workers: int = None,
+    checksums: bool = False,
+) -> dict:
+    """Check the structure of a bank and hash its WEMs
+
+    The chunk sizes, DIDX entries (order, alignment, bounds), DATA length
+    and HIRC object count are checked, then every payload is hashed on
+    max_workers threads over the memory-mapped bank. If expected maps WEM
+    ids to digests, the payloads are compared with them and missing or
+    unexpected WEMs reported. With checksums, the result includes the hex
+    digest of every WEM. Problems are listed under "errors" as
+    {"error": ...} dicts, with the "id" of the WEM or object if any"""
+    errors = []
+    # Empty files cannot be mapped
+    input_stream = InputStream(bnk, little_endian, os.path.getsize(bnk) > 0)
+    try:
+        with profiling.span("verify", bank=bnk):
+            if input_stream.is_mapped():
+                view = input_stream.get_view(0, input_stream.get_size())
+            else:
+                view = memoryview(b"")
+            with profiling.span("check structure"):
+                sections = check_chunks(view, little_endian, errors)
+                entries = check_didx(view, little_endian, sections, errors)
+                hirc_count = check_hirc(view, little_endian, sections, errors)
+            data_pos, data_size = sections.get("DATA", (0, 0))
+            payloads = [
+                view[data_pos + offset : data_pos + min(data_size, offset + size)]
+                for _, offset, size in entries
+            ]
+            with profiling.span("hash wems"):
+                digests = hash_payloads(payloads, max_workers)
+            del payloads, view
+    finally:
+        input_stream.close()
+    if expected is not None:
+        wem_ids = set()
+        for (wem_id, _, _), digest in zip(entries, digests):
+            wem_ids.add(wem_id)
+            if wem_id not in expected:
+                errors.append({"id": wem_id, "error": "Unexpected WEM"})
+            elif expected[wem_id] != digest:
+                errors.append({"id": wem_id, "error": "Payload does not match"})
+        errors.extend(
+            {"id": wem_id, "error": "Missing WEM"}
+            for wem_id in expected
+            if wem_id not in wem_ids
+        )
+    result = {
+        "bank": bnk,
+        "wem_count": len(entries),
+        "hirc_count": hirc_count,
+        "data_size": sections.get("DATA", (0, 0))[1],
+        "errors": errors,
+    }
+    if checksums:
+        result["checksums"] = {
+            str(wem_id): digest.hex()
+            for (wem_id, _, _), digest in zip(entries, digests)
+        }
+    return result
@@ -0,0 +1,160 @@
+"""workspace: Module to keep many banks open at once"""
+
+import os
+from dataclasses import dataclass, field
+from modules.bnkwizard import BNKWizard
+from modules.hashing import get_digest
+
+
+@dataclass(slots=True, eq=False)
+class StoredPayload:
+    """A payload of the store and how many WEMs of each bank reference it.
+    digest is None until another payload of the same size is added"""
+
+    view: memoryview
+    digest: bytes = None
+    owners: dict = field(default_factory=dict)
+
+
+class PayloadStore:
+    """Content-addressed store of WEM payloads shared by the open banks
+
+    Every distinct payload is kept once. Payloads are only hashed when
+    another payload of the same size is added, a payload of a unique size
+    cannot have a duplicate"""
+
+    def __init__(self):
+        # size -> the only payload of that size, not hashed
+        self.unhashed = {}
+        # (size, digest) -> payload
+        self.hashed = {}
+        # size -> number of hashed payloads of that size, payloads of these
+        # sizes are hashed as they are added
+        self.hashed_sizes = {}
+
+    def add(self, data: bytes, owner: str, copy: bool) -> StoredPayload:
+        """Add a payload referenced by owner, returns the stored payload
+        shared by every owner of the same content"""
+        size = len(data)
+        if size in self.unhashed:
+            stored = self.unhashed.pop(size)
+            stored.digest = get_digest(stored.view)
+            self.hashed[size, stored.digest] = stored
+            self.hashed_sizes[size] = 1
+        if size in self.hashed_sizes:
+            digest = get_digest(data)
+            stored = self.hashed.get((size, digest))
+            if stored is None:
+                stored = StoredPayload(memoryview(bytes(data) if copy else data))
+                stored.digest = digest
+                self.hashed[size, digest] = stored
+                self.hashed_sizes[size] += 1
+        else:
+            stored = StoredPayload(memoryview(bytes(data) if copy else data))
+            self.unhashed[size] = stored
+        stored.owners[owner] = stored.owners.get(owner, 0) + 1
+        return stored
+
+    def release(self, owner: str, payloads: list):
+        """Drop the references of owner to payloads, forgetting unreferenced
+        payloads"""
+        for stored in payloads:
+            if stored.owners.pop(owner, None) is None or stored.owners:
+                continue
+            size = len(stored.view)
+            if stored.digest is None:
+                del self.unhashed[size]
+                continue
+            del self.hashed[size, stored.digest]
+            self.hashed_sizes[size] -= 1
+            if not self.hashed_sizes[size]:
+                del self.hashed_sizes[size]
+
+    def get_stored_bytes(self) -> int:
+        """Bytes held by the store, each payload counted once"""
+        return sum(self.unhashed) + sum(size for size, _ in self.hashed)
+
+
+class Workspace:
+    """Holds many banks open at once
+
+    Each bank is a separate BNKWizard. Identical WEM payloads across banks
+    are served from one PayloadStore entry. With use_mmap the store keeps
+    zero-copy views of the first mapped bank containing a payload, and as
+    payloads are only hashed when another one has the same size, WEMs of a
+    unique size are never paged in. Without it, unique payloads are copied
+    into the store and each bank's DATA buffer is released"""
+
+    def __init__(self, use_mmap: bool = True):
+        self.use_mmap = use_mmap
+        self.banks = {}
+        self.payloads = {}
+        self.store = PayloadStore()
+
+    def get_key(self, bnk: str) -> str:
+        """Normalised path used as the key of a bank"""
+        return os.path.normcase(os.path.abspath(bnk))
+
+    def open_bank(self, bnk: str, little_endian: bool = True) -> BNKWizard:
+        """Open a bank, or return it if it is already open"""
+        key = self.get_key(bnk)
+        if key in self.banks:
+            return self.banks[key]
+        bnkwizard = BNKWizard()
+        bnkwizard.read_bnk(bnk, little_endian, self.use_mmap)
+        wem_list = bnkwizard.wem_list
+        payloads = [
+            self.store.add(wem_list.get_payload(idx), key, not self.use_mmap)
+            for idx in range(wem_list.wem_count)
+        ]
+        wem_list.set_payload_views([stored.view for stored in payloads])
+        self.banks[key] = bnkwizard
+        self.payloads[key] = payloads
+        return bnkwizard
+
+    def get_bank(self, bnk: str) -> BNKWizard:
+        """Get an open bank"""
+        return self.banks[self.get_key(bnk)]
+
+    def close_bank(self, bnk: str):
+        """Close a bank, release the payloads only it referenced and delete
+        the scratch file of its replacements"""
+        key = self.get_key(bnk)
+        self.banks.pop(key).wem_list.repl_store.close()
+        self.store.release(key, self.payloads.pop(key))
+
+    def get_bank_memory(self, bnk: str) -> dict:
+        """Memory accounting of one bank"""
+        key = self.get_key(bnk)
+        wem_list = self.banks[key].wem_list
+        payload_bytes, unique_bytes, counted = 0, 0, set()
+        for stored in self.payloads[key]:
+            size = len(stored.view)
+            payload_bytes += size
+            if list(stored.owners) == [key] and stored not in counted:
+                unique_bytes += size
+                counted.add(stored)
+        return {
+            "wem_count": wem_list.wem_count,
+            "payload_bytes": payload_bytes,
+            "unique_bytes": unique_bytes,
+            "shared_bytes": payload_bytes - unique_bytes,
+            "replacement_bytes": sum(
+                repl_wem.size for repl_wem in wem_list.repl_wems.values()
+            ),
+        }
+
+    def get_memory(self) -> dict:
+        """Memory accounting of every bank and of the whole workspace"""
+        banks = {key: self.get_bank_memory(key) for key in self.banks}
+        payload_bytes = sum(bank["payload_bytes"] for bank in banks.values())
+        stored_bytes = self.store.get_stored_bytes()
+        return {
+            "banks": banks,
+            "payload_bytes": payload_bytes,
+            "stored_bytes": stored_bytes,
+            "saved_bytes": payload_bytes - stored_bytes,
+            "replacement_bytes": sum(
+                bank["replacement_bytes"] for bank in banks.values()
+            ),
+        }
@@ -0,0 +1,416 @@
+"""
+Headless command line interface
+
+Never imports the UI modules, so it runs without a display, tkinter, PIL or
+pygame. Every command prints a JSON document to stdout.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from modules import audioutils, indexcache, profiling
+from modules.audioutils import set_conversion_cache
+from modules.bankdiff import apply_patch, diff_banks
+from modules.blobstore import set_spill_budget
+from modules.bnkwizard import BNKWizard
+from modules.cache import ConversionCache
+from modules.indexcache import IndexCache, set_index_cache
+from modules.profiling import Profiler, set_profiler
+from modules.query import parse_query
+from modules.verify import verify_bank
+
+
+def read_manifest(manifest: str) -> dict:
+    """Read a wem_id -> file manifest from a CSV or JSON file
+
+    CSV files have two columns, wem_id and file, with an optional header.
+    JSON files are either an object mapping ids to files or a list of
+    {"wem_id": ..., "file": ...} objects. Relative paths are resolved against
+    the manifest's directory"""
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    entries = []
+    with open(manifest, "r", encoding="utf-8", newline="") as manifest_file:
+        if manifest.lower().endswith(".json"):
+            data = json.load(manifest_file)
+            if isinstance(data, dict):
+                entries = list(data.items())
+            else:
+                entries = [(entry["wem_id"], entry["file"]) for entry in data]
+        else:
+            for row in csv.reader(manifest_file):
+                if len(row) < 2 or not row[0].strip().isdigit():
+                    continue
+                entries.append((row[0], row[1]))
+    return {
+        int(wem_id): os.path.join(base_dir, file.strip()) for wem_id, file in entries
+    }
+
+
+def list_bank(args: argparse.Namespace) -> dict:
+    """List the WEMs and HIRC objects of a bank"""
+    bnkwizard = BNKWizard()
+    # The DATA section is never touched to list a bank, unless the whole
+    # bank is read once to fill the index cache
+    headers = {"DIDX", "HIRC"} if args.hirc else {"DIDX"}
+    if indexcache.index_cache is not None:
+        headers = None
+    wem_filter, wwise_filter = parse_query(args.filter or "")
+    bnkwizard.read_bnk(args.bank, not args.big_endian, use_mmap=True, headers=headers)
+    wem_list = bnkwizard.wem_list
+    result = {
+        "bank": args.bank,
+        "wem_count": wem_list.wem_count,
+        "wems": [
+            {
+                "id": wem_list.wem_ids[pos],
+                "offset": wem_list.offsets[pos],
+                "size": wem_list.sizes[pos],
+            }
+            for pos in bnkwizard.query.find_wems(wem_filter)
+        ],
+    }
+    if args.hirc:
+        result["hirc"] = []
+        for wwise_id in bnkwizard.find_wwise(wwise_filter):
+            wwise_obj = bnkwizard.wwise_list.get_wwise(wwise_id)
+            result["hirc"].append(
+                {
+                    "id": wwise_id,
+                    "type": wwise_obj.section_type,
+                    "name": wwise_obj.get_name(),
+                    "size": wwise_obj.size,
+                }
+            )
+    return result
+
+
+def extract_bank(args: argparse.Namespace) -> dict:
+    """Extract WEMs of a bank to a directory"""
+    wem_filter = parse_query(args.filter)[0] if args.filter else None
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(args.bank, not args.big_endian, use_mmap=True)
+    results = bnkwizard.extract_all(
+        args.out_dir, args.ids, wem_filter, args.wav, args.jobs, force=args.force
+    )
+    return {
+        "bank": args.bank,
+        "extracted": [
+            {"id": result.wem_id, "file": result.file}
+            for result in results
+            if result.error is None and not result.skipped
+        ],
+        "skipped": [
+            {"id": result.wem_id, "file": result.file}
+            for result in results
+            if result.skipped
+        ],
+        "errors": [
+            {"id": result.wem_id, "error": result.error}
+            for result in results
+            if result.error is not None
+        ],
+    }
+
+
+def replace_bank(args: argparse.Namespace) -> dict:
+    """Replace WEMs of a bank from a manifest and write the result"""
+    little_endian = not args.big_endian
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(args.bank, little_endian, use_mmap=True)
+    wem_list = bnkwizard.wem_list
+    manifest = read_manifest(args.manifest)
+    failed = wem_list.make_replacements(manifest, args.jobs)
+    replaced = [
+        {"id": wem_id, "file": file}
+        for wem_id, file in manifest.items()
+        if wem_id not in failed
+    ]
+    errors = [
+        {"id": wem_id, "file": manifest[wem_id], "error": error}
+        for wem_id, error in failed.items()
+    ]
+    if errors and not args.keep_going:
+        # Nothing was written, the replacements which worked are dropped too
+        return {
+            "bank": args.bank,
+            "output": None,
+            "replaced": [],
+            "skipped": replaced,
+            "errors": errors,
+        }
+    result = {"bank": args.bank, "replaced": replaced, "errors": errors}
+    # Hashed before patching, as the bank is reloaded afterwards
+    expected = bnkwizard.hash_wems(args.jobs) if args.verify else None
+    if args.in_place:
+        result["output"] = args.bank
+        result["path"] = bnkwizard.patch_bnk(little_endian)
+    else:
+        result["output"] = args.output
+        bnkwizard.write_bnk(args.output, little_endian)
+    if args.verify:
+        add_verification(result, result["output"], expected, args)
+    return result
+
+
+def add_verification(result: dict, bnk: str, expected: dict, args: argparse.Namespace):
+    """Verify a bank written by a command against the expected WEM digests,
+    adding its problems to the errors of the result"""
+    verification = verify_bank(bnk, not args.big_endian, expected, args.jobs)
+    result["verify"] = {
+        key: value for key, value in verification.items() if key != "errors"
+    }
+    result["errors"] = result.get("errors", []) + verification["errors"]
+
+
+def repack_bank(args: argparse.Namespace) -> dict:
+    """Read a bank and write it back out"""
+    little_endian = not args.big_endian
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(args.bank, little_endian, use_mmap=True)
+    bnkwizard.write_bnk(args.output, little_endian)
+    result = {"bank": args.bank, "output": args.output}
+    if args.verify:
+        add_verification(result, args.output, bnkwizard.hash_wems(args.jobs), args)
+    return result
+
+
+def verify_bank_file(args: argparse.Namespace) -> dict:
+    """Check the consistency of a bank, optionally against checksums"""
+    expected = None
+    if args.expect:
+        with open(args.expect, "r", encoding="utf-8") as expect_file:
+            expected = {
+                int(wem_id): bytes.fromhex(digest)
+                for wem_id, digest in json.load(expect_file).items()
+            }
+    result = verify_bank(
+        args.bank, not args.big_endian, expected, args.jobs, bool(args.checksums)
+    )
+    if args.checksums:
+        with open(args.checksums, "w", encoding="utf-8") as checksums_file:
+            json.dump(result.pop("checksums"), checksums_file, indent=2)
+        result["checksums"] = args.checksums
+    return result
+
+
+def diff_bank(args: argparse.Namespace) -> dict:
+    """Write a patch turning one bank into another"""
+    stats = diff_banks(args.base, args.target, args.output, not args.big_endian)
+    return {
+        "base": args.base,
+        "target": args.target,
+        "output": args.output,
+        "patch_size": os.path.getsize(args.output),
+        **stats,
+    }
+
+
+def apply_bank_patch(args: argparse.Namespace) -> dict:
+    """Rebuild a bank from a base bank and a patch"""
+    result = apply_patch(args.base, args.patch, args.output, not args.no_verify)
+    return {"base": args.base, "patch": args.patch, "output": args.output, **result}
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """Create the argument parser"""
+    parser = argparse.ArgumentParser(
+        prog="bnkwizard", description="Edit WWise Bank sound files"
+    )
+    parser.add_argument(
+        "--big-endian", action="store_true", help="Read and write big endian banks"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of concurrent audio conversions (default: CPU count)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("BNKWIZARD_CACHE_DIR"),
+        help="Cache audio conversions in this directory "
+        "(default: $BNKWIZARD_CACHE_DIR, disabled if unset)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="Size limit of the conversion cache in MiB (default: 1024)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        metavar="MIB",
+        help="Keep at most MIB MiB of replacement WEMs in memory, spilling the "
+        "rest to a scratch file (default: no limit)",
+    )
+    parser.add_argument(
+        "--spill-dir",
+        default=None,
+        metavar="DIR",
+        help="Directory of the scratch file of --memory-budget "
+        "(default: the temp directory)",
+    )
+    parser.add_argument(
+        "--index-cache",
+        nargs="?",
+        const="",
+        default=os.environ.get("BNKWIZARD_INDEX_DIR"),
+        metavar="DIR",
+        help="Reuse parsed bank indexes, stored in DIR or next to each bank as "
+        "BANK.idx (default: $BNKWIZARD_INDEX_DIR, disabled if unset)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Add timings of every stage and I/O counters to the result",
+    )
+    parser.add_argument(
+        "--profile-trace",
+        metavar="FILE",
+        help="Write a Chrome trace-event JSON profile to FILE",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List the WEMs of a bank")
+    list_parser.add_argument("bank")
+    list_parser.add_argument(
+        "--hirc", action="store_true", help="Also list the HIRC objects"
+    )
+    list_parser.add_argument(
+        "--filter",
+        metavar="QUERY",
+        help='Only list matching entries, e.g. "123 size:1k-64k type:2 '
+        'fetch:streamed"',
+    )
+    list_parser.set_defaults(func=list_bank)
+
+    extract_parser = subparsers.add_parser("extract", help="Extract WEMs")
+    extract_parser.add_argument("bank")
+    extract_parser.add_argument("out_dir")
+    extract_parser.add_argument(
+        "--ids", type=int, nargs="+", help="Only extract these WEM ids"
+    )
+    extract_parser.add_argument(
+        "--filter",
+        metavar="QUERY",
+        help="Only extract the WEMs matching a search, see list --filter",
+    )
+    extract_parser.add_argument(
+        "--wav", action="store_true", help="Decode to wav instead of raw wem"
+    )
+    extract_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract every WEM again, even if its file is up to date",
+    )
+    extract_parser.set_defaults(func=extract_bank)
+
+    replace_parser = subparsers.add_parser(
+        "replace", help="Replace WEMs from a CSV/JSON manifest"
+    )
+    replace_parser.add_argument("bank")
+    replace_parser.add_argument("manifest")
+    output_group = replace_parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument("-o", "--output", help="Write the new bank here")
+    output_group.add_argument(
+        "--in-place",
+        action="store_true",
+        help="Patch the bank in place, rewriting it if needed",
+    )
+    replace_parser.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Write the bank even if some replacements failed",
+    )
+    replace_parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the written bank holds the expected WEMs",
+    )
+    replace_parser.set_defaults(func=replace_bank)
+
+    repack_parser = subparsers.add_parser("repack", help="Rewrite a bank")
+    repack_parser.add_argument("bank")
+    repack_parser.add_argument("-o", "--output", required=True)
+    repack_parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the written bank holds the expected WEMs",
+    )
+    repack_parser.set_defaults(func=repack_bank)
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="Check the consistency of a bank and hash its WEMs"
+    )
+    verify_parser.add_argument("bank")
+    verify_parser.add_argument(
+        "--checksums", metavar="FILE", help="Write the WEM checksums to FILE"
+    )
+    verify_parser.add_argument(
+        "--expect",
+        metavar="FILE",
+        help="Compare the WEMs with checksums written by --checksums",
+    )
+    verify_parser.set_defaults(func=verify_bank_file)
+
+    diff_parser = subparsers.add_parser(
+        "diff", help="Write a patch turning a base bank into a target bank"
+    )
+    diff_parser.add_argument("base")
+    diff_parser.add_argument("target")
+    diff_parser.add_argument("-o", "--output", required=True)
+    diff_parser.set_defaults(func=diff_bank)
+
+    apply_parser = subparsers.add_parser(
+        "apply", help="Rebuild a bank from a base bank and a patch"
+    )
+    apply_parser.add_argument("base")
+    apply_parser.add_argument("patch")
+    apply_parser.add_argument("-o", "--output", required=True)
+    apply_parser.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="Do not check the base bank against the patch before applying it",
+    )
+    apply_parser.set_defaults(func=apply_bank_patch)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    """Entry point of the bnkwizard command"""
+    args = create_parser().parse_args(argv)
+    if args.cache_dir:
+        set_conversion_cache(ConversionCache(args.cache_dir, args.cache_size << 20))
+    if args.index_cache is not None:
+        set_index_cache(IndexCache(args.index_cache or None))
+    if args.memory_budget is not None:
+        set_spill_budget(args.memory_budget << 20, args.spill_dir)
+    if args.profile or args.profile_trace:
+        set_profiler(Profiler())
+    try:
+        with profiling.span(args.command):
+            result = args.func(args)
+    except (IOError, ValueError) as err:
+        json.dump({"error": str(err)}, sys.stdout)
+        sys.stdout.write("\n")
+        return 1
+    if audioutils.conversion_cache is not None:
+        result["cache"] = audioutils.conversion_cache.get_stats()
+    if indexcache.index_cache is not None:
+        result["index_cache"] = indexcache.index_cache.get_stats()
+    if profiling.profiler is not None:
+        if args.profile:
+            result["profile"] = profiling.profiler.get_report()
+        if args.profile_trace:
+            profiling.profiler.write_chrome_trace(args.profile_trace)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 1 if result.get("errors") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Tests of bank diffs and patches"""
+
+import struct
+import pytest
+from modules.bankdiff import apply_patch, diff_banks
+from modules.bnkwizard import BNKWizard
+from modules.synthetic import make_synthetic_bank
+
+
+@pytest.fixture(name="banks")
+def fixture_banks(tmp_path):
+    """A base bank and a target bank with replaced, resized and edited
+    entries plus an extra chunk"""
+    base = tmp_path / "base.bnk"
+    target = tmp_path / "target.bnk"
+    wem_ids = make_synthetic_bank(str(base), 40)["wem_ids"]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(base))
+    bnkwizard.wem_list.set_replacement_data(wem_ids[5], b"x" * 333)
+    bnkwizard.wem_list.set_replacement_data(wem_ids[20], bytes(range(256)) * 40)
+    wwise_id = bnkwizard.wwise_list.wwise_ids[-1]
+    body = bytes(bnkwizard.wwise_list.get_wwise(wwise_id).data)
+    bnkwizard.replace_wwise_data(wwise_id, body[:-1] + bytes([body[-1] ^ 0xFF]))
+    bnkwizard.write_bnk(str(target))
+    with open(target, "ab") as target_file:
+        target_file.write(b"PLAT" + struct.pack("<I", 4) + b"abcd")
+    return base, target
+
+
+def test_patch_rebuilds_the_target(banks, tmp_path):
+    """Applying the diff of two banks to the base gives the target byte for
+    byte, storing far less than the target literally"""
+    base, target = banks
+    patch = tmp_path / "bank.patch"
+    output = tmp_path / "out.bnk"
+    stats = diff_banks(str(base), str(target), str(patch))
+    assert stats["data_bytes"] < target.stat().st_size // 2
+    assert stats["copy_bytes"] > 0
+    apply_patch(str(base), str(patch), str(output))
+    assert output.read_bytes() == target.read_bytes()
+
+
+def test_identical_banks_only_copy(banks, tmp_path):
+    """The diff of a bank with itself copies everything"""
+    base, _ = banks
+    patch = tmp_path / "bank.patch"
+    output = tmp_path / "out.bnk"
+    stats = diff_banks(str(base), str(base), str(patch))
+    assert stats["copy_bytes"] > 0 and stats["data_bytes"] < 64
+    apply_patch(str(base), str(patch), str(output))
+    assert output.read_bytes() == base.read_bytes()
+
+
+def test_patch_refuses_another_base(banks, tmp_path):
+    """A patch applied to a bank other than its base fails without writing
+    the output"""
+    base, target = banks
+    patch = tmp_path / "bank.patch"
+    output = tmp_path / "out.bnk"
+    diff_banks(str(base), str(target), str(patch))
+    with pytest.raises(ValueError):
+        apply_patch(str(target), str(patch), str(output))
+    assert not output.exists()
@@ -0,0 +1,58 @@
+"""Tests of the replacement payload store and its spill file"""
+
+from modules import blobstore
+from modules.bnkwizard import BNKWizard
+from modules.blobstore import BlobStore
+from modules.iostream import OutputStream
+from modules.synthetic import make_synthetic_bank
+
+
+def test_spilled_payloads_round_trip(tmp_path):
+    """Payloads past the budget spill to the scratch file and read back
+    unchanged, through get and write_to"""
+    store = BlobStore(1000, str(tmp_path))
+    payloads = {key: bytes([key]) * (300 + key) for key in range(10)}
+    for key, payload in payloads.items():
+        store.put(key, payload)
+    stats = store.get_stats()
+    assert stats["memory_bytes"] <= 1000
+    assert stats["spilled_count"] == 10 - stats["memory_count"] > 0
+    for key, payload in payloads.items():
+        assert bytes(store.get(key)) == payload
+    out_path = tmp_path / "out.bin"
+    out = OutputStream(str(out_path))
+    for key in payloads:
+        store.write_to(key, out)
+    out.close()
+    assert out_path.read_bytes() == b"".join(payloads.values())
+    store.put(0, b"new")
+    assert bytes(store.get(0)) == b"new"
+    store.remove(1)
+    assert 1 not in store and len(store) == 9
+    store.close()
+    assert list(tmp_path.iterdir()) == [out_path]
+
+
+def test_bank_written_with_spilled_replacements(tmp_path, monkeypatch):
+    """A bank whose replacements mostly spilled is written and patched
+    with every replacement"""
+    monkeypatch.setattr(blobstore, "spill_budget", 4096)
+    monkeypatch.setattr(blobstore, "spill_dir", str(tmp_path))
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 40, min_size=1024)["wem_ids"]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank), use_mmap=True)
+    replacements = {
+        wem_id: bytes([pos]) * (1000 + pos) for pos, wem_id in enumerate(wem_ids)
+    }
+    for wem_id, payload in replacements.items():
+        bnkwizard.wem_list.set_replacement_data(wem_id, payload)
+    assert bnkwizard.wem_list.repl_store.get_stats()["spilled_count"] > 0
+    output = tmp_path / "out.bnk"
+    bnkwizard.write_bnk(str(output))
+    bnkwizard.patch_bnk()
+    for path in (output, bank):
+        reread = BNKWizard()
+        reread.read_bnk(str(path))
+        for wem_id, payload in replacements.items():
+            assert bytes(reread.wem_list.get_wem(wem_id).data) == payload
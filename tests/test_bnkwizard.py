@@ -0,0 +1,158 @@
+"""Tests of reading, writing and patching banks"""
+
+import errno
+import os
+import weakref
+import pytest
+from modules import indexcache
+from modules.bnkwizard import BNKWizard
+from modules.indexcache import IndexCache
+from modules.iostream import OutputStream
+from modules.synthetic import make_synthetic_bank
+
+
+def test_empty_bank_round_trip(tmp_path):
+    """A bank whose DIDX and DATA sections are empty is written back as is"""
+    bank = tmp_path / "empty.bnk"
+    output = tmp_path / "out.bnk"
+    make_synthetic_bank(str(bank), 0)
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    assert bnkwizard.wem_list.wem_count == 0
+    bnkwizard.write_bnk(str(output))
+    assert output.read_bytes() == bank.read_bytes()
+    bnkwizard.read_bnk(str(output))
+    assert bnkwizard.wem_list.wem_count == 0
+
+
+def test_patch_in_place(tmp_path):
+    """A replacement fitting its slot is patched in place"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 20)["wem_ids"]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    bnkwizard.wem_list.set_replacement_data(wem_ids[3], b"new")
+    assert bnkwizard.patch_bnk() == "patch"
+    assert bytes(bnkwizard.wem_list.get_wem(wem_ids[3]).data) == b"new"
+
+
+def test_patch_keeps_hirc_edits(tmp_path):
+    """Pending HIRC edits make patch_bnk rewrite the bank instead of
+    patching the WEMs only"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 20)["wem_ids"]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    wwise_id = bnkwizard.wwise_list.wwise_ids[0]
+    body = bytes(bnkwizard.wwise_list.get_wwise(wwise_id).data)
+    new_body = body[:-1] + bytes([body[-1] ^ 0xFF])
+    bnkwizard.replace_wwise_data(wwise_id, new_body)
+    bnkwizard.wem_list.set_replacement_data(wem_ids[3], b"new")
+    assert bnkwizard.wem_list.fits_in_place()
+    assert bnkwizard.patch_bnk() == "rewrite"
+    reread = BNKWizard()
+    reread.read_bnk(str(bank))
+    assert bytes(reread.wwise_list.get_wwise(wwise_id).data) == new_body
+    assert bytes(reread.wem_list.get_wem(wem_ids[3]).data) == b"new"
+
+
+def test_reference_graph_built_lazily(tmp_path, monkeypatch):
+    """The reference graph is only built on its first query, its edges are
+    then stored in the index cache and restored from it"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 20)["wem_ids"]
+    monkeypatch.setattr(indexcache, "index_cache", IndexCache(str(tmp_path / "idx")))
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    assert not bnkwizard.references.built
+    users = bnkwizard.references.get_wem_users(wem_ids[3])
+    assert users and bnkwizard.references.built
+    reread = BNKWizard()
+    reread.read_bnk(str(bank))
+    assert reread.references.flat_edges is not None
+    assert reread.references.get_wem_users(wem_ids[3]) == users
+
+
+def test_failed_write_leaves_no_temporary_file(tmp_path, monkeypatch):
+    """A write failing when flushing (e.g. a full disk) removes its
+    temporary file and leaves the destination untouched"""
+    bank = tmp_path / "bank.bnk"
+    make_synthetic_bank(str(bank), 20)
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+
+    def flush(_self):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(OutputStream, "flush", flush)
+    with pytest.raises(OSError):
+        bnkwizard.write_bnk(str(tmp_path / "out.bnk"))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["bank.bnk"]
+
+
+def test_rewrite_of_mapped_bank_releases_the_mapping(tmp_path, monkeypatch):
+    """A replacement too large for its slot rewrites the memory-mapped bank,
+    whose mapping is released before the rename as Windows requires"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 20)["wem_ids"]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank), use_mmap=True)
+    mapping = weakref.ref(bnkwizard.wem_list.data_buffer.obj)
+    neighbour = bytes(bnkwizard.wem_list.get_wem(wem_ids[4]).data)
+    new_payload = bytes(range(256)) * 64
+    bnkwizard.wem_list.set_replacement_data(wem_ids[3], new_payload)
+    assert not bnkwizard.wem_list.fits_in_place()
+    replace = os.replace
+
+    def checked_replace(src, dst):
+        if dst == str(bank):
+            assert mapping() is None
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", checked_replace)
+    assert bnkwizard.patch_bnk() == "rewrite"
+    assert bnkwizard.mapped
+    assert bytes(bnkwizard.wem_list.get_wem(wem_ids[3]).data) == new_payload
+    assert bytes(bnkwizard.wem_list.get_wem(wem_ids[4]).data) == neighbour
+
+
+@pytest.mark.parametrize("little_endian", [True, False])
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_write_round_trip_with_replacements(tmp_path, little_endian, use_mmap):
+    """Replacements larger and smaller than their slots are written with the
+    16-byte alignment, and every other WEM and HIRC object is kept"""
+    bank = tmp_path / "bank.bnk"
+    output = tmp_path / "out.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 50, little_endian=little_endian)[
+        "wem_ids"
+    ]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank), little_endian, use_mmap)
+    expected = {
+        wem_id: bytes(bnkwizard.wem_list.get_wem(wem_id).data) for wem_id in wem_ids
+    }
+    wwise_bodies = [
+        bytes(bnkwizard.wwise_list.get_wwise(wwise_id).data)
+        for wwise_id in bnkwizard.wwise_list.wwise_ids
+    ]
+    for wem_id, payload in (
+        (wem_ids[0], b"first" * 2000),
+        (wem_ids[17], b"x"),
+        (wem_ids[-1], bytes(range(256)) * 3),
+    ):
+        bnkwizard.wem_list.set_replacement_data(wem_id, payload)
+        expected[wem_id] = payload
+    bnkwizard.write_bnk(str(output), little_endian)
+
+    reread = BNKWizard()
+    reread.read_bnk(str(output), little_endian, use_mmap)
+    wem_list = reread.wem_list
+    assert list(wem_list.wem_ids) == wem_ids
+    assert all(offset % 16 == 0 for offset in wem_list.offsets)
+    for wem_id in wem_ids:
+        assert bytes(wem_list.get_wem(wem_id).data) == expected[wem_id]
+    assert [
+        bytes(reread.wwise_list.get_wwise(wwise_id).data)
+        for wwise_id in reread.wwise_list.wwise_ids
+    ] == wwise_bodies
+    assert reread.verify(str(output), little_endian)["errors"] == []
@@ -0,0 +1,33 @@
+"""Tests of the conversion cache"""
+
+from modules import cache
+from modules.cache import LOW_WATERMARK, ConversionCache
+
+
+def test_evicts_least_recently_used_to_low_watermark(tmp_path, monkeypatch):
+    """A full cache evicts down to the low watermark, keeping recent entries,
+    without walking the directory again"""
+    conversion_cache = ConversionCache(str(tmp_path), 10000)
+    keys = [conversion_cache.make_key(bytes([i]), "wav", "v") for i in range(30)]
+    monkeypatch.setattr(cache.os, "walk", None)
+    for key in keys:
+        conversion_cache.put(key, bytes(1000))
+        assert conversion_cache.get(keys[0]) is not None
+    stats = conversion_cache.get_stats()
+    assert stats["bytes"] <= 10000
+    assert conversion_cache.get(keys[1]) is None
+    assert conversion_cache.get(keys[-1]) is not None
+    monkeypatch.undo()
+    reopened = ConversionCache(str(tmp_path), 10000)
+    assert reopened.total_bytes == stats["bytes"]
+
+
+def test_put_under_the_limit_never_evicts(tmp_path):
+    """Entries are only evicted once the cache is over its limit"""
+    conversion_cache = ConversionCache(str(tmp_path), 10000)
+    for i in range(10):
+        key = conversion_cache.make_key(bytes([i]), "wav", "v")
+        conversion_cache.put(key, b"x" * 1000)
+    assert conversion_cache.get_stats()["evictions"] == 0
+    conversion_cache.put(conversion_cache.make_key(b"new", "wav", "v"), b"x" * 1000)
+    assert conversion_cache.total_bytes <= 10000 * LOW_WATERMARK
@@ -0,0 +1,77 @@
+"""Tests of WEM extraction and its resume manifest"""
+
+import pytest
+from modules.bnkwizard import BNKWizard
+from modules.extraction import RAW_BATCH_SIZE, load_manifest
+from modules.synthetic import make_synthetic_bank
+
+
+class Cancelled(Exception):
+    """Raised by a progress callback to cancel an extraction"""
+
+
+@pytest.fixture(name="bnkwizard")
+def fixture_bnkwizard(tmp_path):
+    """Synthetic bank of several extraction batches"""
+    bank = tmp_path / "bank.bnk"
+    make_synthetic_bank(str(bank), 8 * RAW_BATCH_SIZE, max_size=256)
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    return bnkwizard
+
+
+def skipped_ids(results: list) -> set:
+    """Ids of the WEMs an extraction skipped, checking none failed"""
+    assert all(result.error is None for result in results)
+    return {result.wem_id for result in results if result.skipped}
+
+
+def test_extraction_writes_payloads(bnkwizard, tmp_path):
+    """Every WEM is written as ID.wem with its payload, then skipped by the
+    next extraction"""
+    out_dir = tmp_path / "out"
+    wem_list = bnkwizard.wem_list
+    results = bnkwizard.extract_all(str(out_dir), max_workers=2)
+    assert [result.wem_id for result in results] == list(wem_list.wem_ids)
+    assert not skipped_ids(results)
+    for wem_id in wem_list.wem_ids:
+        payload = (out_dir / f"{wem_id}.wem").read_bytes()
+        assert payload == bytes(wem_list.get_wem(wem_id).data)
+    assert len(load_manifest(str(out_dir))) == wem_list.wem_count
+    results = bnkwizard.extract_all(str(out_dir), max_workers=2)
+    assert skipped_ids(results) == set(wem_list.wem_ids)
+
+
+def test_cancelled_extraction_resumes(bnkwizard, tmp_path):
+    """A cancelled extraction keeps the manifest of the files it wrote, and
+    the next one only writes the others"""
+    out_dir = tmp_path / "out"
+
+    def progress(done: int, _total: int):
+        if done >= 2 * RAW_BATCH_SIZE:
+            raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        bnkwizard.extract_all(str(out_dir), max_workers=2, progress=progress)
+    written = load_manifest(str(out_dir))
+    assert 2 * RAW_BATCH_SIZE <= len(written) < bnkwizard.wem_list.wem_count
+    results = bnkwizard.extract_all(str(out_dir), max_workers=2)
+    assert {f"{wem_id}.wem" for wem_id in skipped_ids(results)} == set(written)
+    assert len(load_manifest(str(out_dir))) == bnkwizard.wem_list.wem_count
+
+
+def test_changed_files_are_extracted_again(bnkwizard, tmp_path):
+    """Files changed or removed since they were extracted are written again,
+    and force writes every file"""
+    out_dir = tmp_path / "out"
+    wem_ids = bnkwizard.wem_list.wem_ids
+    bnkwizard.extract_all(str(out_dir))
+    (out_dir / f"{wem_ids[0]}.wem").write_bytes(b"changed")
+    (out_dir / f"{wem_ids[1]}.wem").unlink()
+    results = bnkwizard.extract_all(str(out_dir))
+    assert skipped_ids(results) == set(wem_ids[2:])
+    assert (out_dir / f"{wem_ids[0]}.wem").read_bytes() == bytes(
+        bnkwizard.wem_list.get_wem(wem_ids[0]).data
+    )
+    results = bnkwizard.extract_all(str(out_dir), force=True)
+    assert not skipped_ids(results)
@@ -0,0 +1,89 @@
+"""Tests of the parsed bank index cache"""
+
+import os
+import pytest
+from modules import indexcache
+from modules.bnkwizard import BNKWizard
+from modules.indexcache import INDEX_SUFFIX, IndexCache
+from modules.synthetic import make_synthetic_bank
+
+
+@pytest.fixture(name="bank")
+def fixture_bank(tmp_path):
+    """Synthetic bank read through a sidecar index cache"""
+    bank = tmp_path / "bank.bnk"
+    make_synthetic_bank(str(bank), 50)
+    return bank
+
+
+def read(bank) -> BNKWizard:
+    """Read a bank, fully"""
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    return bnkwizard
+
+
+def test_unchanged_bank_hits_the_cache(bank, tmp_path, monkeypatch):
+    """The second read of an unchanged bank takes its index from the cache
+    and the bank is written back identically"""
+    cache = IndexCache()
+    monkeypatch.setattr(indexcache, "index_cache", cache)
+    cold = read(bank)
+    assert os.path.exists(str(bank) + INDEX_SUFFIX)
+    warm = read(bank)
+    assert cache.get_stats() == {"hits": 1, "misses": 1}
+    assert warm.sections.chunks == cold.sections.chunks
+    assert warm.wem_list.wem_ids == cold.wem_list.wem_ids
+    assert warm.wem_list.offsets == cold.wem_list.offsets
+    assert warm.wem_list.sizes == cold.wem_list.sizes
+    assert warm.wwise_list.wwise_ids == cold.wwise_list.wwise_ids
+    assert warm.wwise_list.section_types == cold.wwise_list.section_types
+    output = tmp_path / "out.bnk"
+    warm.write_bnk(str(output))
+    assert output.read_bytes() == bank.read_bytes()
+
+
+def test_changed_bank_misses_the_cache(bank, monkeypatch):
+    """A bank changed since its index was stored is parsed again, even when
+    its size and mtime are kept"""
+    cache = IndexCache()
+    monkeypatch.setattr(indexcache, "index_cache", cache)
+    wem_list = read(bank).wem_list
+    bank_stat = os.stat(bank)
+    data = bytearray(bank.read_bytes())
+    data[wem_list.abs_offset + wem_list.offsets[0]] ^= 0xFF
+    bank.write_bytes(data)
+    os.utime(bank, ns=(bank_stat.st_atime_ns, bank_stat.st_mtime_ns))
+    read(bank)
+    assert cache.get_stats() == {"hits": 0, "misses": 2}
+    os.utime(bank, ns=(bank_stat.st_atime_ns, bank_stat.st_mtime_ns + 10**9))
+    read(bank)
+    assert cache.get_stats() == {"hits": 0, "misses": 3}
+    read(bank)
+    assert cache.get_stats() == {"hits": 1, "misses": 3}
+
+
+def test_corrupt_index_is_ignored(bank, monkeypatch):
+    """A truncated index file counts as a miss and is replaced"""
+    cache = IndexCache()
+    monkeypatch.setattr(indexcache, "index_cache", cache)
+    expected = read(bank).wem_list.wem_ids
+    index_path = str(bank) + INDEX_SUFFIX
+    with open(index_path, "r+b") as index_file:
+        index_file.truncate(os.path.getsize(index_path) // 2)
+    assert read(bank).wem_list.wem_ids == expected
+    assert read(bank).wem_list.wem_ids == expected
+    assert cache.get_stats() == {"hits": 1, "misses": 2}
+
+
+def test_shared_cache_directory(bank, tmp_path, monkeypatch):
+    """With a cache directory, indexes are stored there instead of next to
+    the bank"""
+    cache_dir = tmp_path / "indexes"
+    cache = IndexCache(str(cache_dir))
+    monkeypatch.setattr(indexcache, "index_cache", cache)
+    read(bank)
+    read(bank)
+    assert not os.path.exists(str(bank) + INDEX_SUFFIX)
+    assert len(os.listdir(cache_dir)) == 1
+    assert cache.get_stats() == {"hits": 1, "misses": 1}
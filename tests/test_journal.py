@@ -0,0 +1,76 @@
+"""Tests of journaled in-place patching"""
+
+import pytest
+from modules import journal
+from modules.journal import get_journal_path, patch_file, recover_journal
+
+
+class Crash(Exception):
+    """Simulated crash between patching a file and deleting its journal"""
+
+
+def crash_patch(monkeypatch, file: str, patches: list):
+    """Patch a file, crashing before the journal is deleted"""
+
+    def crash(path):
+        raise Crash(path)
+
+    with monkeypatch.context() as context:
+        context.setattr(journal.os, "remove", crash)
+        with pytest.raises(Crash):
+            patch_file(file, patches)
+
+
+def test_patch_file(tmp_path):
+    """Ranges are overwritten and the journal deleted"""
+    target = tmp_path / "bank.bnk"
+    target.write_bytes(bytes(range(256)) * 8)
+    patch_file(str(target), [(10, b"abc"), (1000, bytes(700))])
+    expected = bytearray(bytes(range(256)) * 8)
+    expected[10:13] = b"abc"
+    expected[1000:1700] = bytes(700)
+    assert target.read_bytes() == expected
+    assert not (tmp_path / "bank.bnk.journal").exists()
+
+
+def test_recover_interrupted_patch(tmp_path, monkeypatch):
+    """An interrupted patch is rolled back, even if torn mid-range"""
+    target = tmp_path / "bank.bnk"
+    original = bytes(range(256)) * 8
+    target.write_bytes(original)
+    crash_patch(monkeypatch, str(target), [(10, b"abc"), (1000, b"x" * 700)])
+    # Only the first blocks of the second range reached the disk
+    torn = bytearray(original)
+    torn[10:13] = b"abc"
+    torn[1000:1024] = b"x" * 24
+    target.write_bytes(torn)
+    assert recover_journal(str(target))
+    assert target.read_bytes() == original
+    assert not (tmp_path / "bank.bnk.journal").exists()
+
+
+def test_stale_journal_is_not_replayed(tmp_path, monkeypatch):
+    """A journal left by another file at the same path is discarded"""
+    target = tmp_path / "bank.bnk"
+    target.write_bytes(bytes(2048))
+    crash_patch(monkeypatch, str(target), [(100, b"patched")])
+    other = bytes(range(256)) * 8
+    target.write_bytes(other)
+    assert not recover_journal(str(target))
+    assert target.read_bytes() == other
+    assert not (tmp_path / "bank.bnk.journal").exists()
+    crash_patch(monkeypatch, str(target), [(100, b"patched")])
+    target.write_bytes(other + b"longer")
+    assert not recover_journal(str(target))
+    assert target.read_bytes() == other + b"longer"
+
+
+def test_incomplete_journal_is_discarded(tmp_path):
+    """A journal without its trailer means the file was never touched"""
+    target = tmp_path / "bank.bnk"
+    target.write_bytes(bytes(64))
+    with open(get_journal_path(str(target)), "wb") as journal_file:
+        journal_file.write(journal.JOURNAL_HEADER.pack(journal.JOURNAL_MAGIC, 2, 64))
+    assert not recover_journal(str(target))
+    assert target.read_bytes() == bytes(64)
+    assert not (tmp_path / "bank.bnk.journal").exists()
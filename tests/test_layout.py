@@ -0,0 +1,64 @@
+"""Tests of the incremental DATA layout"""
+
+import random
+from array import array
+from modules.iostream import UINT32_TYPECODE
+from modules.layout import ALIGNMENT, WemLayout, align
+
+
+def make_layout(rnd: random.Random, count: int) -> WemLayout:
+    """Layout of count WEMs of random sizes, packed as Wwise does"""
+    offsets = array(UINT32_TYPECODE)
+    sizes = array(UINT32_TYPECODE)
+    offset = 0
+    for _ in range(count):
+        offset = align(offset)
+        offsets.append(offset)
+        sizes.append(rnd.randint(1, 100))
+        offset += sizes[-1]
+    return WemLayout(offsets, sizes, offset)
+
+
+def check_layout(layout: WemLayout):
+    """Check the incremental layout against a full recompute"""
+    offsets, sizes = layout.recompute()
+    assert layout.get_final_columns() == (offsets, sizes)
+    for idx, offset in enumerate(offsets):
+        assert layout.get_offset(idx) == offset
+        assert layout.get_size(idx) == sizes[idx]
+    for idx in range(len(offsets) - 1):
+        # Every WEM starts aligned, after the padding of the previous one
+        assert offsets[idx + 1] % ALIGNMENT == 0
+        assert offsets[idx + 1] - offsets[idx] == (
+            align(sizes[idx]) if idx in layout.new_sizes else layout.slots[idx]
+        )
+    if len(offsets):
+        assert layout.get_data_size() == offsets[-1] + sizes[-1]
+
+
+def test_layout_matches_recompute():
+    """Random size changes and resets keep the layout equal to a recompute"""
+    rnd = random.Random(0)
+    for _ in range(100):
+        count = rnd.randint(1, 60)
+        layout = make_layout(rnd, count)
+        check_layout(layout)
+        for _ in range(rnd.randint(1, 30)):
+            idx = rnd.randrange(count)
+            if rnd.random() < 0.3:
+                layout.reset_size(idx)
+            else:
+                layout.set_size(idx, rnd.randint(1, 200))
+            check_layout(layout)
+
+
+def test_reset_restores_original_layout():
+    """Resetting every changed WEM gives back the original columns"""
+    layout = make_layout(random.Random(1), 20)
+    original = (array(UINT32_TYPECODE, layout.offsets), layout.sizes)
+    for idx in (0, 5, 19):
+        layout.set_size(idx, 300)
+    for idx in (0, 5, 19):
+        layout.reset_size(idx)
+    assert layout.recompute() == original
+    assert layout.get_final_columns() == original
@@ -0,0 +1,110 @@
+"""Tests of the WEM and HIRC object search"""
+
+import pytest
+from modules.bnkwizard import BNKWizard
+from modules.query import FETCH_TYPE_OFFSET, NO_FETCH_TYPE, parse_query
+from modules.synthetic import make_synthetic_bank
+
+QUERIES = (
+    "1",
+    "12",
+    "2",
+    "99999",
+    "21431278",
+    "size:1k-4k",
+    "size:-300",
+    "size:2k-",
+    "replaced",
+    "unreplaced",
+    "unreplaced 1",
+    "replaced size:-1k",
+    "type:2",
+    "type:4 2143128",
+    "fetch:embedded",
+    "fetch:streamed",
+    "fetch:prefetched 2143127",
+    "type:2 fetch:streamed",
+)
+
+
+@pytest.fixture(name="bnkwizard")
+def fixture_bnkwizard(tmp_path):
+    """Synthetic bank with a few replaced WEMs"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 300, max_size=8192)["wem_ids"]
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank))
+    for wem_id in wem_ids[::17]:
+        bnkwizard.wem_list.set_replacement_data(wem_id, b"new")
+    return bnkwizard
+
+
+def brute_force(bnkwizard: BNKWizard, text: str) -> (list, list):
+    """Ids of the WEMs and HIRC objects matching a query, checking every
+    entry"""
+    wem_filter, wwise_filter = parse_query(text)
+    wem_list, wwise_list = bnkwizard.wem_list, bnkwizard.wwise_list
+    wem_ids = []
+    for wem_id in wem_list.wem_ids:
+        size = len(wem_list.get_wem(wem_id, False).data)
+        if (
+            str(wem_id).startswith(wem_filter.id_prefix or "")
+            and (wem_filter.min_size is None or size >= wem_filter.min_size)
+            and (wem_filter.max_size is None or size <= wem_filter.max_size)
+            and wem_filter.replaced in (None, wem_id in wem_list.repl_wems)
+        ):
+            wem_ids.append(wem_id)
+    wwise_ids = []
+    for wwise_id in wwise_list.wwise_ids:
+        wwise_obj = wwise_list.get_wwise(wwise_id)
+        fetch_type = NO_FETCH_TYPE
+        if wwise_obj.section_type == 2:
+            fetch_type = wwise_obj.data[FETCH_TYPE_OFFSET]
+        if (
+            str(wwise_id).startswith(wwise_filter.id_prefix or "")
+            and wwise_filter.section_type in (None, wwise_obj.section_type)
+            and wwise_filter.fetch_type in (None, fetch_type)
+        ):
+            wwise_ids.append(wwise_id)
+    return wem_ids, wwise_ids
+
+
+def find(bnkwizard: BNKWizard, text: str) -> (list, list):
+    """Ids of the WEMs and HIRC objects matching a query, through the
+    indexes"""
+    wem_filter, wwise_filter = parse_query(text)
+    return bnkwizard.find_wems(wem_filter), bnkwizard.find_wwise(wwise_filter)
+
+
+@pytest.mark.parametrize("text", QUERIES)
+def test_query_matches_brute_force(bnkwizard, text):
+    """Every query finds the same entries, in the same order, as a scan"""
+    assert find(bnkwizard, text) == brute_force(bnkwizard, text)
+
+
+def test_query_follows_edits(bnkwizard):
+    """Replacements and fetch types changed after the indexes were built
+    are found by the next queries"""
+    bnkwizard.query.build()
+    wem_ids = bnkwizard.wem_list.wem_ids
+    bnkwizard.wem_list.set_replacement_data(wem_ids[1], b"newer")
+    wwise_list = bnkwizard.wwise_list
+    sound_ids = [
+        wwise_id
+        for wwise_id in wwise_list.wwise_ids
+        if wwise_list.get_wwise(wwise_id).section_type == 2
+    ]
+    for fetch_type, wwise_id in zip((1, 2, 1, 0), sound_ids[::40]):
+        body = bytearray(wwise_list.get_wwise(wwise_id).data)
+        body[FETCH_TYPE_OFFSET] = fetch_type
+        bnkwizard.replace_wwise_data(wwise_id, bytes(body))
+    assert len(find(bnkwizard, "fetch:streamed")[1]) == 2
+    for text in QUERIES:
+        assert find(bnkwizard, text) == brute_force(bnkwizard, text)
+
+
+def test_invalid_queries():
+    """Unknown terms and malformed sizes are rejected"""
+    for text in ("size:abc-", "size:10", "fetch:lost", "type:x", "12a"):
+        with pytest.raises(ValueError):
+            parse_query(text)
@@ -0,0 +1,74 @@
+"""Tests of the chunk index and partial reads of banks"""
+
+import struct
+import pytest
+from modules.bnkwizard import BNKWizard
+from modules.synthetic import make_synthetic_bank
+
+# BKHD header and its 16 byte body, as written by make_synthetic_bank
+BKHD_SIZE = 24
+
+
+def make_bank_with_unknown_chunks(path) -> list:
+    """Synthetic bank with an unknown chunk after BKHD and another at the
+    end, returns its WEM ids"""
+    wem_ids = make_synthetic_bank(str(path), 20)["wem_ids"]
+    data = path.read_bytes()
+    init = b"INIT" + struct.pack("<I", 6) + b"abcdef"
+    plat = b"PLAT" + struct.pack("<I", 4) + b"\x01\x02\x03\x04"
+    path.write_bytes(data[:BKHD_SIZE] + init + data[BKHD_SIZE:] + plat)
+    return wem_ids
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_unknown_chunks_written_back_verbatim(tmp_path, use_mmap):
+    """Chunks which are not decoded keep their place and contents"""
+    bank = tmp_path / "bank.bnk"
+    output = tmp_path / "out.bnk"
+    make_bank_with_unknown_chunks(bank)
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank), use_mmap=use_mmap)
+    assert [tag for tag, _, _ in bnkwizard.sections.chunks] == [
+        "BKHD",
+        "INIT",
+        "DIDX",
+        "DATA",
+        "HIRC",
+        "PLAT",
+    ]
+    bnkwizard.write_bnk(str(output))
+    assert output.read_bytes() == bank.read_bytes()
+
+
+def test_partial_read_of_wems(tmp_path):
+    """Reading only DIDX lists the WEMs without the HIRC objects, and such a
+    bank cannot be written"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_bank_with_unknown_chunks(bank)
+    bnkwizard = BNKWizard()
+    bnkwizard.read_bnk(str(bank), headers={"DIDX"})
+    assert list(bnkwizard.wem_list.wem_ids) == wem_ids
+    assert bnkwizard.wem_list.data_buffer is None
+    assert len(bnkwizard.wwise_list.wwise_ids) == 0
+    assert not bnkwizard.sections.complete
+    with pytest.raises(ValueError):
+        bnkwizard.write_bnk(str(tmp_path / "out.bnk"))
+
+
+def test_partial_read_of_payloads_and_objects(tmp_path):
+    """Reading DATA also reads DIDX, which locates the payloads, and HIRC
+    can be read on its own"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_bank_with_unknown_chunks(bank)
+    full = BNKWizard()
+    full.read_bnk(str(bank))
+    payloads = BNKWizard()
+    payloads.read_bnk(str(bank), headers={"DATA"})
+    for wem_id in wem_ids:
+        assert bytes(payloads.wem_list.get_wem(wem_id).data) == bytes(
+            full.wem_list.get_wem(wem_id).data
+        )
+    objects = BNKWizard()
+    objects.read_bnk(str(bank), headers={"HIRC"})
+    assert objects.wem_list.wem_count == 0
+    assert list(objects.wwise_list.wwise_ids) == list(full.wwise_list.wwise_ids)
@@ -0,0 +1,55 @@
+"""Tests of the workspace of open banks"""
+
+from modules import workspace
+from modules.synthetic import make_synthetic_bank
+from modules.workspace import PayloadStore, Workspace
+
+
+def test_payloads_hashed_only_on_size_collision(monkeypatch):
+    """A payload of a unique size is stored without being hashed, same size
+    payloads are hashed and deduplicated"""
+    hashed = []
+
+    def get_digest(data):
+        hashed.append(bytes(data))
+        return bytes(data)
+
+    monkeypatch.setattr(workspace, "get_digest", get_digest)
+    store = PayloadStore()
+    first = store.add(b"abc", "a", True)
+    assert not hashed
+    assert store.add(b"abd", "a", True) is not first
+    assert store.add(b"abc", "b", True) is first
+    assert sorted(set(hashed)) == [b"abc", b"abd"]
+    assert store.get_stored_bytes() == 6
+    store.release("a", [first])
+    assert first.owners == {"b": 1}
+    store.release("b", [first])
+    assert store.get_stored_bytes() == 3
+    store.release("a", [store.hashed[3, b"abd"]])
+    assert not store.hashed_sizes
+    store.add(b"abe", "a", True)
+    assert hashed.count(b"abe") == 0
+
+
+def test_close_bank_releases_payloads_and_replacements(tmp_path):
+    """Closing a bank forgets the payloads only it used and deletes the
+    scratch file of its spilled replacements"""
+    bank = tmp_path / "bank.bnk"
+    wem_ids = make_synthetic_bank(str(bank), 20)["wem_ids"]
+    copy = tmp_path / "copy.bnk"
+    copy.write_bytes(bank.read_bytes())
+    work = Workspace()
+    work.open_bank(str(bank))
+    bnkwizard = work.open_bank(str(copy))
+    stored_bytes = work.store.get_stored_bytes()
+    assert work.get_memory()["saved_bytes"] == stored_bytes
+    repl_store = bnkwizard.wem_list.repl_store
+    repl_store.max_bytes = 0
+    bnkwizard.wem_list.set_replacement_data(wem_ids[0], b"spilled")
+    assert repl_store.spill_file is not None
+    work.close_bank(str(copy))
+    assert repl_store.spill_file is None
+    assert work.store.get_stored_bytes() == stored_bytes
+    work.close_bank(str(bank))
+    assert work.store.get_stored_bytes() == 0